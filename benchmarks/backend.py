@@ -0,0 +1,362 @@
+"""
+Offline benchmark of the backend. Simulated clients replay a request mix against an in-memory database
+and a simulated project, and throughput, p50/p99 latency and allocations per request are reported.
+
+    python benchmarks/backend.py --mix browse --clients 32 --requests 5000
+"""
+import sys, os, json, time, random, argparse, threading, tracemalloc
+from dataclasses import dataclass, field
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dungeonmaker.dm_backend import DMBackend
+from dungeonmaker.dm_backend.concurrency import PooledRequestHandler
+from dungeonmaker.dm_backend.modules.database import InMemoryDatabaseAbstraction
+from dungeonmaker.dm_backend.passwords import PasswordHasher, ScryptParameters
+from dungeonmaker.dm_backend.simulation import CloudDriver, SimulatedProject, SimulatedClient
+
+MIXES : dict[str, dict[str, int]] = {
+    "browse": {"load_tab": 40, "load_room": 35, "like_dungeon": 10, "save_room": 10, "login": 5},
+    "edit": {"load_room": 30, "save_room": 55, "load_tab": 10, "login": 5},
+    "login": {"login": 70, "load_tab": 20, "load_room": 10},
+    "explore": {"load_dungeon_bundle": 30, "load_room": 50, "load_tab": 20},
+    "walk": {"walk_room": 85, "load_tab": 15},
+}
+
+ROOM_ALPHABET = "0123456789abcdef"
+
+
+@dataclass(slots=True)
+class World:
+    """
+    Class for the accounts and dungeons created before measuring.
+    """
+    users : list[tuple[str, str]] = field(kw_only=True, default_factory=list)
+    dungeons : list[tuple[int, list[int]]] = field(kw_only=True, default_factory=list)
+    rooms : list[int] = field(kw_only=True, default_factory=list)
+    positions : dict[int, tuple[int, int]] = field(kw_only=True, default_factory=dict)
+
+
+@dataclass(slots=True)
+class Results:
+    """
+    Class for the latencies and failures of a run.
+    """
+    latencies : dict[str, list[float]] = field(kw_only=True, default_factory=dict)
+    failures : dict[str, int] = field(kw_only=True, default_factory=dict)
+    _lock : threading.Lock = field(kw_only=True, default_factory=threading.Lock)
+
+    def add(self, name : str, latency : float, failed : bool):
+        """
+        Record one request.
+        """
+        with self._lock:
+            self.latencies.setdefault(name, []).append(latency)
+            if failed:
+                self.failures[name] = self.failures.get(name, 0) + 1
+
+
+def build(args : argparse.Namespace) -> tuple[DMBackend, CloudDriver, SimulatedProject]:
+    """
+    Build a backend on an in-memory database and a simulated project.
+    """
+    project = SimulatedProject()
+    backend = DMBackend(
+        db_session=None,
+        cloud=None,
+        project_id=project.id,
+        project=project,
+        database_abstraction=InMemoryDatabaseAbstraction(latency=args.db_latency / 1000),
+        workers=args.workers,
+        write_behind=args.write_behind,
+        local_store=args.local_store,
+        local_write_back=args.local_write_back,
+        password_hasher=PasswordHasher(params=ScryptParameters(n=2**args.kdf_log_n), processes=args.hash_processes)
+    )
+    backend.comment_index.min_refresh_interval = 0
+    backend.register_requests()
+    if backend.local_tier is not None:
+        backend.local_tier.start()
+    backend.dm_session.start()
+    if not args.no_prefetch:
+        backend.prefetcher.start()
+    if isinstance(backend.request_handler, PooledRequestHandler):
+        backend.request_handler.start_workers()
+    return backend, CloudDriver(request_handler=backend.request_handler), project
+
+
+def seed(driver : CloudDriver, project : SimulatedProject, *, users : int, rooms : int, rng : random.Random) -> World:
+    """
+    Sign up users and let each of them build a dungeon with some rooms.
+    """
+    world = World()
+    for index in range(users):
+        username, password = f"player{index}", f"secret{index}"
+        client = driver.connect(username=username)
+        project.post_comment(author=username, content=f"My account: {username}")
+        expect(driver.request(client, f'sign_up("{username}", "{password}")'), "Success!")
+        dungeon_id = rng.randrange(1, 2**31)
+        project.post_comment(author=username, content=f"Set name of {dungeon_id} to Dungeon {index}")
+        room_ids = [rng.randrange(1, 2**31) for _ in range(rooms)]
+        expect(driver.request(client, f'save_dungeon({room_ids[0]}, 0, 0, name="Dungeon {index}", dungeon_id={dungeon_id})'), "success")
+        for room_id in room_ids:
+            expect(driver.request(client, f'save_room({room_id}, "{room_content(rng)}", {dungeon_id})'), "Success!")
+        world.users.append((username, password))
+        world.dungeons.append((dungeon_id, room_ids))
+        world.rooms.extend(room_ids)
+    return world
+
+
+def drop_caches(backend : DMBackend):
+    """
+    Empty the session caches, so the run starts with rooms only in the database.
+    """
+    backend.dm_session.setup_cache()
+    backend.dm_session.room_contents.cache.clear()
+
+
+def refresh_feeds(backend : DMBackend):
+    """
+    Load the seeded dungeons into the tab feeds instead of waiting for the next refresh.
+    """
+    for tab in backend.dm_session.tab_feeds.loaders:
+        backend.dm_session.tab_feeds.refresh(tab)
+
+
+def expect(response : str, fragment : str):
+    """
+    Stop when setting up the benchmark fails.
+    """
+    if fragment not in response:
+        raise RuntimeError(f"Unexpected response while seeding: {response}")
+
+
+def room_content(rng : random.Random) -> str:
+    """
+    Build room content of a realistic size.
+    """
+    return "".join(rng.choice(ROOM_ALPHABET) for _ in range(rng.randrange(200, 800)))
+
+
+def succeeded(name : str, response : str) -> bool:
+    """
+    Check the response to a request of the mix. Anything else, like an error message, counts as a failure.
+    """
+    if response is None:
+        return False
+    if name in ("login", "save_room", "like_dungeon"):
+        return response == "Success!"
+    if name in ("load_room", "walk_room"):
+        return bool(response) and set(response) <= set(ROOM_ALPHABET)
+    try:
+        result = json.loads(response)
+    except ValueError:
+        return False
+    if name == "load_tab":
+        return isinstance(result, list)
+    return isinstance(result, dict) and "rooms" in result
+
+
+def make_request(name : str, *, user : int, world : World, rng : random.Random) -> str:
+    """
+    Build a raw request of the given kind for a user.
+    """
+    if name == "login":
+        username, password = world.users[user]
+        return f'login("{username}", "{password}")'
+    if name == "load_tab":
+        return f'load_tab("{rng.choice(("popular", "new", "random"))}")'
+    if name == "load_room":
+        return f"load_room({rng.choice(world.rooms)})"
+    if name == "save_room":
+        dungeon_id, room_ids = world.dungeons[user]
+        return f'save_room({rng.choice(room_ids)}, "{room_content(rng)}", {dungeon_id})'
+    if name == "load_dungeon_bundle":
+        return f"load_dungeon_bundle({rng.choice(world.dungeons)[0]})"
+    if name == "walk_room":
+        return f"load_room({walk(user, world=world, rng=rng)})"
+    if name == "like_dungeon":
+        return f"like_dungeon({rng.choice(world.dungeons)[0]})"
+    raise ValueError(f"Unknown request {name}.")
+
+
+def walk(user : int, *, world : World, rng : random.Random) -> int:
+    """
+    Move a user to the next room of its walk. Walks start at the first room of a dungeon and mostly go on to the next room.
+    """
+    dungeon, position = world.positions.get(user, (None, 0))
+    if dungeon is None or rng.random() < 0.05:
+        dungeon, position = rng.randrange(len(world.dungeons)), 0
+    else:
+        room_ids = world.dungeons[dungeon][1]
+        step = rng.choices((1, -1, rng.randrange(len(room_ids)) - position), (75, 15, 10))[0]
+        position = min(len(room_ids) - 1, max(0, position + step))
+    world.positions[user] = (dungeon, position)
+    return world.dungeons[dungeon][1][position]
+
+
+def run_client(driver : CloudDriver, client : SimulatedClient, *, user : int, world : World, mix : dict[str, int], requests : int, rng : random.Random, results : Results, think_time : float = 0):
+    """
+    Replay a request mix as one logged in client.
+    """
+    names, weights = list(mix), list(mix.values())
+    for _ in range(requests):
+        name = rng.choices(names, weights)[0]
+        msg = make_request(name, user=user, world=world, rng=rng)
+        start = time.perf_counter()
+        response = driver.request(client, msg)
+        results.add(name, time.perf_counter() - start, not succeeded(name, response))
+        if think_time:
+            time.sleep(rng.uniform(0.5, 1.5) * think_time)
+
+
+def log_in(driver : CloudDriver, world : World, user : int) -> SimulatedClient:
+    """
+    Connect and log in a client as a user.
+    """
+    username, password = world.users[user]
+    client = driver.connect(username=username)
+    expect(driver.request(client, f'login("{username}", "{password}")'), "Success!")
+    return client
+
+
+def measure_throughput(driver : CloudDriver, world : World, mix : dict[str, int], *, clients : int, requests : int, seed : int, think_time : float = 0) -> tuple[Results, float]:
+    """
+    Run all clients at once. Returns the results and the wall time.
+    """
+    results = Results()
+    logged_in = [log_in(driver, world, index % len(world.users)) for index in range(clients)]
+    threads = [
+        threading.Thread(target=run_client, args=(driver, client), kwargs={
+            "user": index % len(world.users),
+            "world": world,
+            "mix": mix,
+            "requests": requests // clients,
+            "rng": random.Random(seed + index),
+            "results": results,
+            "think_time": think_time,
+        })
+        for index, client in enumerate(logged_in)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def measure_allocations(driver : CloudDriver, world : World, mix : dict[str, int], *, requests : int, seed : int) -> dict[str, float]:
+    """
+    Run requests one after another under tracemalloc. Returns the mean peak of newly allocated bytes per request kind.
+    """
+    rng = random.Random(seed)
+    client = log_in(driver, world, 0)
+    names, weights = list(mix), list(mix.values())
+    peaks : dict[str, list[int]] = {}
+    tracemalloc.start()
+    try:
+        for _ in range(requests):
+            name = rng.choices(names, weights)[0]
+            msg = make_request(name, user=0, world=world, rng=rng)
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            driver.request(client, msg)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.setdefault(name, []).append(peak - before)
+    finally:
+        tracemalloc.stop()
+    return {name: sum(values) / len(values) for name, values in peaks.items()}
+
+
+def percentile(values : list[float], q : float) -> float:
+    """
+    Get a percentile of a list of values.
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(results : Results, wall_time : float, allocations : dict[str, float], *, backend : DMBackend) -> dict:
+    """
+    Build the report.
+    """
+    total = sum(len(values) for values in results.latencies.values())
+    every = [value for values in results.latencies.values() for value in values]
+    requests = {
+        name: {
+            "count": len(values),
+            "failures": results.failures.get(name, 0),
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "alloc_kib": allocations.get(name, 0) / 1024,
+        }
+        for name, values in sorted(results.latencies.items())
+    }
+    return {
+        "requests": total,
+        "seconds": wall_time,
+        "throughput": total / wall_time if wall_time else 0,
+        "p50_ms": percentile(every, 0.5) * 1000 if every else 0,
+        "p99_ms": percentile(every, 0.99) * 1000 if every else 0,
+        "by_request": requests,
+        "room_cache": backend.dm_session.cache_stats()["rooms"],
+        "prefetch": backend.prefetcher.stats.to_object(),
+        "room_verdicts": backend.room_validator.verdicts.stats.to_object(),
+    }
+
+
+def print_report(report : dict, *, args : argparse.Namespace):
+    """
+    Print the report as a table.
+    """
+    print(f"mix={args.mix} clients={args.clients} workers={args.workers} write_behind={args.write_behind} db_latency={args.db_latency}ms")
+    print(f"{report['requests']} requests in {report['seconds']:.2f}s: {report['throughput']:.0f} req/s, p50 {report['p50_ms']:.2f}ms, p99 {report['p99_ms']:.2f}ms")
+    print(f"{'request':<20}{'count':>8}{'fail':>6}{'p50 ms':>10}{'p99 ms':>10}{'alloc KiB':>11}")
+    for name, row in report["by_request"].items():
+        print(f"{name:<20}{row['count']:>8}{row['failures']:>6}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['alloc_kib']:>11.1f}")
+    cache, prefetch = report["room_cache"], report["prefetch"]
+    print(f"room cache: {cache['hits']} hits, {cache['misses']} misses; prefetched {prefetch['prefetched']} rooms, {prefetch['transitions']} transitions counted")
+    verdicts = report["room_verdicts"]
+    print(f"room verdicts: {verdicts['hits']} remembered, {verdicts['misses']} validated")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Dungeon Maker backend.")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="browse")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=8, help="rooms per dungeon")
+    parser.add_argument("--workers", type=int, default=1, help="request worker threads")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--local-store", default=None, help="SQLite file answering reads before the database, :memory: for an in-memory one")
+    parser.add_argument("--local-write-back", action="store_true", help="write back to the database from the local store in batches")
+    parser.add_argument("--cold-cache", action="store_true", help="empty the session caches after seeding")
+    parser.add_argument("--no-prefetch", action="store_true", help="don't prefetch the rooms players likely enter next")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause of clients between their requests in milliseconds")
+    parser.add_argument("--db-latency", type=float, default=0, help="simulated database round trip in milliseconds")
+    parser.add_argument("--kdf-log-n", type=int, default=14, help="log2 of the scrypt cost")
+    parser.add_argument("--hash-processes", type=int, default=0, help="password hashing processes, 0 hashes inline")
+    parser.add_argument("--alloc-requests", type=int, default=500, help="requests measured under tracemalloc")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    backend, driver, project = build(args)
+    try:
+        world = seed(driver, project, users=args.users, rooms=args.rooms, rng=random.Random(args.seed))
+        if args.cold_cache:
+            drop_caches(backend)
+        refresh_feeds(backend)
+        results, wall_time = measure_throughput(driver, world, MIXES[args.mix], clients=args.clients, requests=args.requests, seed=args.seed, think_time=args.think_ms / 1000)
+        allocations = measure_allocations(driver, world, MIXES[args.mix], requests=args.alloc_requests, seed=args.seed) if args.alloc_requests else {}
+    finally:
+        backend.stop(cascade_stop=False)
+    report = summarize(results, wall_time, allocations, backend=backend)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args=args)
+
+
+if __name__ == "__main__":
+    main()
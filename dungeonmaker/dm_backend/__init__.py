@@ -2,4 +2,6 @@
 Backend for Dungeon Maker: Reinvented
 """
 from . import modules
-from .backend import DMBackend
\ No newline at end of file
+from .backend import DMBackend
+from .async_backend import AsyncDMBackend
+from .cluster import DMBackendCluster
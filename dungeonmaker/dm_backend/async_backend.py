@@ -0,0 +1,167 @@
+"""
+Submodule for the asyncio backend
+"""
+import asyncio, threading
+from typing import Union, AsyncContextManager, Callable, Coroutine, Sequence
+from scratchcommunication.cloud_socket import CloudSocket
+from scratchcommunication.cloud import CloudConnection
+from scratchattach import Project
+from .modules.database import AsyncMongoDBDatabaseAbstraction, AsyncMongoDBAtlasSession
+from .modules.dm.async_session import AsyncDMSession
+from .modules.dm.dmtypes import BaseAsyncDatabaseAbstraction, RoomId, DungeonId, UserId
+from .modules.dm.user import User
+from .modules.dm.dungeon import Dungeon
+from .modules.dm.room import Room
+from .modules.dm.feeds import POPULAR_TAB, NEWEST_TAB
+from .modules.dm.prefetch import AsyncRoomPrefetcher
+from .modules.dm.validation import RoomValidator
+from .backend import DMBackend
+from .concurrency import AsyncRequestHandler
+from .clients import BaseClientStore
+from .modules.dm.metrics import MetricsRegistry
+from .passwords import PasswordHasher
+
+
+class AsyncDMBackend(DMBackend):
+    """
+    Class for the Dungeon Maker Reinvented backend handling requests as coroutines on one event loop.
+    It registers the request handlers of DMBackend and only replaces the primitives they await.
+    """
+    loop : asyncio.AbstractEventLoop
+    loop_thread : Union[threading.Thread, None]
+
+    def __init__(self, *, db_session : AsyncMongoDBAtlasSession = None, cloud : CloudConnection, project_id : int, security : Union[tuple, None] = None, database_abstraction : BaseAsyncDatabaseAbstraction = None, client_store : BaseClientStore = None, password_hasher : PasswordHasher = None, metrics : MetricsRegistry = None, project : Project = None, room_validator : RoomValidator = None):
+        self.db_session = db_session
+        self.db_abstraction = database_abstraction or AsyncMongoDBDatabaseAbstraction(connection=db_session)
+        self.local_tier = None
+        self.metrics = metrics or MetricsRegistry()
+        self.dm_session = AsyncDMSession(database_abstraction=self.db_abstraction, metrics=self.metrics)
+        self.cloud = cloud
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = None
+        self.request_handler = AsyncRequestHandler(cloud_socket=CloudSocket(cloud=cloud, security=security) if cloud is not None else None, loop=self.loop)
+        self.init_shared(project_id=project_id, project=project, client_store=client_store, password_hasher=password_hasher, room_validator=room_validator)
+        self.prefetcher = AsyncRoomPrefetcher(session=self.dm_session)
+
+    async def setup(self):
+        """
+        Connect to the database and start the background work of the session.
+        """
+        if self.db_session is not None:
+            await self.db_session.connect()
+        await self.dm_session.start()
+        await self.prefetcher.start()
+
+    def run(self, *, thread : bool = True, duration : Union[float, int, None] = None, cascade_stop : bool = True):
+        """
+        Run the program.
+        """
+        self.register_requests()
+        if self.loop_thread is None or not self.loop_thread.is_alive():
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, name="AsyncDMBackend", daemon=True)
+            self.loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self.setup(), self.loop).result()
+        self.comment_index.start()
+        return self.request_handler.start(thread=thread, duration=duration, cascade_stop=cascade_stop)
+
+    def stop(self, cascade_stop : bool = True):
+        """
+        Stop the dungeon maker backend, flush all pending writes and stop the event loop.
+        """
+        self.request_handler.stop(cascade_stop=cascade_stop)
+        self.comment_index.stop()
+        self.passwords.close()
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.prefetcher.stop(), self.loop).result()
+            asyncio.run_coroutine_threadsafe(self.dm_session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.loop_thread is not None:
+            self.loop_thread.join(5)
+        self.loop_thread = None
+
+    async def find_tab(self, tab : str, *, after : str = None) -> tuple[list[Dungeon], Union[str, None]]:
+        """
+        Find a page of a tab and the token of the page after it. Raises ValueError if after is not a valid token.
+        """
+        if tab == "popular":
+            data = await self.dm_session.get_popular_tab(after=after)
+            return data, self.dm_session.next_tab_cursor(POPULAR_TAB, data)
+        if tab == "random":
+            return await self.dm_session.get_default_tab(), None
+        if tab == "new":
+            data = await self.dm_session.get_newest_tab(after=after)
+            return data, self.dm_session.next_tab_cursor(NEWEST_TAB, data)
+        return [], None
+    
+    def register(self, *, name : str) -> Callable[[Callable[..., Coroutine]], None]:
+        """
+        Decorator registering a request handler written as a coroutine function, which runs on the event loop.
+        """
+        def decorator(function : Callable[..., Coroutine]):
+            self.request_handler.request(function, name=name, allow_python_syntax=True, auto_convert=True)
+        return decorator
+
+    def locked(self, *objects : tuple[str, Union[DungeonId, RoomId, UserId, str]]) -> AsyncContextManager[None]:
+        """
+        Lock objects of the session for the duration of a request.
+        """
+        return self.dm_session.locked(*objects)
+
+    async def find(self, __type : str, __id : Union[DungeonId, RoomId, UserId] = None, *, name : str = None) -> Union[Dungeon, Room, User]:
+        """
+        Find a dungeon, room or user. Raises KeyError if it doesn't exist.
+        """
+        return await self.dm_session.find(__type, __id, name=name)
+
+    async def find_rooms(self, room_ids : Sequence[RoomId]) -> list[Room]:
+        """
+        Find several rooms at once, leaving out those that don't exist.
+        """
+        return await self.dm_session.find_rooms(room_ids)
+
+    async def write(self, *objects : Union[Dungeon, Room, User]):
+        """
+        Write dungeons, rooms or users and send their changes.
+        """
+        await self.dm_session.write(*objects)
+
+    async def like(self, dungeon : Dungeon, user : User) -> bool:
+        """
+        Register a like. Returns whether the like was new.
+        """
+        return await self.dm_session.like(dungeon, user)
+
+    async def unlike(self, dungeon : Dungeon, user : User) -> bool:
+        """
+        Register an unlike. Returns whether there was a like to remove.
+        """
+        return await self.dm_session.unlike(dungeon, user)
+
+    async def verify_password(self, *, user_id : UserId, username : str, password : str, passdata : str) -> bool:
+        """
+        Check a password against the stored passdata without blocking the event loop.
+        """
+        return await self.passwords.verify_async(user_id=user_id, username=username, password=password, passdata=passdata)
+
+    async def hash_password(self, password : str) -> str:
+        """
+        Hash a new password without blocking the event loop.
+        """
+        return await self.passwords.hash_async(password)
+
+    async def user_has_linked(self, linked_user : str) -> Union[None, User]:
+        """
+        Find out if a user has linked an account to his name.
+        """
+        try:
+            return await self.dm_session.find_linked_user(linked_user)
+        except KeyError:
+            return None
+
+    async def find_comment(self, *, content : str = None, user : str = None) -> bool:
+        """
+        Find a comment, only leaving the event loop if the comments have to be fetched.
+        """
+        if self.comment_index.lookup(content=content, user=user):
+            return True
+        return await asyncio.to_thread(self.comment_index.find, content=content, user=user)
@@ -1,22 +1,41 @@
 """
 Submodule for the backend
 """
-import pickle, hmac, json, secrets
-from hashlib import sha3_256
+import json, secrets, functools
+from contextlib import asynccontextmanager
 from types import ModuleType
-from typing import Union, Any
+from typing import Union, Any, AsyncIterator, Callable, Coroutine, Sequence, TypeVar
 from dataclasses import dataclass, field
 from scratchcommunication.cloud_socket import CloudSocket
 from scratchcommunication.cloud import CloudConnection
 from scratchcommunication.cloudrequests import RequestHandler, ErrorMessage
 from scratchattach import get_project, Project
-from .modules.database import MongoDBDatabaseAbstraction, MongoDBAtlasSession
+from .modules.database import MongoDBDatabaseAbstraction, MongoDBAtlasSession, SQLiteDocumentStore, TieredDatabaseAbstraction
 from .modules.dm.session import DMSession
-from .modules.dm.selectors import DUNGEON, ROOM, USER
-from .modules.dm.user import User, s_vars
-from .modules.dm.dmtypes import RoomId, DungeonId, UserId
+from .modules.dm.selectors import DUNGEON, ROOM, USER, USERNAME, LINKED_USER
+from .modules.dm.user import User
+from .modules.dm.utils import s_vars
+from .modules.dm.dmtypes import RoomId, DungeonId, UserId, BaseDatabaseAbstraction
 from .modules.dm.dungeon import Dungeon, DungeonUser
 from .modules.dm.room import Room
+from .modules.dm.feeds import POPULAR_TAB, NEWEST_TAB
+from .modules.dm.prefetch import RoomPrefetcher
+from .modules.dm.validation import RoomValidator
+from .comments import CommentIndex, comment_fields
+from .concurrency import PooledRequestHandler
+from .dispatch import DMRequestHandler
+from .clients import BaseClientStore, ClientRecord, MemoryClientStore
+from .monitoring import instrument_requests
+from .modules.dm.metrics import MetricsRegistry
+from .passwords import PasswordHasher, gen_passdata
+from .transfer import Upload, UploadStore, content_chunk, clamp_chunk_size, encoded_content, decoded_content, apply_delta, checksum
+
+MAX_BATCH_ROOMS = 32
+
+BUNDLE_RADIUS = 4
+
+T = TypeVar("T")
+
 
 @dataclass(slots=True)
 class DMBackend:
@@ -24,90 +43,129 @@ class DMBackend:
     Class for the Dungeon Maker Reinvented backend.
     """
     db_session : MongoDBAtlasSession = field(kw_only=True)
-    db_abstraction : MongoDBDatabaseAbstraction = field(init=False)
+    db_abstraction : BaseDatabaseAbstraction = field(init=False)
+    local_tier : Union[TieredDatabaseAbstraction, None] = field(init=False)
     dm_session : DMSession = field(init=False)
     cloud : CloudConnection = field(kw_only=True)
-    clients : dict[str, dict[str, Any]] = field(init=False)
+    clients : BaseClientStore = field(init=False)
+    passwords : PasswordHasher = field(init=False)
+    metrics : MetricsRegistry = field(init=False)
     request_handler : RequestHandler = field(init=False)
     project_id : int = field(kw_only=True)
     project : Project = field(init=False)
+    comment_index : CommentIndex = field(init=False)
+    uploads : UploadStore = field(init=False)
+    prefetcher : RoomPrefetcher = field(init=False)
+    room_validator : RoomValidator = field(init=False)
     
-    def __init__(self, *, db_session : MongoDBAtlasSession, cloud : CloudConnection, project_id : int, security : Union[tuple, None] = None):
+    def __init__(self, *, db_session : Union[MongoDBAtlasSession, None], cloud : Union[CloudConnection, None], project_id : int, security : Union[tuple, None] = None, write_behind : bool = False, workers : int = 1, client_store : BaseClientStore = None, request_handler : RequestHandler = None, cache_ttl : Union[float, None] = 300, password_hasher : PasswordHasher = None, metrics : MetricsRegistry = None, database_abstraction : BaseDatabaseAbstraction = None, project : Project = None, local_store : Union[str, None] = None, local_write_back : bool = False, room_validator : RoomValidator = None):
+        """
+        Pass a database_abstraction and a project instead of db_session and project_id to run without MongoDB or Scratch, e.g. in benchmarks.
+        The indexes are not created here, run the create-indexes migration for that.
+        Pass the path of an SQLite file as local_store to answer reads from it before the database, writing through to the database or, with local_write_back, back in batches.
+        """
         self.db_session = db_session
-        self.db_abstraction = MongoDBDatabaseAbstraction(connection=db_session)
-        self.dm_session = DMSession()
+        if database_abstraction is None:
+            database_abstraction = MongoDBDatabaseAbstraction(connection=db_session)
+        self.local_tier = None
+        if local_store is not None:
+            self.local_tier = TieredDatabaseAbstraction(local=SQLiteDocumentStore(local_store), remote=database_abstraction, write_back=local_write_back)
+            database_abstraction = self.local_tier
+        self.db_abstraction = database_abstraction
+        self.metrics = metrics or MetricsRegistry()
+        self.dm_session = DMSession(write_behind=write_behind, cache_ttl=cache_ttl, metrics=self.metrics)
         self.dm_session.add_database_abstraction(self.db_abstraction)
+        self.dm_session.database_selector.validate()
         self.cloud = cloud
-        self.request_handler = RequestHandler(cloud_socket=CloudSocket(cloud=cloud, security=security))
-        self.clients = {}
+        cloud_socket = CloudSocket(cloud=cloud, security=security) if cloud is not None else None
+        if request_handler is not None:
+            self.request_handler = request_handler
+        elif workers > 1:
+            self.request_handler = PooledRequestHandler(cloud_socket=cloud_socket, workers=workers)
+        else:
+            self.request_handler = DMRequestHandler(cloud_socket=cloud_socket)
+        self.init_shared(project_id=project_id, project=project, client_store=client_store, password_hasher=password_hasher, room_validator=room_validator)
+        self.prefetcher = RoomPrefetcher(session=self.dm_session)
+    
+    def init_shared(self, *, project_id : int, project : Union[Project, None], client_store : Union[BaseClientStore, None], password_hasher : Union[PasswordHasher, None], room_validator : Union[RoomValidator, None]):
+        """
+        Set up what DMBackend and AsyncDMBackend share: clients, passwords, the project and its comments, uploads and room validation.
+        Call it after self.metrics is set.
+        """
+        self.clients = client_store or MemoryClientStore()
+        self.passwords = password_hasher or PasswordHasher()
         self.project_id = project_id
-        self.project = get_project(project_id)
+        self.project = project or get_project(project_id)
+        self.comment_index = CommentIndex(project=self.project, metrics=self.metrics)
+        self.uploads = UploadStore()
+        self.room_validator = room_validator or RoomValidator()
         
-    def run(self, *, thread : bool = True, duration : Union[float, int, None] = None, cascade_stop : bool = True):
+    def register_requests(self):
         """
-        Run the program.
+        Register all request handlers on the request handler.
+        They are coroutine functions shared with AsyncDMBackend, which only differs in the primitives they await.
         """
-        @self.request_handler.request(name="login", allow_python_syntax=True, auto_convert=True)
-        def login(username : str, password : str) -> str:
+        @self.register(name="login")
+        async def login(username : str, password : str) -> str:
             user : User
-            passdata = gen_passdata(username=username, password=password)
+            client = self.current_client_data
             try:
-                user = self.dm_session.find(USER, name=username)
+                user = await self.find(USER, name=username)
             except KeyError:
                 raise ErrorMessage("Username doesn't exist.")
-            if not hmac.compare_digest(passdata, user.passdata):
-                self.current_client_data.setdefault("logged_in", False)
-                self.current_client_data.setdefault("username", None)
-                self.current_client_data.setdefault("user_id", None)
+            if not await self.verify_password(user_id=user.user_id, username=user.username, password=password, passdata=user.passdata):
                 raise ErrorMessage("Wrong credentials")
-            self.current_client_data["logged_in"] = True
-            self.current_client_data["username"] = user.username
-            self.current_client_data["user_id"] = user.user_id
+            if self.passwords.needs_rehash(user.passdata):
+                async with self.locked((USER, user.user_id)):
+                    user.passdata = await self.hash_password(password)
+                    await self.write(user)
+            client.log_in(username=user.username, user_id=user.user_id)
+            self.clients.save(client)
             return "Success!"
         
-        @self.request_handler.request(name="sign_up", allow_python_syntax=True, auto_convert=True)
-        def sign_up(username : str, password : str, linked_user : str = None) -> str:
+        @self.register(name="sign_up")
+        async def sign_up(username : str, password : str, linked_user : str = None) -> str:
             user : User
-            passdata = gen_passdata(username=username, password=password)
-            try:
-                user = self.dm_session.find(USER, name=username)
-            except KeyError:
-                pass
-            except Exception as e:
-                raise RuntimeError("Some error occured") from e
-            else:
-                raise ErrorMessage("Username already exists.")
-            if len(password) < 3 or len(username) < 3:
-                raise ErrorMessage("Your username and password needs to be at least 3 characters long.")
-            self.current_client_data["logged_in"] = True
-            self.current_client_data["username"] = username
-            linked_user = linked_user.lower()
-            if linked_user:
-                has_linked = user_has_linked(session=self.dm_session, user=linked_user)
-                if has_linked:
-                    raise ErrorMessage(f"You already have an account linked: {has_linked['username']}")
-                project = self.project
-                user = linked_user
-                comment = f"My account: {username}"
-                if not find_comment(project, content=comment, user=user):
-                    raise ErrorMessage(f"Couldn't link your new account to your scratch username. Try commenting \"{comment}\" on the project again.")
-            else:
-                project = self.project
-                comment = f"My account: {username}"
-                if not find_comment(project=project, content=comment):
-                    raise ErrorMessage(f"Couldn't verify your username. Try commenting \"{comment}\" on the project again.")
-            user = self.dm_session.create(USER, kwargs={"username": username, "passdata": passdata, "linked_user": linked_user})
-            self.current_client_data["user_id"] = user.user_id
-            user.write()
-            return "Success!"
+            client = self.current_client_data
+            linked_user = linked_user.lower() if linked_user else None
+            claims = [(USERNAME, username)] + ([(LINKED_USER, linked_user)] if linked_user else [])
+            async with self.locked(*claims):
+                try:
+                    user = await self.find(USER, name=username)
+                except KeyError:
+                    pass
+                except Exception as e:
+                    raise RuntimeError("Some error occured") from e
+                else:
+                    raise ErrorMessage("Username already exists.")
+                if len(password) < 3 or len(username) < 3:
+                    raise ErrorMessage("Your username and password needs to be at least 3 characters long.")
+                if linked_user:
+                    has_linked = await self.user_has_linked(linked_user)
+                    if has_linked:
+                        raise ErrorMessage(f"You already have an account linked: {has_linked.username}")
+                    comment = f"My account: {username}"
+                    if not await self.find_comment(content=comment, user=linked_user):
+                        raise ErrorMessage(f"Couldn't link your new account to your scratch username. Try commenting \"{comment}\" on the project again.")
+                else:
+                    comment = f"My account: {username}"
+                    if not await self.find_comment(content=comment):
+                        raise ErrorMessage(f"Couldn't verify your username. Try commenting \"{comment}\" on the project again.")
+                passdata = await self.hash_password(password)
+                user = self.dm_session.create(USER, kwargs={"username": username, "passdata": passdata, "linked_user": linked_user})
+                await self.write(user)
+                client.log_in(username=username, user_id=user.user_id)
+                self.clients.save(client)
+                return "Success!"
         
-        @self.request_handler.request(name="load_private_profile", allow_python_syntax=True, auto_convert=True)
-        def load_private_profile() -> json.dumps:
-            self.ensure_login()
-            user_data = s_vars(self.find_current_client_user())
+        @self.register(name="load_private_profile")
+        async def load_private_profile() -> json.dumps:
+            client = self.current_client_data
+            self.ensure_login(client)
+            user_data = s_vars(await self.find_current_client_user(client))
             user_data = include_data(user_data, include=
                 [
-                    "username", 
+                    "username",
                     "user_id",
                     "admin_level",
                     "linked_user",
@@ -119,18 +177,18 @@ class DMBackend:
             )
             user_data["passdata"] = "maybe not"
             return {"success": True, "result": user_data, "reason": "success"}
-                
-        @self.request_handler.request(name="load_profile", allow_python_syntax=True, auto_convert=True)
-        def load_profile(username : str = None, *, user_id : str = None) -> json.dumps:
+        
+        @self.register(name="load_profile")
+        async def load_profile(username : str = None, *, user_id : str = None) -> json.dumps:
             user : User
             try:
-                user = self.dm_session.find(USER, __id=user_id, name=username)
+                user = await self.find(USER, user_id, name=username)
             except KeyError:
                 raise ErrorMessage(json.dumps({"success": False, "result": None, "reason": "That profile doesn't seem to exist."}))
             user_data = s_vars(user)
             user_data = include_data(user_data, include=
                 [
-                    "username", 
+                    "username",
                     "user_id",
                     "admin_level",
                     "linked_user",
@@ -141,249 +199,502 @@ class DMBackend:
             )
             return {"success": True, "result": user_data, "reason": "success"}
         
-        @self.request_handler.request(name="link_user", allow_python_syntax=True, auto_convert=True)
-        def link_user(linked_user : str, password : str) -> str:
+        @self.register(name="link_user")
+        async def link_user(linked_user : str, password : str) -> str:
             user : User
-            self.ensure_login()
+            client = self.current_client_data
+            self.ensure_login(client)
             linked_user = linked_user.lower()
-            has_linked = user_has_linked(session=self.dm_session, user=linked_user)
-            if has_linked:
-                raise ErrorMessage(f"You already have an account linked: {has_linked['username']}")
-            user = self.find_current_client_user()
-            passdata = gen_passdata(username=self.current_client_data["username"], password=password)
-            if passdata != user.passdata:
-                raise ErrorMessage("Wrong password.")
-            project = self.project
-            username = self.current_client_data["username"]
-            comment = f"My account: {username}"
-            user = linked_user
-            if not find_comment(project=project, user=user):
-                raise ErrorMessage(f"Couldn't link your new account to your scratch username. Try commenting \"{comment}\" on the project again.")
-            user.linked_user = linked_user
-            user.write()
-            return "Success!"
+            async with self.locked((USER, client.user_id), (LINKED_USER, linked_user)):
+                has_linked = await self.user_has_linked(linked_user)
+                if has_linked:
+                    raise ErrorMessage(f"You already have an account linked: {has_linked.username}")
+                user = await self.find_current_client_user(client)
+                if not await self.verify_password(user_id=user.user_id, username=user.username, password=password, passdata=user.passdata):
+                    raise ErrorMessage("Wrong password.")
+                username = client.username
+                comment = f"My account: {username}"
+                if not await self.find_comment(content=comment, user=linked_user):
+                    raise ErrorMessage(f"Couldn't link your new account to your scratch username. Try commenting \"{comment}\" on the project again.")
+                user.linked_user = linked_user
+                await self.write(user)
+                return "Success!"
         
-        @self.request_handler.request(name="unlink_user", allow_python_syntax=True, auto_convert=True)
-        def unlink_user(password : str) -> str:
+        @self.register(name="unlink_user")
+        async def unlink_user(password : str) -> str:
             user : User
-            self.ensure_login
-            user = self.find_current_client_user()
-            passdata = gen_passdata(username=self.current_client_data["username"], password=password)
-            if passdata != user.passdata:
-                raise ErrorMessage("Wrong password.")
-            user.linked_user = None
-            user.write()
-            return "Success!"
+            client = self.current_client_data
+            self.ensure_login(client)
+            async with self.locked((USER, client.user_id)):
+                user = await self.find_current_client_user(client)
+                if not await self.verify_password(user_id=user.user_id, username=user.username, password=password, passdata=user.passdata):
+                    raise ErrorMessage("Wrong password.")
+                user.linked_user = None
+                await self.write(user)
+                return "Success!"
         
-        @self.request_handler.request(name="reset_password", allow_python_syntax=True, auto_convert=True)
-        def reset_password(username : str, password : str = None, linked_user : str = None, code : int = None) -> str:
+        @self.register(name="reset_password")
+        async def reset_password(username : str, password : str = None, linked_user : str = None, code : int = None) -> str:
             user : User
+            client = self.current_client_data
             if code is None:
-                code = secrets.randbits(24)
-                self.current_client_data["password_reset_code"] = code
+                code = client.new_password_reset_code()
+                self.clients.save(client)
                 return f"Your password reset code is \"{code}\". Comment \"Password reset code: {code}\" using your linked account."
-            if code != self.current_client_data["password_reset_code"]:
+            if not client.check_password_reset_code(code):
                 raise ErrorMessage("Wrong code.")
-            user = self.dm_session.find(USER, name=username)
-            if user.linked_user is None:
-                raise ErrorMessage("You do not have a user linked, so you cannot reset your password like this. Try commenting on the project for help.")
-            if linked_user != user.linked_user:
-                raise ErrorMessage("That is not your linked user.")
-            project = self.project
-            comment = f"Password reset code: {code}"
-            user = linked_user
-            if not find_comment(project, content=comment, user=user):
-                raise ErrorMessage(f"Couldn't verify your password reset request. Try commenting \"{comment}\" on the project again.")
-            passdata = gen_passdata(username=username, password=password)
-            user.passdata = passdata
-            user.write()
-            return "Success!"
-        
-        @self.request_handler.request(name="logout", allow_python_syntax=True, auto_convert=True)
-        def logout() -> str:
-            self.current_client_data["logged_in"] = False
-            self.current_client_data["username"] = None
-            self.current_client_data["user_id"] = None
-            return "OK"
-        
-        @self.request_handler.request(name="save_dungeon", allow_python_syntax=True, auto_convert=True)
-        def save_dungeon(start_room : RoomId, start_x : int, start_y : int, name : str = None, dungeon_id : DungeonId = None) -> json.dumps:
-            dungeon : Dungeon
-            self.ensure_login()
             try:
-                dungeon = self.dm_session.find(DUNGEON, dungeon_id)
+                user = await self.find(USER, name=username)
             except KeyError:
-                dungeon_id = dungeon_id or secrets.randbits(32)
-                dungeon = self.dm_session.create(Dungeon, kwargs={
-                    "description": "", 
-                    "name": name, 
-                    "owner": self.current_client_data["user_id"],
-                    "owner_name": self.current_client_data["username"],
-                    "start": ()
-                })
-                if not name:
-                    raise ErrorMessage("You need to pick a name.")
-                if not find_comment(self.project, content=f"Set name of {dungeon.dungeon_id} to {name}"):
-                    raise ErrorMessage(f"Could not confirm name. Comment \"Set name of {dungeon.dungeon_id} to {name}\" and try again.")
-                user = self.find_current_client_user()
-                user.remaining_dungeons -= 1
-                user.owned_dungeons.append(dungeon_id)
-                user.permitted_dungeons.append(dungeon_id)
-                user.write()
-            if not dungeon.get_user(self.current_client_data["username"]).permitions.get("edit_infos"):
-                raise ErrorMessage("Not Authorized")
-            if name:
-                if not find_comment(self.project, content=f"Set name of {dungeon.dungeon_id} to {name}"):
-                    raise ErrorMessage(f"Could not confirm name. Comment \"Set name of {dungeon.dungeon_id} to {name}\" and try again.")
-                dungeon.name = name
-            dungeon.start = (start_room, start_x, start_y)
-            dungeon.write()
-            return {"dungeon_id": dungeon.dungeon_id, "success": True}
-            
-        @self.request_handler.request(name="save_dungeon_infos", allow_python_syntax=True, auto_convert=True)
-        def save_dungeon_infos(dungeon_id : DungeonId) -> str:
-            pass
+                raise ErrorMessage("Username doesn't exist.")
+            async with self.locked((USER, user.user_id)):
+                if user.linked_user is None:
+                    raise ErrorMessage("You do not have a user linked, so you cannot reset your password like this. Try commenting on the project for help.")
+                if linked_user != user.linked_user:
+                    raise ErrorMessage("That is not your linked user.")
+                comment = f"Password reset code: {code}"
+                if not await self.find_comment(content=comment, user=linked_user):
+                    raise ErrorMessage(f"Couldn't verify your password reset request. Try commenting \"{comment}\" on the project again.")
+                user.passdata = await self.hash_password(password)
+                await self.write(user)
+                client.password_reset_code = None
+                self.clients.save(client)
+                return "Success!"
         
-        @self.request_handler.request(name="save_room", allow_python_syntax=True, auto_convert=True)
-        def save_room(room_id : RoomId, content : str, bound_dungeon : DungeonId) -> str:
-            room : Room
+        @self.register(name="logout")
+        async def logout() -> str:
+            client = self.current_client_data
+            client.log_out()
+            self.clients.save(client)
+            return "OK"
+        
+        @self.register(name="save_dungeon")
+        async def save_dungeon(start_room : RoomId, start_x : int, start_y : int, name : str = None, dungeon_id : DungeonId = None) -> json.dumps:
             dungeon : Dungeon
-            self.ensure_login()
-            try:
-                room = self.dm_session.find(ROOM, room_id)
-            except KeyError:
-                try:
-                    dungeon = self.dm_session.find(DUNGEON, bound_dungeon)
-                except KeyError:
-                    raise ErrorMessage("Dungeon does not exist.")
-                if not dungeon.permissions[self.current_client_data["user_id"]].can_edit_room(room_id=room_id):
-                    raise ErrorMessage("Not authorized")
-                room = dungeon.new_room(room_id=room_id)
-                user = self.find_current_client_user()
-                user.remaining_rooms -= 1
-                user.write()
-            else:
-                if not room.dungeon_id == bound_dungeon:
-                    raise ErrorMessage("Wrong dungeon bound.")
+            client = self.current_client_data
+            self.ensure_login(client)
+            async with self.locked((DUNGEON, dungeon_id), (USER, client.user_id)):
                 try:
-                    dungeon = self.dm_session.find(DUNGEON, bound_dungeon)
+                    dungeon = await self.find(DUNGEON, dungeon_id)
                 except KeyError:
-                    raise ErrorMessage("Dungeon does not exist.")
-                if not dungeon.permissions[self.current_client_data["user_id"]].can_edit_room(room_id=room_id):
-                    raise ErrorMessage("Not authorized")
-            room.content = content
-            room.write()
-            dungeon.log_update()
-            dungeon.write()
+                    dungeon_id = dungeon_id or secrets.randbits(32)
+                    dungeon = self.dm_session.create(DUNGEON, kwargs={
+                        "dungeon_id": dungeon_id,
+                        "description": "",
+                        "name": name,
+                        "owner": client.user_id,
+                        "owner_name": client.username,
+                        "start": ()
+                    })
+                    if not name:
+                        raise ErrorMessage("You need to pick a name.")
+                    if not await self.find_comment(content=f"Set name of {dungeon.dungeon_id} to {name}"):
+                        raise ErrorMessage(f"Could not confirm name. Comment \"Set name of {dungeon.dungeon_id} to {name}\" and try again.")
+                    user = await self.find_current_client_user(client)
+                    user.remaining_dungeons -= 1
+                    user.owned_dungeons.append(dungeon_id)
+                    user.permitted_dungeons.append(dungeon_id)
+                    await self.write(user)
+                if not dungeon.get_user(user_id=client.user_id).permissions.get("edit_infos").value:
+                    raise ErrorMessage("Not Authorized")
+                if name:
+                    if not await self.find_comment(content=f"Set name of {dungeon.dungeon_id} to {name}"):
+                        raise ErrorMessage(f"Could not confirm name. Comment \"Set name of {dungeon.dungeon_id} to {name}\" and try again.")
+                    dungeon.name = name
+                dungeon.start = (start_room, start_x, start_y)
+                await self.write(dungeon)
+                return {"dungeon_id": dungeon.dungeon_id, "success": True}
+        
+        @self.register(name="save_dungeon_infos")
+        async def save_dungeon_infos(dungeon_id : DungeonId) -> str:
+            pass
+        
+        @self.register(name="save_room")
+        async def save_room(room_id : RoomId, content : str, bound_dungeon : DungeonId) -> str:
+            client = self.current_client_data
+            await self.write_room(client, room_id, bound_dungeon, lambda current: content)
             return "Success!"
         
-        @self.request_handler.request(name="load_room", allow_python_syntax=True, auto_convert=True)
-        def load_room(room_id : RoomId) -> str:
+        @self.register(name="save_room_delta")
+        async def save_room_delta(room_id : RoomId, bound_dungeon : DungeonId, base_crc : int, *edits : Any) -> json.dumps:
+            client = self.current_client_data
+            return stored_room(await self.write_room(client, room_id, bound_dungeon, lambda current: edited_content(current, base_crc, edits)))
+        
+        @self.register(name="save_room_encoded")
+        async def save_room_encoded(room_id : RoomId, data : str, bound_dungeon : DungeonId) -> json.dumps:
+            client = self.current_client_data
+            try:
+                content = decoded_content(data)
+            except ValueError as e:
+                raise ErrorMessage(str(e))
+            return stored_room(await self.write_room(client, room_id, bound_dungeon, lambda current: content))
+        
+        @self.register(name="begin_room_upload")
+        async def begin_room_upload(room_id : RoomId, bound_dungeon : DungeonId, size : int, content_crc : int, chunk_size : int = None) -> json.dumps:
+            client = self.current_client_data
+            self.ensure_login(client)
+            if size > self.room_validator.max_size:
+                raise ErrorMessage(f"Rooms can be at most {self.room_validator.max_size} characters long.")
+            try:
+                upload = self.uploads.begin(user_id=client.user_id, room_id=room_id, bound_dungeon=bound_dungeon, size=size, content_crc=content_crc, chunk_size=chunk_size)
+            except ValueError as e:
+                raise ErrorMessage(str(e))
+            return {"upload_id": upload.upload_id, "chunk_size": upload.chunk_size, "chunks": upload.count}
+        
+        @self.register(name="upload_room_chunk")
+        async def upload_room_chunk(upload_id : str, index : int, data : str, crc : int) -> json.dumps:
+            client = self.current_client_data
+            upload = self.find_upload(client, upload_id)
+            try:
+                upload.add(index, data, crc)
+            except ValueError as e:
+                raise ErrorMessage(str(e))
+            return {"missing": upload.missing()}
+        
+        @self.register(name="room_upload_status")
+        async def room_upload_status(upload_id : str) -> json.dumps:
+            client = self.current_client_data
+            return {"missing": self.find_upload(client, upload_id).missing()}
+        
+        @self.register(name="commit_room_upload")
+        async def commit_room_upload(upload_id : str) -> json.dumps:
+            client = self.current_client_data
+            upload = self.find_upload(client, upload_id)
+            try:
+                content = upload.assemble()
+            except ValueError as e:
+                raise ErrorMessage(str(e))
+            room = await self.write_room(client, upload.room_id, upload.bound_dungeon, lambda current: content)
+            self.uploads.finish(upload_id)
+            return stored_room(room)
+        
+        @self.register(name="load_room")
+        async def load_room(room_id : RoomId) -> str:
             room : Room
-            room = self.dm_session.find(ROOM, room_id)
+            room = await self.find(ROOM, room_id)
+            self.prefetcher.visit(self.request_handler.current_client.client_id, room.dungeon_id, room.room_id)
             return room.content
         
-        @self.request_handler.request(name="like_dungeon", allow_python_syntax=True, auto_convert=True)
-        def like_dungeon(dungeon_id : DungeonId) -> str:
+        @self.register(name="load_room_chunk")
+        async def load_room_chunk(room_id : RoomId, index : int = 0, chunk_size : int = None) -> json.dumps:
+            room : Room
+            room = await self.find(ROOM, room_id)
+            try:
+                return content_chunk(room.content or "", index, chunk_size=clamp_chunk_size(chunk_size))
+            except IndexError as e:
+                raise ErrorMessage(str(e))
+        
+        @self.register(name="load_room_encoded")
+        async def load_room_encoded(room_id : RoomId) -> str:
+            room : Room
+            room = await self.find(ROOM, room_id)
+            self.prefetcher.visit(self.request_handler.current_client.client_id, room.dungeon_id, room.room_id)
+            return encoded_content(room.content or "")
+        
+        @self.register(name="load_rooms")
+        async def load_rooms(*room_ids : RoomId) -> json.dumps:
+            if len(room_ids) > MAX_BATCH_ROOMS:
+                raise ErrorMessage(f"You can load at most {MAX_BATCH_ROOMS} rooms at once.")
+            rooms = await self.find_rooms(room_ids)
+            return {"rooms": [[room.room_id, room.content] for room in rooms]}
+        
+        @self.register(name="load_dungeon_bundle")
+        async def load_dungeon_bundle(dungeon_id : DungeonId, room_id : RoomId = None) -> json.dumps:
+            dungeon : Dungeon
+            try:
+                dungeon = await self.find(DUNGEON, dungeon_id)
+            except KeyError:
+                raise ErrorMessage("Dungeon does not exist.")
+            rooms = await self.find_rooms(dungeon.nearby_rooms(room_id, radius=BUNDLE_RADIUS))
+            self.prefetcher.visit(self.request_handler.current_client.client_id, dungeon.dungeon_id, room_id)
+            return {"dungeon_id": dungeon.dungeon_id, "start": list(dungeon.start), "rooms": [[room.room_id, room.content] for room in rooms]}
+        
+        @self.register(name="like_dungeon")
+        async def like_dungeon(dungeon_id : DungeonId) -> str:
             dungeon : Dungeon
             user : User
-            self.ensure_login()
-            dungeon = self.dm_session.find(DUNGEON, dungeon_id)
-            user = self.find_current_client_user()
-            dungeon.like(user)
-            return "Success!"
+            client = self.current_client_data
+            self.ensure_login(client)
+            async with self.locked((DUNGEON, dungeon_id)):
+                dungeon = await self.find(DUNGEON, dungeon_id)
+                user = await self.find_current_client_user(client)
+                await self.like(dungeon, user)
+                return "Success!"
         
-        @self.request_handler.request(name="unlike_dungeon", allow_python_syntax=True, auto_convert=True)
-        def unlike_dungeon(dungeon_id : DungeonId) -> str:
+        @self.register(name="unlike_dungeon")
+        async def unlike_dungeon(dungeon_id : DungeonId) -> str:
             dungeon : Dungeon
             user : User
-            self.ensure_login()
-            dungeon = self.dm_session.find(DUNGEON, dungeon_id)
-            user = self.find_current_client_user()
-            dungeon.unlike(user)
-            return "Success!"
+            client = self.current_client_data
+            self.ensure_login(client)
+            async with self.locked((DUNGEON, dungeon_id)):
+                dungeon = await self.find(DUNGEON, dungeon_id)
+                user = await self.find_current_client_user(client)
+                await self.unlike(dungeon, user)
+                return "Success!"
         
-        @self.request_handler.request(name="load_tab", allow_python_syntax=True, auto_convert=True)
-        def load_tab(tab : str) -> json.dumps:
-            data = []
-            if tab == "popular":
-                data = self.dm_session.get_popular_tab()
-            elif tab == "random":
-                data = self.dm_session.get_default_tab()
-            elif tab == "new":
-                data = self.dm_session.get_newest_tab()
-            data = [dungeon.to_object() for dungeon in data]
-            return data
+        @self.register(name="load_tab")
+        async def load_tab(tab : str) -> json.dumps:
+            data, _ = await self.find_tab(tab)
+            return [dungeon.to_object() for dungeon in data]
         
+        @self.register(name="load_tab_page")
+        async def load_tab_page(tab : str, after : str = None) -> json.dumps:
+            try:
+                data, next_page = await self.find_tab(tab, after=after)
+            except ValueError:
+                raise ErrorMessage("Invalid page.")
+            return {"success": True, "result": [dungeon.to_object() for dungeon in data], "next": next_page, "reason": "success"}
+        
+        instrument_requests(self.request_handler, self.metrics)
+        
+    def run(self, *, thread : bool = True, duration : Union[float, int, None] = None, cascade_stop : bool = True):
+        """
+        Run the program.
+        """
+        self.register_requests()
+        if self.local_tier is not None:
+            self.local_tier.start()
+        self.dm_session.start()
+        self.prefetcher.start()
+        self.comment_index.start()
         return self.request_handler.start(thread=thread, duration=duration, cascade_stop=cascade_stop)
         
     def stop(self, cascade_stop : bool = True):
         """
-        Stop the dungeon maker backend.
+        Stop the dungeon maker backend and flush all pending writes.
         """
         self.request_handler.stop(cascade_stop=cascade_stop)
+        self.comment_index.stop()
+        self.passwords.close()
+        self.prefetcher.stop()
+        self.dm_session.close()
+        if self.local_tier is not None:
+            self.local_tier.close()
         
     @property
-    def current_client_data(self) -> dict:
+    def current_client_data(self) -> ClientRecord:
         """
-        Client data of the current user
+        Client record of the current user. Save it in the client store after changing it.
         """
-        if not self.request_handler.current_client.client_id in self.clients:
-            self.clients[self.request_handler.current_client.client_id] = {}
-        return self.clients[self.request_handler.current_client.client_id]
-    
-    @current_client_data.setter
-    def set_current_client_data(self, data : dict):
-        self.clients[self.request_handler.current_client.client_id] = data
+        return self.clients.get(self.request_handler.current_client.client_id)
         
-    def ensure_login(self) -> None:
+    def ensure_login(self, client : ClientRecord) -> None:
         """
         Ensure the user is logged in.
         """
-        if not self.current_client_data.get("logged_in", False):
+        if not client.logged_in:
             raise ErrorMessage("You are not logged in")
         
     
-    def find_current_client_user(self) -> User:
+    async def write_room(self, client : ClientRecord, room_id : RoomId, bound_dungeon : DungeonId, update : Callable[[Union[str, None]], str]) -> Room:
+        """
+        Set the content of a room to what update returns for its current content, creating the room if needed.
+        """
+        room : Room
+        dungeon : Dungeon
+        self.ensure_login(client)
+        async with self.locked((DUNGEON, bound_dungeon), (ROOM, room_id), (USER, client.user_id)):
+            try:
+                room = await self.find(ROOM, room_id)
+            except KeyError:
+                try:
+                    dungeon = await self.find(DUNGEON, bound_dungeon)
+                except KeyError:
+                    raise ErrorMessage("Dungeon does not exist.")
+                if not dungeon.get_user(user_id=client.user_id).permissions.can_edit_room(room_id=room_id):
+                    raise ErrorMessage("Not authorized")
+                content = self.checked_content(update(None))
+                room = dungeon.new_room(room_id=room_id)
+                user = await self.find_current_client_user(client)
+                user.remaining_rooms -= 1
+                await self.write(user)
+            else:
+                if not room.dungeon_id == bound_dungeon:
+                    raise ErrorMessage("Wrong dungeon bound.")
+                try:
+                    dungeon = await self.find(DUNGEON, bound_dungeon)
+                except KeyError:
+                    raise ErrorMessage("Dungeon does not exist.")
+                if not dungeon.get_user(user_id=client.user_id).permissions.can_edit_room(room_id=room_id):
+                    raise ErrorMessage("Not authorized")
+                content = self.checked_content(update(room.content))
+            room.content = content
+            dungeon.log_update()
+            await self.write(room, dungeon)
+            return room
+    
+    def checked_content(self, content : str) -> str:
+        """
+        Validate and normalize room content a client wants to store.
+        """
+        try:
+            return self.room_validator.sanitize(content)
+        except ValueError as e:
+            raise ErrorMessage(str(e))
+    
+    async def find_tab(self, tab : str, *, after : str = None) -> tuple[list[Dungeon], Union[str, None]]:
+        """
+        Find a page of a tab and the token of the page after it. Raises ValueError if after is not a valid token.
+        """
+        if tab == "popular":
+            data = self.dm_session.get_popular_tab(after=after)
+            return data, self.dm_session.next_tab_cursor(POPULAR_TAB, data)
+        if tab == "random":
+            return self.dm_session.get_default_tab(), None
+        if tab == "new":
+            data = self.dm_session.get_newest_tab(after=after)
+            return data, self.dm_session.next_tab_cursor(NEWEST_TAB, data)
+        return [], None
+    
+    def find_upload(self, client : ClientRecord, upload_id : str) -> Upload:
+        """
+        Find an unfinished upload of the current user.
+        """
+        self.ensure_login(client)
+        try:
+            return self.uploads.get(upload_id, user_id=client.user_id)
+        except KeyError:
+            raise ErrorMessage("Upload not found. Start it again.")
+    
+    async def find_current_client_user(self, client : ClientRecord) -> User:
         """
         Find the User Account associated with the current user.
         """
-        self.ensure_login()
-        return self.dm_session.find(USER, self.current_client_data["user_id"])
+        self.ensure_login(client)
+        return await self.find(USER, client.user_id)
+    
+    def register(self, *, name : str) -> Callable[[Callable[..., Coroutine]], None]:
+        """
+        Decorator registering a request handler written as a coroutine function. It is run to completion when called, since everything it awaits here returns right away.
+        """
+        def decorator(function : Callable[..., Coroutine]):
+            @functools.wraps(function)
+            def handler(*args, **kwargs):
+                return run_to_completion(function(*args, **kwargs))
+            self.request_handler.request(handler, name=name, allow_python_syntax=True, auto_convert=True)
+        return decorator
+    
+    @asynccontextmanager
+    async def locked(self, *objects : tuple[str, Union[DungeonId, RoomId, UserId, str]]) -> AsyncIterator[None]:
+        """
+        Lock objects of the session for the duration of a request.
+        """
+        with self.dm_session.locked(*objects):
+            yield
+    
+    async def find(self, __type : str, __id : Union[DungeonId, RoomId, UserId] = None, *, name : str = None) -> Union[Dungeon, Room, User]:
+        """
+        Find a dungeon, room or user. Raises KeyError if it doesn't exist.
+        """
+        return self.dm_session.find(__type, __id, name=name)
+    
+    async def find_rooms(self, room_ids : Sequence[RoomId]) -> list[Room]:
+        """
+        Find several rooms at once, leaving out those that don't exist.
+        """
+        return self.dm_session.find_rooms(room_ids)
+    
+    async def write(self, *objects : Union[Dungeon, Room, User]):
+        """
+        Write dungeons, rooms or users.
+        """
+        for __object in objects:
+            __object.write()
+    
+    async def like(self, dungeon : Dungeon, user : User) -> bool:
+        """
+        Register a like. Returns whether the like was new.
+        """
+        return dungeon.like(user)
+    
+    async def unlike(self, dungeon : Dungeon, user : User) -> bool:
+        """
+        Register an unlike. Returns whether there was a like to remove.
+        """
+        return dungeon.unlike(user)
+    
+    async def verify_password(self, *, user_id : UserId, username : str, password : str, passdata : str) -> bool:
+        """
+        Check a password against the stored passdata.
+        """
+        return self.passwords.verify(user_id=user_id, username=username, password=password, passdata=passdata)
+    
+    async def hash_password(self, password : str) -> str:
+        """
+        Hash a new password.
+        """
+        return self.passwords.hash(password)
+    
+    async def find_comment(self, *, content : str = None, user : str = None) -> bool:
+        """
+        Find a comment on the project.
+        """
+        return self.comment_index.find(content=content, user=user)
+    
+    async def user_has_linked(self, linked_user : str) -> Union[None, User]:
+        """
+        Find out if a user has linked an account to his name.
+        """
+        return user_has_linked(session=self.dm_session, user=linked_user)
 
 
 
-def gen_passdata(*, username : str, password : str) -> bytes:
+def run_to_completion(coroutine : Coroutine[Any, Any, T]) -> T:
     """
-    Generate passdata for an account
+    Run a coroutine that never suspends without an event loop. Raises RuntimeError if it tries to wait for something.
     """
-    passdata = sha3_256(pickle.dumps((username, password, "Dungeon Maker: Reinvented - Login System Salt"))).digest()
-    return passdata
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    coroutine.close()
+    raise RuntimeError("The request handler waited for something, which needs an event loop.")
 
 def find_comment(project : Project, *, content : str = None, user : str = None) -> bool:
     """
-    Find a comment.
+    Find a comment by scanning the newest comments. Use a CommentIndex to avoid fetching every time.
     """
     comments = project.comments()
     for comment in comments:
-        if user and comment["author"]["username"] != user:
+        _, author, text = comment_fields(comment)
+        if user and author != user:
             continue
-        if content and comment["content"] != content:
+        if content and text != content:
             continue
         return True
     return False
 
-def user_has_linked(*, session : DMSession, user : str) -> Union[None, dict]:
+def user_has_linked(*, session : DMSession, user : str) -> Union[None, User]:
     """
     Find out if a user has linked an account to his name.
     """
     try:
-        has_linked = session.database_abstraction.select_user(fields={"linked_user": user})
+        has_linked = session.find_linked_user(user)
     except KeyError:
         return None
     else:
         return has_linked
 
+def stored_room(room : Room) -> dict:
+    """
+    Get the reply to saving a room with a delta, encoded or in chunks. The content may have been normalized, so clients take its checksum as the base of their next delta.
+    """
+    return {"success": True, "content_crc": checksum(room.content or "")}
+
+def edited_content(current : Union[str, None], base_crc : int, edits : Sequence[Any]) -> str:
+    """
+    Apply the edits of a delta upload to the content they were made against. Edits are sent flat as start, end, replacement, start, ...
+    """
+    if current is None or checksum(current) != base_crc:
+        raise ErrorMessage("The room changed. Load it again.")
+    if len(edits) % 3:
+        raise ErrorMessage("Edits have to be given as start, end, replacement.")
+    try:
+        return apply_delta(current, [edits[i:i + 3] for i in range(0, len(edits), 3)])
+    except ValueError as e:
+        raise ErrorMessage(str(e))
+
 def include_data(data : dict, *, include : list[str] = ()) -> dict:
     """
     Remove all elements from a dict except those specified
@@ -0,0 +1,201 @@
+"""
+Submodule for storing the state of cloud clients.
+"""
+from __future__ import annotations
+import time, secrets
+from datetime import datetime, timezone
+from typing import Union
+from dataclasses import dataclass, field
+from pymongo.collection import Collection
+from .modules.dm.cache import IdentityMap
+from .modules.dm.dmtypes import UserId
+
+
+@dataclass(slots=True)
+class ClientRecord:
+    """
+    Class for the login state of a cloud client.
+    """
+    client_id : str = field(kw_only=True)
+    logged_in : bool = field(kw_only=True, default=False)
+    username : Union[str, None] = field(kw_only=True, default=None)
+    user_id : Union[UserId, None] = field(kw_only=True, default=None)
+    password_reset_code : Union[int, None] = field(kw_only=True, default=None)
+    password_reset_expires : float = field(kw_only=True, default=0)
+
+    def log_in(self, *, username : str, user_id : UserId):
+        """
+        Mark the client as logged in.
+        """
+        self.logged_in = True
+        self.username = username
+        self.user_id = user_id
+
+    def log_out(self):
+        """
+        Mark the client as logged out.
+        """
+        self.logged_in = False
+        self.username = None
+        self.user_id = None
+
+    def new_password_reset_code(self, *, ttl : float = 900) -> int:
+        """
+        Create a password reset code that expires after ttl seconds.
+        """
+        self.password_reset_code = secrets.randbits(24)
+        self.password_reset_expires = time.time() + ttl
+        return self.password_reset_code
+
+    def check_password_reset_code(self, code : int) -> bool:
+        """
+        Check a password reset code. Expired codes are dropped.
+        """
+        if self.password_reset_code is not None and self.password_reset_expires < time.time():
+            self.password_reset_code = None
+        return self.password_reset_code is not None and code == self.password_reset_code
+
+    def to_object(self) -> dict:
+        """
+        Convert to an object.
+        """
+        return {
+            "client_id": self.client_id,
+            "logged_in": self.logged_in,
+            "username": self.username,
+            "user_id": self.user_id,
+            "password_reset_code": self.password_reset_code,
+            "password_reset_expires": self.password_reset_expires,
+        }
+
+
+class BaseClientStore:
+    """
+    Base class for client stores.
+    """
+    def get(self, client_id : str) -> ClientRecord:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+
+    def save(self, record : ClientRecord):
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+
+    def discard(self, client_id : str):
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+
+    def prune(self) -> int:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+
+
+class MemoryClientStore(BaseClientStore):
+    """
+    Class for keeping client records in memory, dropping clients idle for longer than ttl and the least recently seen ones above capacity.
+    """
+    records : IdentityMap
+    prune_interval : float
+    _pruned_at : float
+
+    def __init__(self, *, ttl : Union[float, None] = 3600, capacity : Union[int, None] = 10000, prune_interval : float = 60):
+        self.records = IdentityMap(capacity=capacity, ttl=ttl)
+        self.prune_interval = prune_interval
+        self._pruned_at = time.monotonic()
+
+    def get(self, client_id : str) -> ClientRecord:
+        """
+        Get the record of a client, creating it if there is none.
+        """
+        if time.monotonic() - self._pruned_at > self.prune_interval:
+            self.prune()
+        record = self.records.get(client_id)
+        if record is None:
+            record = ClientRecord(client_id=client_id)
+        self.records.put(client_id, record)
+        return record
+
+    def save(self, record : ClientRecord):
+        """
+        Store a record.
+        """
+        self.records.put(record.client_id, record)
+
+    def discard(self, client_id : str):
+        """
+        Forget a client.
+        """
+        self.records.pop(client_id)
+
+    def prune(self) -> int:
+        """
+        Forget all idle clients. Returns the amount removed.
+        """
+        self._pruned_at = time.monotonic()
+        return self.records.prune()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+class MongoDBClientStore(BaseClientStore):
+    """
+    Class for sharing client records between backend processes through a MongoDB collection.
+    Idle records are removed by a TTL index on last_seen.
+    """
+    collection : Collection
+    ttl : int
+
+    def __init__(self, *, collection : Collection, ttl : int = 3600):
+        self.collection = collection
+        self.ttl = ttl
+
+    def ensure_indexes(self):
+        """
+        Create the indexes used for lookups and expiry.
+        """
+        self.collection.create_index([("client_id", 1)], unique=True)
+        self.collection.create_index([("last_seen", 1)], expireAfterSeconds=self.ttl)
+
+    def get(self, client_id : str) -> ClientRecord:
+        """
+        Get the record of a client and mark it as seen, creating it if there is none.
+        """
+        data = self.collection.find_one_and_update(
+            {"client_id": client_id},
+            {"$set": {"last_seen": datetime.now(timezone.utc)}},
+            projection={"_id": 0, "last_seen": 0}
+        )
+        if data is None:
+            return ClientRecord(client_id=client_id)
+        return ClientRecord(**data)
+
+    def save(self, record : ClientRecord):
+        """
+        Store a record.
+        """
+        self.collection.update_one(
+            {"client_id": record.client_id},
+            {"$set": {**record.to_object(), "last_seen": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def discard(self, client_id : str):
+        """
+        Forget a client.
+        """
+        self.collection.delete_one({"client_id": client_id})
+
+    def prune(self) -> int:
+        """
+        Idle records are removed by MongoDB.
+        """
+        return 0
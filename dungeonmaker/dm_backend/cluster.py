@@ -0,0 +1,203 @@
+"""
+Submodule for running the backend on several worker processes.
+"""
+from __future__ import annotations
+import os, zlib, threading, warnings, traceback, multiprocessing
+from dataclasses import dataclass, field
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Union
+from scratchcommunication.cloud_socket import AnyCloudSocket, BaseCloudSocketConnection, CloudSocket
+from scratchcommunication.cloud import CloudConnection
+from scratchcommunication.cloudrequests import RequestHandler
+from scratchattach import get_project, Project
+from .modules.database import MongoDBAtlasSession
+from .modules.dm.cache import IdentityMap
+from .backend import DMBackend
+from .passwords import PasswordHasher
+from .dispatch import DMRequestHandler
+from .comments import CommentRelay, RelayedCommentIndex
+
+
+@dataclass(slots=True)
+class RemoteClient:
+    """
+    Class standing in for a client connected to the front process while a worker handles its request.
+    """
+    client_id : str = field(kw_only=True)
+
+    def emit(self, event : str, **kwargs):
+        """
+        Events of remote clients are not forwarded to the front process.
+        """
+
+
+def worker_index(client_id : str, workers : int) -> int:
+    """
+    Get the worker handling a client. All requests of a client go to the same worker, so its login state and request order stay on one process.
+    """
+    return zlib.crc32(client_id.encode()) % workers
+
+
+class ForwardingRequestHandler(RequestHandler):
+    """
+    Class for request handlers forwarding raw requests to worker processes and sending their responses back to the clients.
+    """
+    inboxes : list[Any]
+    outbox : Any
+    senders : IdentityMap
+    delivery_thread : Union[threading.Thread, None]
+
+    def __init__(self, *, cloud_socket : AnyCloudSocket, inboxes : list[Any], outbox : Any, uses_thread : bool = False, client_capacity : Union[int, None] = 10000, client_ttl : Union[float, None] = 3600):
+        self.inboxes = inboxes
+        self.outbox = outbox
+        self.senders = IdentityMap(capacity=client_capacity, ttl=client_ttl)
+        self.delivery_thread = None
+        super().__init__(cloud_socket=cloud_socket, uses_thread=uses_thread)
+
+    def start(self, *, thread : Union[bool, None] = None, daemon_thread : bool = False, duration : Union[float, int, None] = None, cascade_stop : bool = True):
+        """
+        Method for starting the request handler and the delivery of responses.
+        """
+        if self.delivery_thread is None or not self.delivery_thread.is_alive():
+            self.delivery_thread = threading.Thread(target=self._deliver_loop, name="ForwardingRequestHandler", daemon=True)
+            self.delivery_thread.start()
+        return super().start(thread=thread, daemon_thread=daemon_thread, duration=duration, cascade_stop=cascade_stop)
+
+    def process_request(self, msg : str, client : BaseCloudSocketConnection, username : str, send_response : Callable[[str], None]) -> None:
+        """
+        Forward a request to the worker of its client.
+        """
+        self.senders.put(client.client_id, send_response)
+        self.inboxes[worker_index(client.client_id, len(self.inboxes))].put((msg, client.client_id, username))
+        return None
+
+    def close(self):
+        """
+        Stop delivering responses. Call this after the workers have stopped.
+        """
+        if self.delivery_thread is not None:
+            self.outbox.put(None)
+            self.delivery_thread.join(5)
+        self.delivery_thread = None
+
+    def _deliver_loop(self):
+        while (item := self.outbox.get()) is not None:
+            client_id, response = item
+            send_response = self.senders.get(client_id)
+            if send_response is None:
+                continue
+            try:
+                send_response(response)
+            except Exception:
+                warnings.warn(f"Could not send a response to client {client_id}: \n{traceback.format_exc()}", RuntimeWarning)
+
+
+def run_worker(backend_factory : Callable[[], DMBackend], inbox : Any, outbox : Any, comments : Union[tuple[Any, Any, int], None] = None):
+    """
+    Entry point of worker processes. Builds a backend and handles forwarded requests until it receives None.
+    comments is (requests, relayed, worker) of the CommentRelay of the front, which then polls the comments instead of every worker.
+    """
+    backend = backend_factory()
+    if comments is not None:
+        requests, relayed, worker = comments
+        backend.comment_index = RelayedCommentIndex(requests=requests, relayed=relayed, worker=worker, metrics=backend.metrics)
+    backend.register_requests()
+    if backend.local_tier is not None:
+        backend.local_tier.start()
+    backend.dm_session.start()
+    backend.prefetcher.start()
+    backend.comment_index.start()
+    try:
+        while (item := inbox.get()) is not None:
+            msg, client_id, username = item
+            send_response = lambda response, client_id=client_id: outbox.put((client_id, response))
+            try:
+                response = backend.request_handler.process_request(msg, RemoteClient(client_id=client_id), username, send_response)
+                if response:
+                    send_response(response)
+            except Exception:
+                warnings.warn(f"There was an uncaught error in a backend worker: \n{traceback.format_exc()}", RuntimeWarning)
+    finally:
+        backend.comment_index.stop()
+        backend.passwords.close()
+        backend.prefetcher.stop()
+        backend.dm_session.close()
+        if backend.local_tier is not None:
+            backend.local_tier.close()
+
+
+def mongo_worker_backend(*, uri : str, project_id : int, write_behind : bool = False, cache_ttl : Union[float, None] = 5) -> DMBackend:
+    """
+    Build the backend of a worker process with its own MongoDB connection.
+    Use it with functools.partial as the backend factory of a DMBackendCluster.
+    The cache TTL is short because other workers change the same documents. Passwords are hashed in the worker itself, as the workers already use all cores.
+    """
+    return DMBackend(
+        db_session=MongoDBAtlasSession(URI=uri),
+        cloud=None,
+        project_id=project_id,
+        write_behind=write_behind,
+        request_handler=DMRequestHandler(cloud_socket=None),
+        cache_ttl=cache_ttl,
+        password_hasher=PasswordHasher(processes=0)
+    )
+
+
+class DMBackendCluster:
+    """
+    Class for running the backend as one cloud-facing front process and several worker processes.
+    The front only reads requests from the cloud and sends responses, the workers parse and handle them.
+    The front also polls the comments of the project and relays them to the workers, so they are fetched once instead of once per worker.
+    """
+    cloud : CloudConnection
+    inboxes : list[Any]
+    outbox : Any
+    processes : list[BaseProcess]
+    request_handler : ForwardingRequestHandler
+    comments : CommentRelay
+    join_timeout : float
+
+    def __init__(self, *, cloud : CloudConnection, backend_factory : Callable[[], DMBackend], project_id : int, project : Union[Project, None] = None, workers : Union[int, None] = None, security : Union[tuple, None] = None, start_method : str = "spawn", join_timeout : float = 10):
+        """
+        backend_factory is called in every worker process, so it has to be picklable, for example a partial of mongo_worker_backend.
+        """
+        context = multiprocessing.get_context(start_method)
+        self.cloud = cloud
+        self.inboxes = [context.Queue() for _ in range(workers or os.cpu_count() or 1)]
+        self.outbox = context.Queue()
+        comment_requests = context.Queue()
+        relayed = [context.Queue() for _ in self.inboxes]
+        self.comments = CommentRelay(project=project or get_project(project_id), queues=relayed, requests=comment_requests)
+        self.processes = [
+            context.Process(target=run_worker, args=(backend_factory, inbox, self.outbox, (comment_requests, relayed[i], i)), name=f"DMBackendWorker-{i}")
+            for i, inbox in enumerate(self.inboxes)
+        ]
+        self.request_handler = ForwardingRequestHandler(cloud_socket=CloudSocket(cloud=cloud, security=security), inboxes=self.inboxes, outbox=self.outbox)
+        self.join_timeout = join_timeout
+
+    def run(self, *, thread : bool = True, duration : Union[float, int, None] = None, cascade_stop : bool = True):
+        """
+        Start the workers and run the front.
+        """
+        self.comments.start()
+        for process in self.processes:
+            if process.pid is None:
+                process.start()
+        return self.request_handler.start(thread=thread, duration=duration, cascade_stop=cascade_stop)
+
+    def stop(self, cascade_stop : bool = True):
+        """
+        Stop the front, let the workers finish their queued requests and flush their writes, then stop them.
+        """
+        self.request_handler.stop(cascade_stop=cascade_stop)
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            if process.pid is None:
+                continue
+            process.join(self.join_timeout)
+            if process.is_alive():
+                warnings.warn(f"{process.name} did not stop in time and is terminated.", RuntimeWarning)
+                process.terminate()
+        self.comments.stop()
+        self.request_handler.close()
@@ -0,0 +1,285 @@
+"""
+Submodule for the comment index used to verify accounts and names.
+"""
+from __future__ import annotations
+import time, queue, threading, warnings, traceback
+from typing import Any, Union
+from scratchattach import Project
+from .modules.dm.metrics import MetricsRegistry, record_scratch_call
+
+CommentKey = tuple[Union[str, None], Union[str, None]]
+
+
+def comment_fields(comment : Any) -> tuple[int, str, str]:
+    """
+    Get the id, author and content of a comment, which can be an API dict or a scratchattach comment.
+    """
+    if isinstance(comment, dict):
+        return int(comment["id"]), comment["author"]["username"], comment["content"]
+    return int(comment.id), comment.author_name, comment.content
+
+
+class CommentIndex:
+    """
+    Class for indexing the comments of a project by author and content.
+    Only comments newer than the newest one already seen are fetched.
+    """
+    project : Project
+    ttl : float
+    page_size : int
+    max_pages : int
+    poll_interval : float
+    min_refresh_interval : float
+    fetches : int
+    metrics : Union[MetricsRegistry, None]
+    _entries : dict[CommentKey, float]
+    _last_seen_id : Union[int, None]
+    _refreshed_at : float
+    _lock : threading.Lock
+    _refresh_lock : threading.Lock
+    _poller : Union[threading.Thread, None]
+    _stop : threading.Event
+
+    def __init__(self, *, project : Project, ttl : float = 3600, page_size : int = 40, max_pages : int = 5, poll_interval : float = 10, min_refresh_interval : float = 2, metrics : Union[MetricsRegistry, None] = None):
+        self.project = project
+        self.ttl = ttl
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.poll_interval = poll_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.fetches = 0
+        self.metrics = metrics
+        self._entries = {}
+        self._last_seen_id = None
+        self._refreshed_at = float("-inf")
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._poller = None
+        self._stop = threading.Event()
+
+    def find(self, *, content : str = None, user : str = None) -> bool:
+        """
+        Find a comment, fetching the newest comments once if it isn't indexed yet.
+        """
+        start = time.perf_counter()
+        if self.lookup(content=content, user=user):
+            self._record_find("indexed", start)
+            return True
+        refreshed_at = self._refreshed_at
+        with self._refresh_lock:
+            if self._refreshed_at == refreshed_at and time.monotonic() - refreshed_at >= self.min_refresh_interval:
+                self._refresh()
+        found = self.lookup(content=content, user=user)
+        self._record_find("fetched" if found else "missing", start)
+        return found
+
+    def lookup(self, *, content : str = None, user : str = None) -> bool:
+        """
+        Find a comment in the index without fetching.
+        """
+        key = (user or None, content or None)
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._entries[key]
+                return False
+            return True
+
+    def refresh(self) -> int:
+        """
+        Fetch and index the comments posted since the last refresh. Returns the amount of new comments.
+        """
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self) -> int:
+        comments = []
+        newest_id = self._last_seen_id
+        for page in range(self.max_pages):
+            start = time.perf_counter()
+            fetched = self.project.comments(limit=self.page_size, offset=page * self.page_size)
+            self.fetches += 1
+            if self.metrics is not None:
+                record_scratch_call(self.metrics, "comments", time.perf_counter() - start)
+            done = len(fetched) < self.page_size
+            for comment in fetched:
+                comment_id, author, content = comment_fields(comment)
+                if self._last_seen_id is not None and comment_id <= self._last_seen_id:
+                    done = True
+                    continue
+                comments.append((author, content))
+                if newest_id is None or comment_id > newest_id:
+                    newest_id = comment_id
+            if done or self._last_seen_id is None:
+                break
+        self.index(comments)
+        self._last_seen_id = newest_id
+        self._refreshed_at = time.monotonic()
+        return len(comments)
+
+    def index(self, comments : list[tuple[str, str]]):
+        """
+        Add comments given as (author, content) to the index.
+        """
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for author, content in comments:
+                self._entries[(author, content)] = expires
+                self._entries[(None, content)] = expires
+                self._entries[(author, None)] = expires
+
+    def prune(self) -> int:
+        """
+        Remove expired comments from the index. Returns the amount removed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, expires in self._entries.items() if expires < now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def start(self):
+        """
+        Start polling for new comments in a background thread.
+        """
+        if self._poller is not None and self._poller.is_alive():
+            return
+        self._stop.clear()
+        self._poller = threading.Thread(target=self._poll_loop, name="CommentIndex", daemon=True)
+        self._poller.start()
+
+    def stop(self):
+        """
+        Stop polling for new comments.
+        """
+        self._stop.set()
+        if self._poller is not None:
+            self._poller.join(5)
+        self._poller = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _record_find(self, result : str, start : float):
+        if self.metrics is not None:
+            self.metrics.histogram("dm_comment_find_seconds", help="Duration of comment lookups.").observe(time.perf_counter() - start, result=result)
+
+    def _poll_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+                self.prune()
+            except Exception:
+                warnings.warn(f"Couldn't fetch new comments: \n{traceback.format_exc()}", RuntimeWarning)
+            self._stop.wait(self.poll_interval)
+
+
+class CommentRelay(CommentIndex):
+    """
+    Class for a comment index polling the comments of a project for several worker processes, so only one process fetches them.
+    New comments are put on the queue of every worker. Workers missing a comment put (worker, number) on the requests queue,
+    which fetches the newest comments if they weren't fetched within min_refresh_interval and then puts number on the queue of that worker.
+    """
+    queues : list[Any]
+    requests : Any
+    _server : Union[threading.Thread, None]
+
+    def __init__(self, *, project : Project, queues : list[Any], requests : Any, **kwargs):
+        super().__init__(project=project, **kwargs)
+        self.queues = queues
+        self.requests = requests
+        self._server = None
+
+    def index(self, comments : list[tuple[str, str]]):
+        """
+        Add comments given as (author, content) to the index and relay them to the workers.
+        """
+        super().index(comments)
+        if comments:
+            for relayed in self.queues:
+                relayed.put(comments)
+
+    def start(self):
+        """
+        Start polling for new comments and answering the requests of workers in background threads.
+        """
+        super().start()
+        if self._server is not None and self._server.is_alive():
+            return
+        self._server = threading.Thread(target=self._serve_loop, name="CommentRelay", daemon=True)
+        self._server.start()
+
+    def stop(self):
+        """
+        Stop polling and answering requests.
+        """
+        super().stop()
+        if self._server is not None:
+            self.requests.put(None)
+            self._server.join(5)
+        self._server = None
+
+    def _serve_loop(self):
+        while (request := self.requests.get()) is not None:
+            worker, number = request
+            try:
+                with self._refresh_lock:
+                    if time.monotonic() - self._refreshed_at >= self.min_refresh_interval:
+                        self._refresh()
+            except Exception:
+                warnings.warn(f"Couldn't fetch new comments: \n{traceback.format_exc()}", RuntimeWarning)
+            self.queues[worker].put(number)
+
+
+class RelayedCommentIndex(CommentIndex):
+    """
+    Class for the comment index of a worker process, which gets the comments from a CommentRelay instead of fetching them.
+    """
+    requests : Any
+    relayed : Any
+    worker : int
+    timeout : float
+    _requested : int
+
+    def __init__(self, *, requests : Any, relayed : Any, worker : int, timeout : float = 10, ttl : float = 3600, poll_interval : float = 1, metrics : Union[MetricsRegistry, None] = None):
+        super().__init__(project=None, ttl=ttl, poll_interval=poll_interval, min_refresh_interval=0, metrics=metrics)
+        self.requests = requests
+        self.relayed = relayed
+        self.worker = worker
+        self.timeout = timeout
+        self._requested = 0
+
+    def refresh(self) -> int:
+        """
+        Index the comments relayed since the last refresh without asking for new ones. Returns the amount of new comments.
+        """
+        with self._refresh_lock:
+            return self._receive()
+
+    def _refresh(self) -> int:
+        self._requested += 1
+        self.requests.put((self.worker, self._requested))
+        return self._receive(until=self._requested)
+
+    def _receive(self, until : int = None) -> int:
+        """
+        Index relayed comments until the answer to request until arrives, or until none are left if it is None.
+        """
+        received = 0
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                item = self.relayed.get_nowait() if until is None else self.relayed.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if isinstance(item, int):
+                if item == until:
+                    break
+                continue
+            self.index(item)
+            received += len(item)
+        self._refreshed_at = time.monotonic()
+        return received
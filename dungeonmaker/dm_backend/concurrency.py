@@ -0,0 +1,242 @@
+"""
+Submodule for handling requests concurrently.
+"""
+from __future__ import annotations
+import asyncio, inspect, threading, warnings, traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Callable, Mapping, Sequence, Union
+from scratchcommunication.cloud_socket import AnyCloudSocket, BaseCloudSocketConnection
+from scratchcommunication.cloudrequests import RequestHandler, ErrorMessage
+from .dispatch import DMRequestHandler
+
+
+class PooledRequestHandler(DMRequestHandler):
+    """
+    Class for request handlers running requests on a pool of worker threads.
+    Requests of the same client are still handled one after another and in order.
+    """
+    workers : int
+    executor : Union[ThreadPoolExecutor, None]
+    _local : threading.local
+    _queues : dict[str, deque[Callable[[], None]]]
+    _queues_lock : threading.Lock
+
+    def __init__(self, *, cloud_socket : AnyCloudSocket, uses_thread : bool = False, workers : int = 8):
+        self.workers = workers
+        self.executor = None
+        self._local = threading.local()
+        self._queues = {}
+        self._queues_lock = threading.Lock()
+        super().__init__(cloud_socket=cloud_socket, uses_thread=uses_thread)
+
+    @property
+    def current_client(self) -> Union[BaseCloudSocketConnection, None]:
+        """
+        Client of the request handled by the current thread.
+        """
+        return getattr(self._local, "client", None)
+
+    @current_client.setter
+    def current_client(self, client : Union[BaseCloudSocketConnection, None]):
+        self._local.client = client
+
+    @property
+    def current_client_username(self) -> Union[str, None]:
+        """
+        Username of the client of the request handled by the current thread.
+        """
+        return getattr(self._local, "username", None)
+
+    @current_client_username.setter
+    def current_client_username(self, username : Union[str, None]):
+        self._local.username = username
+
+    def start(self, *, thread : Union[bool, None] = None, daemon_thread : bool = False, duration : Union[float, int, None] = None, cascade_stop : bool = True):
+        """
+        Method for starting the request handler and its workers.
+        """
+        self.start_workers()
+        return super().start(thread=thread, daemon_thread=daemon_thread, duration=duration, cascade_stop=cascade_stop)
+
+    def start_workers(self):
+        """
+        Start the workers without listening to the cloud socket, for feeding requests to process_request directly.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="PooledRequestHandler")
+
+    def process_request(self, msg : str, client : BaseCloudSocketConnection, username : str, send_response : Callable[[str], None]) -> None:
+        """
+        Queue a request to be processed by a worker.
+        """
+        def task():
+            response = RequestHandler.process_request(self, msg, client, username, send_response)
+            if response:
+                send_response(response)
+        if self.executor is None:
+            task()
+            return None
+        with self._queues_lock:
+            queue = self._queues.get(client.client_id)
+            if queue is not None:
+                queue.append(task)
+                return None
+            self._queues[client.client_id] = deque([task])
+        self.executor.submit(self._drain, client.client_id)
+        return None
+
+    def stop(self, cascade_stop : bool = True):
+        """
+        Stop the request handler and wait for running requests to finish.
+        """
+        super().stop(cascade_stop=cascade_stop)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        self.executor = None
+
+    def _drain(self, client_id : str):
+        """
+        Run the queued requests of a client until there are none left.
+        """
+        while True:
+            with self._queues_lock:
+                queue = self._queues[client_id]
+                if not queue:
+                    del self._queues[client_id]
+                    return
+                task = queue[0]
+            try:
+                task()
+            except Exception:
+                warnings.warn(f"There was an uncaught error in a request worker: \n{traceback.format_exc()}", RuntimeWarning)
+            finally:
+                with self._queues_lock:
+                    queue.popleft()
+
+
+class AsyncRequestHandler(DMRequestHandler):
+    """
+    Class for request handlers running coroutine handlers on an event loop, so many requests can wait on the database at once.
+    Requests of the same client are still handled one after another and in order. Plain functions are run like before.
+    """
+    loop : asyncio.AbstractEventLoop
+    _client : ContextVar[Union[BaseCloudSocketConnection, None]]
+    _username : ContextVar[Union[str, None]]
+    _tails : dict[str, Future]
+    _tails_lock : threading.Lock
+
+    def __init__(self, *, cloud_socket : AnyCloudSocket, loop : asyncio.AbstractEventLoop, uses_thread : bool = False):
+        self.loop = loop
+        self._client = ContextVar("current_client", default=None)
+        self._username = ContextVar("current_client_username", default=None)
+        self._tails = {}
+        self._tails_lock = threading.Lock()
+        super().__init__(cloud_socket=cloud_socket, uses_thread=uses_thread)
+
+    @property
+    def current_client(self) -> Union[BaseCloudSocketConnection, None]:
+        """
+        Client of the request handled by the current task or thread.
+        """
+        return self._client.get()
+
+    @current_client.setter
+    def current_client(self, client : Union[BaseCloudSocketConnection, None]):
+        self._client.set(client)
+
+    @property
+    def current_client_username(self) -> Union[str, None]:
+        """
+        Username of the client of the request handled by the current task or thread.
+        """
+        return self._username.get()
+
+    @current_client_username.setter
+    def current_client_username(self, username : Union[str, None]):
+        self._username.set(username)
+
+    def execute_request(
+        self,
+        name,
+        *,
+        args : Sequence[Any],
+        kwargs : Mapping[str, Any],
+        client : BaseCloudSocketConnection,
+        response : bool = True,
+        return_converter : Callable,
+        request_handling_function : Callable,
+        retried : bool = False,
+        respond : Callable,
+        send_response : Callable[[str], None]
+    ) -> None:
+        """
+        Execute a request handler, scheduling it on the event loop if it is a coroutine function.
+        """
+        if not inspect.iscoroutinefunction(request_handling_function.function):
+            return super().execute_request(
+                name,
+                args=args,
+                kwargs=kwargs,
+                client=client,
+                response=response,
+                return_converter=return_converter,
+                request_handling_function=request_handling_function,
+                retried=retried,
+                respond=respond,
+                send_response=send_response
+            )
+        with self._tails_lock:
+            previous = self._tails.get(client.client_id)
+            future = asyncio.run_coroutine_threadsafe(self._execute(
+                name,
+                args=args,
+                kwargs=kwargs,
+                client=client,
+                username=self.current_client_username,
+                response=response,
+                return_converter=return_converter,
+                request_handling_function=request_handling_function,
+                send_response=send_response,
+                previous=previous
+            ), self.loop)
+            self._tails[client.client_id] = future
+        future.add_done_callback(lambda _: self._release(client.client_id, future))
+
+    async def _execute(
+        self,
+        name,
+        *,
+        args : Sequence[Any],
+        kwargs : Mapping[str, Any],
+        client : BaseCloudSocketConnection,
+        username : Union[str, None],
+        response : bool,
+        return_converter : Callable,
+        request_handling_function : Callable,
+        send_response : Callable[[str], None],
+        previous : Union[Future, None]
+    ):
+        if previous is not None:
+            await asyncio.wait([asyncio.wrap_future(previous)])
+        self.current_client = client
+        self.current_client_username = username
+        try:
+            response_text = str(return_converter(await request_handling_function(*args, **kwargs)))
+        except ErrorMessage as e:
+            response_text = " ".join(e.args)
+        except Exception as e:
+            response_text = "Something went wrong."
+            try:
+                client.emit("error_in_request", request=name, args=args, kwargs=kwargs, client=client, error=e)
+            except Exception:
+                pass
+            warnings.warn(f"Error in request \"{name}\" with args: {args} and kwargs: {kwargs}: \n{traceback.format_exc()}", RuntimeWarning)
+        if response:
+            send_response(response_text)
+
+    def _release(self, client_id : str, future : Future):
+        with self._tails_lock:
+            if self._tails.get(client_id) is future:
+                del self._tails[client_id]
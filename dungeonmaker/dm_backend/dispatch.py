@@ -0,0 +1,41 @@
+"""
+Submodule for the request handler used by the backend.
+"""
+from __future__ import annotations
+import inspect
+from typing import Any, Callable, Mapping, Sequence
+from func_timeout import StoppableThread
+from scratchcommunication.cloud_socket import BaseCloudSocketConnection
+from scratchcommunication.cloudrequests import RequestHandler
+from scratchcommunication.cloudrequests.requests import type_casting
+
+
+class DMRequestHandler(RequestHandler):
+    """
+    Class for request handlers converting arguments and responses with the signature of the request function.
+    RequestHandler reads the signature of its own wrapper instead, whose return annotation is not callable, so every dispatched request failed.
+    """
+    def dispatch_request(self, name, *, args : Sequence[Any], kwargs : Mapping[str, Any], client : BaseCloudSocketConnection, response : bool = True, send_response : Callable[[str], None]) -> None:
+        """
+        Dispatch a request.
+        """
+        request_handling_function = self.requests[name]
+        args, kwargs, return_converter = type_casting(func=request_handling_function.function, signature=inspect.signature(request_handling_function.function), args=args, kwargs=kwargs)
+        def respond(retried = False):
+            return self.execute_request(
+                name=name,
+                args=args,
+                kwargs=kwargs,
+                client=client,
+                response=response,
+                return_converter=return_converter,
+                request_handling_function=request_handling_function,
+                retried=retried,
+                respond=respond,
+                send_response=send_response
+            )
+        if request_handling_function.thread:
+            thread = StoppableThread(target=respond)
+            thread.start()
+            return
+        respond()
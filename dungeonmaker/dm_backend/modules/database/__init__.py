@@ -3,4 +3,7 @@ Module for connecting to a database.
 """
 from .connection import *
 from .dba import *
+from .async_dba import *
+from .memory import *
+from .tiered import *
 from ..dm import dba
\ No newline at end of file
@@ -0,0 +1,245 @@
+"""
+Submodule for Database Abstractions using the asyncio MongoDB driver.
+"""
+from __future__ import annotations
+from typing import Literal, Any, Union
+from dataclasses import dataclass, field
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from .basetypes import BaseAsyncMongoDBAtlasSession
+from .dba import COUNTS_PROJECTION, USERNAME_INDEX, write_request, failed_operations, transitions_projection, transition_trims
+from ..dm.dmtypes import BaseAsyncDatabaseAbstraction, UserId, DungeonId, RoomId
+from ..dm.pagination import cursor_filter
+from ..dm.unit_of_work import WriteOperation, PartialWriteError
+from ..dm.content import CONTENT_HASH_FIELD
+from ..dm.utils import LIKE_WEIGHT, transition_increments
+
+
+@dataclass(slots=True)
+class AsyncMongoDBDatabaseAbstraction(BaseAsyncDatabaseAbstraction):
+    """
+    Class for MongoDB database abstractions using the asyncio driver.
+    """
+    connection : BaseAsyncMongoDBAtlasSession = field(kw_only=True)
+
+    async def select_user(self, user_id : UserId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a user.
+        """
+        fields = fields or {}
+        if user_id is not None:
+            fields["user_id"] = user_id
+        data = await self.connection.users.find_one(fields)
+        if not data:
+            raise KeyError("User not found.")
+        return dict(data)
+
+    async def select_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a dungeon.
+        """
+        fields = fields or {}
+        if dungeon_id is not None:
+            fields["dungeon_id"] = dungeon_id
+        data = await self.connection.dungeons.find_one(fields)
+        if not data:
+            raise KeyError("Dungeon not found.")
+        return dict(data)
+
+    async def select_room(self, room_id : RoomId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a room.
+        """
+        fields = fields or {}
+        if room_id is not None:
+            fields["room_id"] = room_id
+        data = await self.connection.rooms.find_one(fields)
+        if not data:
+            raise KeyError("Room not found.")
+        return dict(data)
+
+    async def select_users(self, user_ids : list[UserId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several users with a single query.
+        """
+        fields = fields or {}
+        fields["user_id"] = {"$in": list(user_ids)}
+        return [dict(data) for data in await self.connection.users.find(fields).to_list()]
+
+    async def select_dungeons(self, dungeon_ids : list[DungeonId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several dungeons with a single query.
+        """
+        fields = fields or {}
+        fields["dungeon_id"] = {"$in": list(dungeon_ids)}
+        return [dict(data) for data in await self.connection.dungeons.find(fields).to_list()]
+
+    async def select_rooms(self, room_ids : list[RoomId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several rooms with a single query.
+        """
+        fields = fields or {}
+        fields["room_id"] = {"$in": list(room_ids)}
+        return [dict(data) for data in await self.connection.rooms.find(fields).to_list()]
+
+    async def bulk_write(self, *, operations : list[WriteOperation]):
+        """
+        Abstraction to write several operations with one unordered bulk_write per collection.
+        Raises PartialWriteError with the operations that weren't written if any failed.
+        """
+        grouped = {}
+        for operation in operations:
+            grouped.setdefault(operation.collection, []).append(operation)
+        grouped = list(grouped.items())
+        results, failed = [], []
+        for position, (collection, collection_operations) in enumerate(grouped):
+            try:
+                results.append(await getattr(self.connection, collection).bulk_write([write_request(operation) for operation in collection_operations], ordered=False))
+            except BulkWriteError as e:
+                failed += failed_operations(e, collection_operations)
+            except Exception as e:
+                failed += [operation for _, later in grouped[position:] for operation in later]
+                raise PartialWriteError(f"{len(failed)} of {len(operations)} writes failed.", failed=failed) from e
+        if failed:
+            raise PartialWriteError(f"{len(failed)} of {len(operations)} writes failed.", failed=failed)
+        return results
+
+    async def add_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a liker to a dungeon. Returns the new counts or None if nothing changed.
+        """
+        return await self.connection.dungeons.find_one_and_update(
+            {"dungeon_id": dungeon_id, "likers": {"$ne": user_id}},
+            {"$addToSet": {"likers": user_id}, "$inc": {"like_count": 1, "score": LIKE_WEIGHT}},
+            projection=COUNTS_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def remove_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically remove a liker from a dungeon. Returns the new counts or None if nothing changed.
+        """
+        return await self.connection.dungeons.find_one_and_update(
+            {"dungeon_id": dungeon_id, "likers": user_id},
+            {"$pull": {"likers": user_id}, "$inc": {"like_count": -1, "score": -LIKE_WEIGHT}},
+            projection=COUNTS_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def add_view(self, dungeon_id : DungeonId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a view to a dungeon. Returns the new counts or None if the dungeon doesn't exist.
+        """
+        return await self.connection.dungeons.find_one_and_update(
+            {"dungeon_id": dungeon_id},
+            {"$inc": {"views": 1, "score": 1}},
+            projection=COUNTS_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def random_dungeons(self, *, amount : int = 1) -> list[dict]:
+        """
+        Abstraction to select random dungeons.
+        """
+        return await (await self.connection.dungeons.aggregate([{"$sample": {"size": amount}}])).to_list()
+
+    async def sorted_dungeons(
+        self,
+        *,
+        amount : int = 20,
+        offset : int = 0,
+        field : str = "score",
+        aggregation : list[dict] = None,
+        after : tuple[Any, DungeonId] = None
+    ) -> list[dict]:
+        """
+        Abstraction to select the best dungeons by a field, using the stored score by default.
+        Pass the (value, dungeon_id) of the last dungeon of a page as after to get the next page.
+        """
+        sort = [(field, -1), ("dungeon_id", -1)]
+        query = cursor_filter(after, field=field) if after is not None else {}
+        if not aggregation:
+            return await self.connection.dungeons.find(query).sort(sort).skip(offset).limit(amount).to_list()
+        aggregator = [
+            *aggregation,
+            *([{"$match": query}] if query else []),
+            {"$sort": dict(sort)},
+            {"$skip": offset},
+            {"$limit": amount}
+        ]
+        return await (await self.connection.dungeons.aggregate(aggregator)).to_list()
+
+    async def ensure_indexes(self):
+        """
+        Create the indexes used by the lookups and the tab queries.
+        """
+        await self.connection.users.create_index([("user_id", 1)], unique=True)
+        if not (await self.connection.users.index_information()).get(USERNAME_INDEX, {"unique": True}).get("unique"):
+            await self.connection.users.drop_index(USERNAME_INDEX)
+        await self.connection.users.create_index([("username", 1)], unique=True)
+        await self.connection.users.create_index([("linked_user", 1)], sparse=True)
+        await self.connection.rooms.create_index([("room_id", 1)], unique=True)
+        await self.connection.room_contents.create_index([(CONTENT_HASH_FIELD, 1)], unique=True)
+        await self.connection.dungeons.create_index([("dungeon_id", 1)], unique=True)
+        await self.connection.dungeons.create_index([("score", -1), ("dungeon_id", -1)])
+        await self.connection.dungeons.create_index([("creation_time", -1), ("dungeon_id", -1)])
+
+    async def refresh_owner_names(self) -> int:
+        """
+        Abstraction to copy the current username of every dungeon owner into the stored owner_name.
+        """
+        aggregator = [
+            {"$lookup": {"from": "users", "localField": "owner", "foreignField": "user_id", "as": "owner_user"}},
+            {"$unwind": "$owner_user"},
+            {"$match": {"$expr": {"$ne": ["$owner_name", "$owner_user.username"]}}},
+            {"$project": {"_id": 1, "owner_name": "$owner_user.username"}},
+        ]
+        updates = [UpdateOne({"_id": data["_id"]}, {"$set": {"owner_name": data["owner_name"]}}) async for data in await self.connection.dungeons.aggregate(aggregator)]
+        if not updates:
+            return 0
+        modified = (await self.connection.dungeons.bulk_write(updates, ordered=False)).modified_count
+        trims = transition_trims(await self.connection.dungeons.find({"dungeon_id": {"$in": list(transitions)}}, transitions_projection(transitions)).to_list())
+        if trims:
+            await self.connection.dungeons.bulk_write(trims, ordered=False)
+        return modified
+
+    async def select_room_content(self, content_hash : str) -> dict:
+        """
+        Abstraction to select stored room content by its hash.
+        """
+        data = await self.connection.room_contents.find_one({CONTENT_HASH_FIELD: content_hash})
+        if not data:
+            raise KeyError("Room content not found.")
+        return dict(data)
+
+    async def select_room_contents(self, content_hashes : list[str]) -> list[dict]:
+        """
+        Abstraction to select stored room content by several hashes with a single query.
+        """
+        return [dict(data) for data in await self.connection.room_contents.find({CONTENT_HASH_FIELD: {"$in": list(content_hashes)}}).to_list()]
+
+    async def insert_room_content(self, *, data : dict = None):
+        """
+        Abstraction to store room content. Content that is already stored is left alone.
+        """
+        return await self.connection.room_contents.update_one({CONTENT_HASH_FIELD: data[CONTENT_HASH_FIELD]}, {"$setOnInsert": data}, upsert=True)
+
+    async def add_room_transitions(self, *, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> int:
+        """
+        Abstraction to add counts of rooms entered after each other to the stats of dungeons with one bulk write.
+        Afterwards only the TRANSITION_TARGETS rooms most often entered after each room are kept. Returns the amount of dungeons updated.
+        """
+        updates = [UpdateOne({"dungeon_id": dungeon_id}, {"$inc": transition_increments(counts)}) for dungeon_id, counts in transitions.items() if counts]
+        if not updates:
+            return 0
+        modified = (await self.connection.dungeons.bulk_write(updates, ordered=False)).modified_count
+        trims = transition_trims(await self.connection.dungeons.find({"dungeon_id": {"$in": list(transitions)}}, transitions_projection(transitions)).to_list())
+        if trims:
+            await self.connection.dungeons.bulk_write(trims, ordered=False)
+        return modified
+
+    async def aggregate(self, *, collection : Literal["users", "dungeons", "rooms", "room_contents"], aggregation : list[dict]) -> list[dict]:
+        """
+        Aggregate documents.
+        """
+        return await (await getattr(self.connection, collection).aggregate(aggregation)).to_list()
@@ -6,6 +6,9 @@ from dataclasses import dataclass, field
 from pymongo.mongo_client import MongoClient
 from pymongo.database import Database
 from pymongo.collection import Collection
+from pymongo.asynchronous.mongo_client import AsyncMongoClient
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.asynchronous.collection import AsyncCollection
 
 
 
@@ -21,6 +24,21 @@ class BaseMongoDBAtlasSession:
     users : Collection = field(init=False)
     dungeons : Collection = field(init=False)
     rooms : Collection = field(init=False)
+    room_contents : Collection = field(init=False)
+
+
+@dataclass(slots=True)
+class BaseAsyncMongoDBAtlasSession:
+    """
+    Base class for MongoDB Atlas sessions using the asyncio driver.
+    """
+    URI : str = field(kw_only=True)
+    client : AsyncMongoClient = field(init=False)
+    db : AsyncDatabase = field(init=False)
+    users : AsyncCollection = field(init=False)
+    dungeons : AsyncCollection = field(init=False)
+    rooms : AsyncCollection = field(init=False)
+    room_contents : AsyncCollection = field(init=False)
 
 
 
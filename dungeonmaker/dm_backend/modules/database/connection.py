@@ -4,7 +4,8 @@ Submodule for database connections.
 from __future__ import annotations
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-from .basetypes import BaseMongoDBAtlasSession
+from pymongo.asynchronous.mongo_client import AsyncMongoClient
+from .basetypes import BaseMongoDBAtlasSession, BaseAsyncMongoDBAtlasSession
 
 
 
@@ -25,9 +26,39 @@ class MongoDBAtlasSession(BaseMongoDBAtlasSession):
         self.db = self.client["dungeon_maker_reinvented_db"]
         self.users = self.db["users"]
         self.rooms = self.db["rooms"]
+        self.room_contents = self.db["room_contents"]
         self.dungeons = self.db["dungeons"]
 
 
+class AsyncMongoDBAtlasSession(BaseAsyncMongoDBAtlasSession):
+    """
+    Class for MongoDB Atlas sessions using the asyncio driver. Await connect before using it.
+    """
+    def __init__(self, *args, server_api : bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = AsyncMongoClient(self.URI, server_api=ServerApi('1') if server_api else None)
+        self.db = self.client["dungeon_maker_reinvented_db"]
+        self.users = self.db["users"]
+        self.rooms = self.db["rooms"]
+        self.room_contents = self.db["room_contents"]
+        self.dungeons = self.db["dungeons"]
+
+    async def connect(self):
+        """
+        Check that the database can be reached.
+        """
+        try:
+            await self.client.admin.command('ping')
+        except Exception as e:
+            raise ConnectionError("The connection didn't work.") from e
+
+    async def close(self):
+        """
+        Close the client.
+        """
+        await self.client.close()
+
+
 
 
 
@@ -2,11 +2,70 @@
 Submodule for Database Abstractions.
 """
 from __future__ import annotations
-from typing import Literal
+import warnings
+from typing import Literal, Any, Union
 from dataclasses import dataclass, field
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 from .basetypes import BaseMongoDBAtlasSession
 from ..dm.dba import BaseDatabaseAbstraction
 from ..dm.dmtypes import UserId, DungeonId, RoomId
+from ..dm.utils import LIKE_WEIGHT, TRANSITIONS_FIELD, transition_increments, transition_unsets
+from ..dm.pagination import cursor_filter
+from ..dm.unit_of_work import WriteOperation, PartialWriteError, update_operators
+from ..dm.content import CONTENT_HASH_FIELD, PACKED_CODECS, pack_content, unpack_content
+
+# _id stays in, so the document is found again by it after updates that change whether it matches the filter.
+COUNTS_PROJECTION = {"like_count": 1, "views": 1, "score": 1}
+
+# Usernames were indexed without being unique before, and an index can't be changed in place.
+USERNAME_INDEX = "username_1"
+
+DUPLICATE_KEY = 11000
+
+# Only used to backfill the counts; like, unlike and view keep them up to date with $inc.
+COUNTS_PIPELINE = [
+    {"$set": {"like_count": {"$size": {"$ifNull": ["$likers", []]}}}},
+    {"$set": {"score": {"$add": [{"$multiply": [LIKE_WEIGHT, "$like_count"]}, {"$ifNull": ["$views", 0]}]}}},
+]
+
+
+def write_request(operation : WriteOperation) -> UpdateOne:
+    """
+    Get the bulk write request of an operation. Inserts are upserts keyed on the id, so writing one again after it was written doesn't fail.
+    """
+    return UpdateOne({operation.key_field: operation.key}, update_operators(operation.data, operation.additions), upsert=operation.kind == "insert")
+
+def failed_operations(error : BulkWriteError, operations : list[WriteOperation]) -> list[WriteOperation]:
+    """
+    Get the operations of an unordered bulk write that weren't written. All of them count as failed if the write concern wasn't met.
+    Operations violating a unique index are dropped with a warning, as writing them again can't succeed.
+    """
+    if error.details.get("writeConcernErrors"):
+        return operations
+    failed = []
+    for write_error in error.details.get("writeErrors", ()):
+        if write_error.get("code") == DUPLICATE_KEY:
+            warnings.warn(f"Dropped a write violating a unique index: {write_error.get('errmsg')}", RuntimeWarning)
+            continue
+        failed.append(operations[write_error["index"]])
+    return failed
+
+def transitions_projection(transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> dict[str, int]:
+    """
+    Get the projection of the stored transition counts from the rooms transitions were added for.
+    """
+    return {"dungeon_id": 1, **{f"stats.{TRANSITIONS_FIELD}.{from_room}": 1 for counts in transitions.values() for from_room in counts}}
+
+def transition_trims(dungeons : Any) -> list[UpdateOne]:
+    """
+    Get the updates keeping only the rooms most often entered after each room in the transition counts of dungeons, so they stay bounded.
+    """
+    return [
+        UpdateOne({"dungeon_id": dungeon["dungeon_id"]}, {"$unset": unsets})
+        for dungeon in dungeons
+        if (unsets := transition_unsets((dungeon.get("stats") or {}).get(TRANSITIONS_FIELD, {})))
+    ]
 
 @dataclass(slots=True)
 class MongoDBDatabaseAbstraction(BaseDatabaseAbstraction):
@@ -51,6 +110,30 @@ class MongoDBDatabaseAbstraction(BaseDatabaseAbstraction):
             raise KeyError("Room not found.")
         return dict(data)
     
+    def select_users(self, user_ids : list[UserId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several users with a single query.
+        """
+        fields = fields or {}
+        fields["user_id"] = {"$in": list(user_ids)}
+        return [dict(data) for data in self.connection.users.find(fields)]
+    
+    def select_dungeons(self, dungeon_ids : list[DungeonId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several dungeons with a single query.
+        """
+        fields = fields or {}
+        fields["dungeon_id"] = {"$in": list(dungeon_ids)}
+        return [dict(data) for data in self.connection.dungeons.find(fields)]
+    
+    def select_rooms(self, room_ids : list[RoomId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several rooms with a single query.
+        """
+        fields = fields or {}
+        fields["room_id"] = {"$in": list(room_ids)}
+        return [dict(data) for data in self.connection.rooms.find(fields)]
+    
     def update_user(self, user_id : UserId = None, *, fields : dict = None, updator : dict = None):
         """
         Abstraction to update a user.
@@ -96,37 +179,72 @@ class MongoDBDatabaseAbstraction(BaseDatabaseAbstraction):
         """
         return self.connection.rooms.insert_one(data)
     
+    def bulk_write(self, *, operations : list[WriteOperation]):
+        """
+        Abstraction to write several operations with one unordered bulk_write per collection.
+        Raises PartialWriteError with the operations that weren't written if any failed.
+        """
+        grouped = {}
+        for operation in operations:
+            grouped.setdefault(operation.collection, []).append(operation)
+        grouped = list(grouped.items())
+        results, failed = [], []
+        for position, (collection, collection_operations) in enumerate(grouped):
+            try:
+                results.append(getattr(self.connection, collection).bulk_write([write_request(operation) for operation in collection_operations], ordered=False))
+            except BulkWriteError as e:
+                failed += failed_operations(e, collection_operations)
+            except Exception as e:
+                failed += [operation for _, later in grouped[position:] for operation in later]
+                raise PartialWriteError(f"{len(failed)} of {len(operations)} writes failed.", failed=failed) from e
+        if failed:
+            raise PartialWriteError(f"{len(failed)} of {len(operations)} writes failed.", failed=failed)
+        return results
+    
+    def add_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a liker to a dungeon. Returns the new counts or None if nothing changed.
+        """
+        return self.connection.dungeons.find_one_and_update(
+            {"dungeon_id": dungeon_id, "likers": {"$ne": user_id}},
+            {"$addToSet": {"likers": user_id}, "$inc": {"like_count": 1, "score": LIKE_WEIGHT}},
+            projection=COUNTS_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+    
+    def remove_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically remove a liker from a dungeon. Returns the new counts or None if nothing changed.
+        """
+        return self.connection.dungeons.find_one_and_update(
+            {"dungeon_id": dungeon_id, "likers": user_id},
+            {"$pull": {"likers": user_id}, "$inc": {"like_count": -1, "score": -LIKE_WEIGHT}},
+            projection=COUNTS_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+    
+    def add_view(self, dungeon_id : DungeonId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a view to a dungeon. Returns the new counts or None if the dungeon doesn't exist.
+        """
+        return self.connection.dungeons.find_one_and_update(
+            {"dungeon_id": dungeon_id},
+            {"$inc": {"views": 1, "score": 1}},
+            projection=COUNTS_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+    
+    def backfill_scores(self) -> int:
+        """
+        Abstraction to store the like count and popularity score on every dungeon document.
+        """
+        return self.connection.dungeons.update_many({}, COUNTS_PIPELINE).modified_count
+    
     def random_dungeons(self, *, amount : int = 1) -> list[dict]:
         """
         Abstraction to select random dungeons.
         """
-        aggregator = [
-            {
-                "$sample":
-                {
-                    "size": amount,
-                },
-            },
-            {
-                "$addFields":
-                {
-                    "score": {
-                    "$add": [
-                        {
-                        "$multiply": [
-                            20,
-                            {
-                            "$size": "$likers",
-                            },
-                        ],
-                        },
-                        "$views",
-                    ],
-                    },
-                },
-            },
-        ]
-        return list(self.connection.dungeons.aggregate(aggregator))
+        return list(self.connection.dungeons.aggregate([{"$sample": {"size": amount}}]))
     
     def sorted_dungeons(
         self, 
@@ -134,19 +252,139 @@ class MongoDBDatabaseAbstraction(BaseDatabaseAbstraction):
         amount : int = 20, 
         offset : int = 0, 
         field : str = "score", 
-        aggregation : list[dict] = [{"$addFields":{"score": {"$add": [{"$multiply": [20,{"$size": "$likers"},]},"$views"]}}}]
+        aggregation : list[dict] = None,
+        after : tuple[Any, DungeonId] = None
     ) -> list[dict]:
         """
-        Abstraction to select random dungeons.
+        Abstraction to select the best dungeons by a field, using the stored score by default.
+        Pass the (value, dungeon_id) of the last dungeon of a page as after to get the next page.
         """
+        sort = [(field, -1), ("dungeon_id", -1)]
+        query = cursor_filter(after, field=field) if after is not None else {}
+        if not aggregation:
+            return list(self.connection.dungeons.find(query).sort(sort).skip(offset).limit(amount))
         aggregator = [
             *aggregation,
-            {"$sort": {field: -1}},
-            {"$limit": amount + offset}
+            *([{"$match": query}] if query else []),
+            {"$sort": dict(sort)},
+            {"$skip": offset},
+            {"$limit": amount}
+        ]
+        return list(self.connection.dungeons.aggregate(aggregator))
+    
+    def ensure_indexes(self):
+        """
+        Create the indexes used by the lookups and the tab queries.
+        """
+        self.connection.users.create_index([("user_id", 1)], unique=True)
+        if not self.connection.users.index_information().get(USERNAME_INDEX, {"unique": True}).get("unique"):
+            self.connection.users.drop_index(USERNAME_INDEX)
+        self.connection.users.create_index([("username", 1)], unique=True)
+        self.connection.users.create_index([("linked_user", 1)], sparse=True)
+        self.connection.rooms.create_index([("room_id", 1)], unique=True)
+        self.connection.room_contents.create_index([(CONTENT_HASH_FIELD, 1)], unique=True)
+        self.connection.dungeons.create_index([("dungeon_id", 1)], unique=True)
+        self.connection.dungeons.create_index([("score", -1), ("dungeon_id", -1)])
+        self.connection.dungeons.create_index([("creation_time", -1), ("dungeon_id", -1)])
+    
+    def duplicate_usernames(self) -> dict[str, list[UserId]]:
+        """
+        Abstraction to find the usernames shared by several users, which keep the unique username index from being created.
+        """
+        aggregator = [
+            {"$group": {"_id": "$username", "user_ids": {"$push": "$user_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]
+        return {data["_id"]: data["user_ids"] for data in self.connection.users.aggregate(aggregator)}
+    
+    def refresh_owner_names(self) -> int:
+        """
+        Abstraction to copy the current username of every dungeon owner into the stored owner_name.
+        """
+        aggregator = [
+            {"$lookup": {"from": "users", "localField": "owner", "foreignField": "user_id", "as": "owner_user"}},
+            {"$unwind": "$owner_user"},
+            {"$match": {"$expr": {"$ne": ["$owner_name", "$owner_user.username"]}}},
+            {"$project": {"_id": 1, "owner_name": "$owner_user.username"}},
         ]
-        return list(self.connection.dungeons.aggregate(aggregator))[offset:]
+        updates = [UpdateOne({"_id": data["_id"]}, {"$set": {"owner_name": data["owner_name"]}}) for data in self.connection.dungeons.aggregate(aggregator)]
+        if not updates:
+            return 0
+        return self.connection.dungeons.bulk_write(updates, ordered=False).modified_count
+    
+    def select_room_content(self, content_hash : str) -> dict:
+        """
+        Abstraction to select stored room content by its hash.
+        """
+        data = self.connection.room_contents.find_one({CONTENT_HASH_FIELD: content_hash})
+        if not data:
+            raise KeyError("Room content not found.")
+        return dict(data)
+    
+    def select_room_contents(self, content_hashes : list[str]) -> list[dict]:
+        """
+        Abstraction to select stored room content by several hashes with a single query.
+        """
+        return [dict(data) for data in self.connection.room_contents.find({CONTENT_HASH_FIELD: {"$in": list(content_hashes)}})]
+    
+    def insert_room_content(self, *, data : dict = None):
+        """
+        Abstraction to store room content. Content that is already stored is left alone.
+        """
+        return self.connection.room_contents.update_one({CONTENT_HASH_FIELD: data[CONTENT_HASH_FIELD]}, {"$setOnInsert": data}, upsert=True)
+    
+    def add_room_transitions(self, *, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> int:
+        """
+        Abstraction to add counts of rooms entered after each other to the stats of dungeons with one bulk write.
+        Afterwards only the TRANSITION_TARGETS rooms most often entered after each room are kept. Returns the amount of dungeons updated.
+        """
+        updates = [UpdateOne({"dungeon_id": dungeon_id}, {"$inc": transition_increments(counts)}) for dungeon_id, counts in transitions.items() if counts]
+        if not updates:
+            return 0
+        modified = self.connection.dungeons.bulk_write(updates, ordered=False).modified_count
+        trims = transition_trims(self.connection.dungeons.find({"dungeon_id": {"$in": list(transitions)}}, transitions_projection(transitions)))
+        if trims:
+            self.connection.dungeons.bulk_write(trims, ordered=False)
+        return modified
+    
+    def externalize_room_contents(self, *, batch_size : int = 500) -> int:
+        """
+        Move the content still stored inline in room documents to the room content store.
+        """
+        updated = 0
+        rooms = self.connection.rooms.find({"content": {"$type": "string"}, CONTENT_HASH_FIELD: {"$exists": False}}, {"_id": 1, "content": 1})
+        updates = []
+        for data in rooms:
+            document = pack_content(data["content"])
+            self.insert_room_content(data=document)
+            updates.append(UpdateOne({"_id": data["_id"]}, {"$set": {"content": None, CONTENT_HASH_FIELD: document[CONTENT_HASH_FIELD]}}))
+            if len(updates) >= batch_size:
+                updated += self.connection.rooms.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            updated += self.connection.rooms.bulk_write(updates, ordered=False).modified_count
+        return updated
+    
+    def repack_room_contents(self, *, batch_size : int = 500) -> int:
+        """
+        Store room content packed before the tile grid format in it, where that is smaller. Hashes don't change, so rooms keep referring to it.
+        """
+        updated = 0
+        contents = self.connection.room_contents.find({"codec": {"$nin": list(PACKED_CODECS)}})
+        updates = []
+        for document in contents:
+            packed = pack_content(unpack_content(document), digest=document[CONTENT_HASH_FIELD])
+            if len(packed["data"]) >= len(document["data"]):
+                continue
+            updates.append(UpdateOne({"_id": document["_id"]}, {"$set": {"codec": packed["codec"], "data": packed["data"]}}))
+            if len(updates) >= batch_size:
+                updated += self.connection.room_contents.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            updated += self.connection.room_contents.bulk_write(updates, ordered=False).modified_count
+        return updated
     
-    def aggregate(self, *, collection : Literal["users", "dungeons", "rooms"], aggregation : list[dict]):
+    def aggregate(self, *, collection : Literal["users", "dungeons", "rooms", "room_contents"], aggregation : list[dict]):
         """
         Aggregate documents.
         """
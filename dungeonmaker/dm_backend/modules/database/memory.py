@@ -0,0 +1,370 @@
+"""
+Submodule for an in-memory database abstraction.
+"""
+from __future__ import annotations
+import copy, random, threading
+from typing import Any, Literal, Union
+from ..dm.dba import BaseDatabaseAbstraction
+from ..dm.dmtypes import UserId, DungeonId, RoomId
+from ..dm.utils import LIKE_WEIGHT, TRANSITIONS_FIELD, merge_transitions
+from ..dm.pagination import cursor_filter
+from ..dm.unit_of_work import WriteOperation
+from ..dm.content import CONTENT_HASH_FIELD
+
+KEY_FIELDS : dict[str, str] = {
+    "users": "user_id",
+    "dungeons": "dungeon_id",
+    "rooms": "room_id",
+    "room_contents": CONTENT_HASH_FIELD,
+}
+
+
+class InMemoryDatabaseAbstraction(BaseDatabaseAbstraction):
+    """
+    Class for a database abstraction keeping all documents in memory, for tests and benchmarks without a database.
+    It understands the subset of MongoDB queries and updates the sessions send. Documents are copied in and out like they would be by a driver.
+    """
+    collections : dict[str, dict[Any, dict]]
+    latency : float
+    calls : int
+    _lock : threading.RLock
+    _wait : threading.Event
+
+    def __init__(self, *, latency : float = 0):
+        """
+        latency is slept on every call to simulate database round trips.
+        """
+        self.collections = {collection: {} for collection in KEY_FIELDS}
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.RLock()
+        self._wait = threading.Event()
+
+    def select_user(self, user_id : UserId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a user.
+        """
+        return self._find_one("users", user_id, fields, "User not found.")
+
+    def select_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a dungeon.
+        """
+        return self._find_one("dungeons", dungeon_id, fields, "Dungeon not found.")
+
+    def select_room(self, room_id : RoomId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a room.
+        """
+        return self._find_one("rooms", room_id, fields, "Room not found.")
+
+    def select_users(self, user_ids : list[UserId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several users with a single query.
+        """
+        return self._find("users", {**(fields or {}), "user_id": {"$in": list(user_ids)}})
+
+    def select_dungeons(self, dungeon_ids : list[DungeonId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several dungeons with a single query.
+        """
+        return self._find("dungeons", {**(fields or {}), "dungeon_id": {"$in": list(dungeon_ids)}})
+
+    def select_rooms(self, room_ids : list[RoomId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several rooms with a single query.
+        """
+        return self._find("rooms", {**(fields or {}), "room_id": {"$in": list(room_ids)}})
+
+    def update_user(self, user_id : UserId = None, *, fields : dict = None, updator : dict = None):
+        """
+        Abstraction to update a user.
+        """
+        return self._update_one("users", user_id, fields, updator)
+
+    def update_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None, updator : dict = None):
+        """
+        Abstraction to update a dungeon.
+        """
+        return self._update_one("dungeons", dungeon_id, fields, updator)
+
+    def update_room(self, room_id : RoomId = None, *, fields : dict = None, updator : dict = None):
+        """
+        Abstraction to update a room.
+        """
+        return self._update_one("rooms", room_id, fields, updator)
+
+    def insert_user(self, *, data : dict = None):
+        """
+        Abstraction to insert a user.
+        """
+        return self._insert("users", data)
+
+    def insert_dungeon(self, *, data : dict = None):
+        """
+        Abstraction to insert a dungeon.
+        """
+        return self._insert("dungeons", data)
+
+    def insert_room(self, *, data : dict = None):
+        """
+        Abstraction to insert a room.
+        """
+        return self._insert("rooms", data)
+
+    def bulk_write(self, *, operations : list[WriteOperation]):
+        """
+        Abstraction to write several operations at once.
+        """
+        self._round_trip()
+        with self._lock:
+            for operation in operations:
+                documents = self.collections[operation.collection]
+                if operation.kind == "insert":
+                    documents[operation.data[operation.key_field]] = copy.deepcopy(operation.data)
+                elif (document := self._by_key(operation.collection, operation.key_field, operation.key)) is not None:
+                    document.update(copy.deepcopy(operation.data))
+                    _add_to_sets(document, operation.additions)
+
+    def add_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a liker to a dungeon. Returns the new counts or None if nothing changed.
+        """
+        self._round_trip()
+        with self._lock:
+            document = self.collections["dungeons"].get(dungeon_id)
+            if document is None or user_id in document.get("likers", ()):
+                return None
+            document["likers"] = [*document.get("likers", ()), user_id]
+            return _update_counts(document)
+
+    def remove_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically remove a liker from a dungeon. Returns the new counts or None if nothing changed.
+        """
+        self._round_trip()
+        with self._lock:
+            document = self.collections["dungeons"].get(dungeon_id)
+            if document is None or user_id not in document.get("likers", ()):
+                return None
+            document["likers"] = [liker for liker in document["likers"] if liker != user_id]
+            return _update_counts(document)
+
+    def add_view(self, dungeon_id : DungeonId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a view to a dungeon. Returns the new counts or None if the dungeon doesn't exist.
+        """
+        self._round_trip()
+        with self._lock:
+            document = self.collections["dungeons"].get(dungeon_id)
+            if document is None:
+                return None
+            document["views"] = document.get("views", 0) + 1
+            return _update_counts(document)
+
+    def backfill_scores(self) -> int:
+        """
+        Abstraction to store the like count and popularity score on every dungeon document.
+        """
+        with self._lock:
+            for document in self.collections["dungeons"].values():
+                _update_counts(document)
+            return len(self.collections["dungeons"])
+
+    def random_dungeons(self, *, amount : int = 1) -> list[dict]:
+        """
+        Abstraction to select random dungeons.
+        """
+        self._round_trip()
+        with self._lock:
+            documents = list(self.collections["dungeons"].values())
+            return copy.deepcopy(random.sample(documents, min(amount, len(documents))))
+
+    def sorted_dungeons(
+        self,
+        *,
+        amount : int = 20,
+        offset : int = 0,
+        field : str = "score",
+        aggregation : list[dict] = None,
+        after : tuple[Any, DungeonId] = None
+    ) -> list[dict]:
+        """
+        Abstraction to select the best dungeons by a field.
+        Of the aggregation stages, $sample, $match and a $search on the name are understood.
+        """
+        self._round_trip()
+        with self._lock:
+            documents = list(self.collections["dungeons"].values())
+            for stage in aggregation or ():
+                documents = _run_stage(stage, documents)
+            if after is not None:
+                query = cursor_filter(after, field=field)
+                documents = [document for document in documents if _matches(document, query)]
+            documents.sort(key=lambda document: (document.get(field, 0), document["dungeon_id"]), reverse=True)
+            return copy.deepcopy(documents[offset:offset + amount])
+
+    def refresh_owner_names(self) -> int:
+        """
+        Abstraction to copy the current username of every dungeon owner into the stored owner_name.
+        """
+        self._round_trip()
+        updated = 0
+        with self._lock:
+            for document in self.collections["dungeons"].values():
+                owner = self.collections["users"].get(document.get("owner"))
+                if owner is not None and document.get("owner_name") != owner["username"]:
+                    document["owner_name"] = owner["username"]
+                    updated += 1
+        return updated
+
+    def select_room_content(self, content_hash : str) -> dict:
+        """
+        Abstraction to select stored room content by its hash.
+        """
+        return self._find_one("room_contents", content_hash, None, "Room content not found.")
+
+    def select_room_contents(self, content_hashes : list[str]) -> list[dict]:
+        """
+        Abstraction to select stored room content by several hashes with a single query.
+        """
+        self._round_trip()
+        with self._lock:
+            documents = self.collections["room_contents"]
+            return [copy.deepcopy(documents[content_hash]) for content_hash in dict.fromkeys(content_hashes) if content_hash in documents]
+
+    def insert_room_content(self, *, data : dict = None):
+        """
+        Abstraction to store room content. Content that is already stored is left alone.
+        """
+        self._round_trip()
+        with self._lock:
+            self.collections["room_contents"].setdefault(data[CONTENT_HASH_FIELD], copy.deepcopy(data))
+
+    def add_room_transitions(self, *, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> int:
+        """
+        Abstraction to add counts of rooms entered after each other to the stats of dungeons. Returns the amount of dungeons updated.
+        """
+        self._round_trip()
+        updated = 0
+        with self._lock:
+            for dungeon_id, counts in transitions.items():
+                document = self.collections["dungeons"].get(dungeon_id)
+                if document is None or not counts:
+                    continue
+                stats = document.get("stats") or {}
+                document["stats"] = {**stats, TRANSITIONS_FIELD: merge_transitions(stats.get(TRANSITIONS_FIELD, {}), counts)}
+                updated += 1
+        return updated
+
+    def aggregate(self, *, collection : Literal["users", "dungeons", "rooms", "room_contents"], aggregation : list[dict]) -> list[dict]:
+        """
+        Aggregate documents with the stages sorted_dungeons understands.
+        """
+        self._round_trip()
+        with self._lock:
+            documents = list(self.collections[collection].values())
+            for stage in aggregation:
+                documents = _run_stage(stage, documents)
+            return copy.deepcopy(documents)
+
+    def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            self._wait.wait(self.latency)
+
+    def _by_key(self, collection : str, key_field : str, key : Any) -> Union[dict, None]:
+        if key_field == KEY_FIELDS[collection]:
+            return self.collections[collection].get(key)
+        return next((document for document in self.collections[collection].values() if document.get(key_field) == key), None)
+
+    def _find(self, collection : str, query : dict) -> list[dict]:
+        self._round_trip()
+        with self._lock:
+            return [copy.deepcopy(document) for document in self.collections[collection].values() if _matches(document, query)]
+
+    def _find_one(self, collection : str, key : Any, fields : Union[dict, None], message : str) -> dict:
+        self._round_trip()
+        with self._lock:
+            if key is not None and not fields:
+                document = self.collections[collection].get(key)
+            else:
+                query = {**(fields or {}), **({KEY_FIELDS[collection]: key} if key is not None else {})}
+                document = next((document for document in self.collections[collection].values() if _matches(document, query)), None)
+            if document is None:
+                raise KeyError(message)
+            return copy.deepcopy(document)
+
+    def _insert(self, collection : str, data : dict):
+        self._round_trip()
+        with self._lock:
+            self.collections[collection][data[KEY_FIELDS[collection]]] = copy.deepcopy(data)
+
+    def _update_one(self, collection : str, key : Any, fields : Union[dict, None], updator : dict):
+        self._round_trip()
+        with self._lock:
+            query = {**(fields or {}), **({KEY_FIELDS[collection]: key} if key is not None else {})}
+            document = next((document for document in self.collections[collection].values() if _matches(document, query)), None)
+            if document is None:
+                return None
+            for operator, changes in updator.items():
+                if operator == "$set":
+                    document.update(copy.deepcopy(changes))
+                elif operator == "$unset":
+                    for name in changes:
+                        document.pop(name, None)
+                elif operator == "$inc":
+                    for name, amount in changes.items():
+                        document[name] = document.get(name, 0) + amount
+                elif operator == "$addToSet":
+                    _add_to_sets(document, {name: value["$each"] if isinstance(value, dict) else [value] for name, value in changes.items()})
+                else:
+                    raise ValueError(f"Unsupported update operator {operator}.")
+            return None
+
+
+def _add_to_sets(document : dict, additions : dict[str, list]):
+    for name, items in additions.items():
+        values = document.setdefault(name, [])
+        values.extend(copy.deepcopy(item) for item in items if item not in values)
+
+def _update_counts(document : dict) -> dict:
+    document["like_count"] = len(document.get("likers", ()))
+    document["score"] = LIKE_WEIGHT * document["like_count"] + document.get("views", 0)
+    return {"like_count": document["like_count"], "views": document.get("views", 0), "score": document["score"]}
+
+def _run_stage(stage : dict, documents : list[dict]) -> list[dict]:
+    (operator, argument), = stage.items()
+    if operator == "$sample":
+        return random.sample(documents, min(argument["size"], len(documents)))
+    if operator == "$match":
+        return [document for document in documents if _matches(document, argument)]
+    if operator == "$search":
+        term = argument["text"]["query"].lower()
+        return [document for document in documents if term in str(document.get("name", "")).lower()]
+    raise ValueError(f"Unsupported aggregation stage {operator}.")
+
+def _matches(document : dict, query : dict) -> bool:
+    for name, condition in query.items():
+        if name == "$or":
+            if not any(_matches(document, option) for option in condition):
+                return False
+            continue
+        value = document.get(name)
+        if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+            for operator, operand in condition.items():
+                if operator == "$in":
+                    matched = value in operand
+                elif operator == "$ne":
+                    matched = value != operand and not (isinstance(value, list) and operand in value)
+                elif operator == "$lt":
+                    matched = value is not None and value < operand
+                elif operator == "$gt":
+                    matched = value is not None and value > operand
+                else:
+                    raise ValueError(f"Unsupported query operator {operator}.")
+                if not matched:
+                    return False
+        elif value != condition and not (isinstance(value, list) and condition in value):
+            return False
+    return True
@@ -0,0 +1,91 @@
+"""
+Submodule for maintenance jobs and migrations.
+
+Run with ``python -m dungeonmaker.dm_backend.modules.database.migrations <job>``.
+"""
+from __future__ import annotations
+import argparse, os
+from typing import Callable
+from ..dm.dmtypes import BaseDatabaseAbstraction
+
+
+class MigrationError(Exception):
+    """
+    Raised when a job can't run on the database as it is.
+    """
+
+
+def refresh_owner_names(dba : BaseDatabaseAbstraction) -> int:
+    """
+    Rewrite the stored owner name of every dungeon from its owner's current username.
+    """
+    return dba.refresh_owner_names()
+
+
+def backfill_scores(dba : BaseDatabaseAbstraction) -> int:
+    """
+    Store the like count and popularity score on every dungeon and create the index used to sort by it.
+    """
+    create_indexes(dba)
+    return dba.backfill_scores()
+
+
+def create_indexes(dba : BaseDatabaseAbstraction) -> int:
+    """
+    Create all indexes. The backend doesn't do this on startup, run it before the first start and after updates.
+    Nothing is changed while several users share a username, as the unique username index would fail. They are reported instead.
+    """
+    if (duplicates := dba.duplicate_usernames()):
+        lines = "\n".join(f"  {username!r}: users {', '.join(map(str, user_ids))}" for username, user_ids in sorted(duplicates.items(), key=lambda item: str(item[0])))
+        raise MigrationError(f"{len(duplicates)} usernames are shared by several users, rename them first:\n{lines}")
+    dba.ensure_indexes()
+    return 0
+
+
+def externalize_room_contents(dba : BaseDatabaseAbstraction) -> int:
+    """
+    Move room content stored inline to the compressed, deduplicated room content store.
+    """
+    create_indexes(dba)
+    return dba.externalize_room_contents()
+
+
+def repack_room_contents(dba : BaseDatabaseAbstraction) -> int:
+    """
+    Store room content in the tile grid format where that is smaller.
+    """
+    return dba.repack_room_contents()
+
+
+JOBS : dict[str, Callable[[BaseDatabaseAbstraction], int]] = {
+    "refresh-owner-names": refresh_owner_names,
+    "backfill-scores": backfill_scores,
+    "create-indexes": create_indexes,
+    "externalize-room-contents": externalize_room_contents,
+    "repack-room-contents": repack_room_contents,
+}
+
+
+def main(argv : list[str] = None) -> int:
+    """
+    Run a maintenance job against a MongoDB Atlas database.
+    """
+    from .connection import MongoDBAtlasSession
+    from .dba import MongoDBDatabaseAbstraction
+    parser = argparse.ArgumentParser(description="Maintenance jobs for the Dungeon Maker database.")
+    parser.add_argument("job", choices=sorted(JOBS))
+    parser.add_argument("--uri", default=os.getenv("MONGO_DB_ATLAS_URI"), help="defaults to $MONGO_DB_ATLAS_URI")
+    args = parser.parse_args(argv)
+    if not args.uri:
+        parser.error("no database URI given")
+    dba = MongoDBDatabaseAbstraction(connection=MongoDBAtlasSession(URI=args.uri))
+    try:
+        updated = JOBS[args.job](dba)
+    except MigrationError as error:
+        parser.exit(1, f"{args.job}: {error}\n")
+    print(f"{args.job}: {updated} documents updated")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,544 @@
+"""
+Submodule for tiered storage: a local embedded store answering reads before the remote database abstraction.
+"""
+from __future__ import annotations
+import time, sqlite3, threading
+from typing import Any, Union
+from dataclasses import dataclass, field
+import bson
+from ..dm.dba import BaseDatabaseAbstraction
+from ..dm.dmtypes import UserId, DungeonId, RoomId
+from ..dm.unit_of_work import WriteOperation, WriteBehindQueue, PartialWriteError
+from ..dm.content import CONTENT_HASH_FIELD
+from .memory import KEY_FIELDS
+
+VERSION_FIELD = "_version"
+
+LOCAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    key NOT NULL,
+    version INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    dirty INTEGER NOT NULL DEFAULT 0,
+    data BLOB NOT NULL,
+    PRIMARY KEY (collection, key)
+)
+"""
+
+
+@dataclass(slots=True)
+class LocalEntry:
+    """
+    Class for a document held by the local store.
+    """
+    data : dict = field(kw_only=True)
+    version : int = field(kw_only=True)
+    stored_at : float = field(kw_only=True)
+    dirty : bool = field(kw_only=True, default=False)
+
+
+@dataclass(slots=True)
+class TierStats:
+    """
+    Class for statistics about the local tier.
+    """
+    hits : int = field(kw_only=True, default=0)
+    misses : int = field(kw_only=True, default=0)
+    expirations : int = field(kw_only=True, default=0)
+    stale : int = field(kw_only=True, default=0)
+    writes : int = field(kw_only=True, default=0)
+
+    def to_object(self) -> dict:
+        """
+        Convert to an object.
+        """
+        return {"hits": self.hits, "misses": self.misses, "expirations": self.expirations, "stale": self.stale, "writes": self.writes}
+
+
+class SQLiteDocumentStore:
+    """
+    Class for a local document store in an SQLite file. Documents are kept as BSON with a version stamp and whether they still have to be written to the remote database.
+    """
+    path : str
+    connection : sqlite3.Connection
+    _lock : threading.Lock
+
+    def __init__(self, path : str = ":memory:"):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            if path != ":memory:":
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(LOCAL_SCHEMA)
+
+    def get(self, collection : str, key : Any) -> Union[LocalEntry, None]:
+        """
+        Get a document or None if it isn't stored.
+        """
+        with self._lock:
+            row = self.connection.execute("SELECT data, version, stored_at, dirty FROM documents WHERE collection = ? AND key = ?", (collection, key)).fetchone()
+        if row is None:
+            return None
+        return LocalEntry(data=bson.decode(row[0]), version=row[1], stored_at=row[2], dirty=bool(row[3]))
+
+    def put(self, collection : str, key : Any, data : dict, *, version : int, dirty : bool = False):
+        """
+        Store a document.
+        """
+        encoded = bson.encode(data)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (collection, key, version, stored_at, dirty, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (collection, key, version, time.time(), int(dirty), encoded)
+            )
+
+    def delete(self, collection : str, key : Any):
+        """
+        Remove a document.
+        """
+        with self._lock:
+            self.connection.execute("DELETE FROM documents WHERE collection = ? AND key = ?", (collection, key))
+
+    def clear(self, collection : str = None):
+        """
+        Remove all clean documents, optionally only of one collection. Documents waiting to be written are kept.
+        """
+        with self._lock:
+            if collection is None:
+                self.connection.execute("DELETE FROM documents WHERE dirty = 0")
+            else:
+                self.connection.execute("DELETE FROM documents WHERE collection = ? AND dirty = 0", (collection,))
+
+    def mark_clean(self, collection : str, key : Any, version : int):
+        """
+        Mark a document as written to the remote database, unless it changed again since that version.
+        """
+        with self._lock:
+            self.connection.execute("UPDATE documents SET dirty = 0 WHERE collection = ? AND key = ? AND version <= ?", (collection, key, version))
+
+    def dirty(self, collection : str) -> list[dict]:
+        """
+        Get the documents of a collection that weren't written to the remote database yet.
+        """
+        with self._lock:
+            rows = self.connection.execute("SELECT data FROM documents WHERE collection = ? AND dirty = 1", (collection,)).fetchall()
+        return [bson.decode(row[0]) for row in rows]
+
+    def close(self):
+        """
+        Close the database file.
+        """
+        with self._lock:
+            self.connection.close()
+
+
+class TieredDatabaseAbstraction(BaseDatabaseAbstraction):
+    """
+    Class for a database abstraction answering users, dungeons and rooms from a local store first and falling through to a remote abstraction on a miss.
+    Writes go to the remote abstraction immediately (write-through) or are stored locally and batched to it (write-back).
+    Every write of a document stamps it with the next version under _version, so a refetched document older than the local one is recognized as not yet written and one newer than it as a stale local copy.
+    Local copies older than max_age are fetched again, because other processes may write the same documents.
+    """
+    local : SQLiteDocumentStore
+    remote : BaseDatabaseAbstraction
+    max_age : Union[float, None]
+    write_queue : Union[WriteBehindQueue, None]
+    stats : TierStats
+    _lock : threading.Lock
+
+    def __init__(
+        self,
+        *,
+        local : SQLiteDocumentStore,
+        remote : BaseDatabaseAbstraction,
+        write_back : bool = False,
+        max_age : Union[float, None] = 60,
+        flush_interval : float = 0.5,
+        flush_size : int = 100
+    ):
+        self.local = local
+        self.remote = remote
+        self.max_age = max_age
+        self.stats = TierStats()
+        self._lock = threading.Lock()
+        self.write_queue = WriteBehindQueue(flush_callback=self._write_back, interval=flush_interval, max_operations=flush_size) if write_back else None
+
+    def start(self):
+        """
+        Start writing back in the background.
+        """
+        if self.write_queue is not None:
+            self.write_queue.start()
+
+    def close(self):
+        """
+        Write everything that is still pending and close the local store.
+        """
+        if self.write_queue is not None:
+            self.write_queue.stop()
+        self.local.close()
+
+    def select_user(self, user_id : UserId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a user.
+        """
+        return self._select("users", user_id, fields, self.remote.select_user)
+
+    def select_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a dungeon.
+        """
+        return self._select("dungeons", dungeon_id, fields, self.remote.select_dungeon)
+
+    def select_room(self, room_id : RoomId = None, *, fields : dict = None) -> dict:
+        """
+        Abstraction to select a room.
+        """
+        return self._select("rooms", room_id, fields, self.remote.select_room)
+
+    def select_users(self, user_ids : list[UserId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several users, fetching only the ones not stored locally.
+        """
+        return self._select_many("users", user_ids, fields, self.remote.select_users)
+
+    def select_dungeons(self, dungeon_ids : list[DungeonId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several dungeons, fetching only the ones not stored locally.
+        """
+        return self._select_many("dungeons", dungeon_ids, fields, self.remote.select_dungeons)
+
+    def select_rooms(self, room_ids : list[RoomId], *, fields : dict = None) -> list[dict]:
+        """
+        Abstraction to select several rooms, fetching only the ones not stored locally.
+        """
+        return self._select_many("rooms", room_ids, fields, self.remote.select_rooms)
+
+    def update_user(self, user_id : UserId = None, *, fields : dict = None, updator : dict = None):
+        """
+        Abstraction to update a user.
+        """
+        return self._update("users", user_id, fields, updator, self.remote.update_user)
+
+    def update_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None, updator : dict = None):
+        """
+        Abstraction to update a dungeon.
+        """
+        return self._update("dungeons", dungeon_id, fields, updator, self.remote.update_dungeon)
+
+    def update_room(self, room_id : RoomId = None, *, fields : dict = None, updator : dict = None):
+        """
+        Abstraction to update a room.
+        """
+        return self._update("rooms", room_id, fields, updator, self.remote.update_room)
+
+    def insert_user(self, *, data : dict = None):
+        """
+        Abstraction to insert a user.
+        """
+        return self._insert("users", data, self.remote.insert_user)
+
+    def insert_dungeon(self, *, data : dict = None):
+        """
+        Abstraction to insert a dungeon.
+        """
+        return self._insert("dungeons", data, self.remote.insert_dungeon)
+
+    def insert_room(self, *, data : dict = None):
+        """
+        Abstraction to insert a room.
+        """
+        return self._insert("rooms", data, self.remote.insert_room)
+
+    def bulk_write(self, *, operations : list[WriteOperation]):
+        """
+        Abstraction to write several operations at once.
+        """
+        stamped = []
+        for operation in operations:
+            if operation.kind == "insert":
+                data = {**operation.data, VERSION_FIELD: 1}
+                self._store_write(operation.collection, operation.key, data, version=1, insert=True)
+                stamped.append(WriteOperation(kind="insert", collection=operation.collection, key_field=operation.key_field, key=operation.key, data=data))
+            elif (changes := self._stamp_update(operation.collection, operation.key, operation.data, operation.additions)) is not None:
+                stamped.append(WriteOperation(kind="update", collection=operation.collection, key_field=operation.key_field, key=operation.key, data=changes, additions=operation.additions))
+        if self.write_queue is not None or not stamped:
+            return None
+        try:
+            return self.remote.bulk_write(operations=stamped)
+        except BaseException:
+            for operation in stamped:
+                self.local.delete(operation.collection, operation.key)
+            raise
+
+    def add_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a liker to a dungeon.
+        """
+        return self._remote_dungeon_write(self.remote.add_liker, dungeon_id=dungeon_id, user_id=user_id)
+
+    def remove_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Abstraction to atomically remove a liker from a dungeon.
+        """
+        return self._remote_dungeon_write(self.remote.remove_liker, dungeon_id=dungeon_id, user_id=user_id)
+
+    def add_view(self, dungeon_id : DungeonId) -> Union[dict, None]:
+        """
+        Abstraction to atomically add a view to a dungeon.
+        """
+        return self._remote_dungeon_write(self.remote.add_view, dungeon_id=dungeon_id)
+
+    def random_dungeons(self, *, amount : int = 1) -> list[dict]:
+        """
+        Abstraction to select random dungeons. Always asks the remote abstraction.
+        """
+        self.flush()
+        return [_strip(data) for data in self.remote.random_dungeons(amount=amount)]
+
+    def sorted_dungeons(
+        self,
+        *,
+        amount : int = 20,
+        offset : int = 0,
+        field : str = "score",
+        aggregation : list[dict] = None,
+        after : tuple[Any, DungeonId] = None
+    ) -> list[dict]:
+        """
+        Abstraction to select the best dungeons by a field. Always asks the remote abstraction.
+        """
+        self.flush()
+        return [_strip(data) for data in self.remote.sorted_dungeons(amount=amount, offset=offset, field=field, aggregation=aggregation, after=after)]
+
+    def refresh_owner_names(self) -> int:
+        """
+        Abstraction to refresh the stored owner names of all dungeons. Drops the local copies of dungeons.
+        """
+        self.flush()
+        updated = self.remote.refresh_owner_names()
+        self.local.clear("dungeons")
+        return updated
+
+    def select_room_content(self, content_hash : str) -> dict:
+        """
+        Abstraction to select stored room content by its hash. Content never changes under its hash, so local copies don't expire.
+        """
+        entry = self.local.get("room_contents", content_hash)
+        if entry is not None:
+            self.stats.hits += 1
+            return entry.data
+        self.stats.misses += 1
+        data = _strip(self.remote.select_room_content(content_hash))
+        self.local.put("room_contents", content_hash, data, version=0)
+        return data
+
+    def select_room_contents(self, content_hashes : list[str]) -> list[dict]:
+        """
+        Abstraction to select stored room content by several hashes, fetching only the ones not stored locally.
+        """
+        found, missing = [], []
+        for content_hash in dict.fromkeys(content_hashes):
+            if (entry := self.local.get("room_contents", content_hash)) is not None:
+                self.stats.hits += 1
+                found.append(entry.data)
+            else:
+                self.stats.misses += 1
+                missing.append(content_hash)
+        if missing:
+            for data in self.remote.select_room_contents(missing):
+                data = _strip(data)
+                self.local.put("room_contents", data[CONTENT_HASH_FIELD], data, version=0)
+                found.append(data)
+        return found
+
+    def insert_room_content(self, *, data : dict = None):
+        """
+        Abstraction to store room content. It is always written through, because rooms written back later refer to it.
+        """
+        result = self.remote.insert_room_content(data=data)
+        self.local.put("room_contents", data[CONTENT_HASH_FIELD], data, version=0)
+        self.stats.writes += 1
+        return result
+
+    def add_room_transitions(self, *, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> int:
+        """
+        Abstraction to add counts of rooms entered after each other to the stats of dungeons.
+        """
+        for dungeon_id in transitions:
+            self._flush_key("dungeons", dungeon_id)
+        result = self.remote.add_room_transitions(transitions=transitions)
+        for dungeon_id in transitions:
+            self.local.delete("dungeons", dungeon_id)
+        return result
+
+    def flush(self) -> int:
+        """
+        Write back all pending writes now. Returns the amount of operations written.
+        """
+        if self.write_queue is None:
+            return 0
+        return self.write_queue.flush()
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.remote, attr)
+
+    def _fresh(self, entry : LocalEntry) -> bool:
+        return entry.dirty or self.max_age is None or time.time() - entry.stored_at < self.max_age
+
+    def _select(self, collection : str, key : Any, fields : Union[dict, None], fetch) -> dict:
+        if key is not None and not fields:
+            entry = self.local.get(collection, key)
+            if entry is not None and self._fresh(entry):
+                self.stats.hits += 1
+                return entry.data
+            if entry is not None:
+                self.stats.expirations += 1
+            self.stats.misses += 1
+            return self._fetched(collection, fetch(key, fields=None), entry)
+        if self.write_queue is not None:
+            query = {**(fields or {}), **({KEY_FIELDS[collection]: key} if key is not None else {})}
+            for data in self.local.dirty(collection):
+                if all(data.get(name) == value for name, value in query.items()):
+                    return data
+        self.stats.misses += 1
+        return self._fetched(collection, fetch(key, fields=fields))
+
+    def _select_many(self, collection : str, keys : list, fields : Union[dict, None], fetch) -> list[dict]:
+        if fields:
+            self.flush()
+            return [self._fetched(collection, data) for data in fetch(keys, fields=fields)]
+        found, missing, expired = [], [], {}
+        for key in keys:
+            entry = self.local.get(collection, key)
+            if entry is not None and self._fresh(entry):
+                self.stats.hits += 1
+                found.append(entry.data)
+                continue
+            if entry is not None:
+                self.stats.expirations += 1
+                expired[key] = entry
+            self.stats.misses += 1
+            missing.append(key)
+        if missing:
+            key_field = KEY_FIELDS[collection]
+            found.extend(self._fetched(collection, data, expired.get(data.get(key_field))) for data in fetch(missing, fields=None))
+        return found
+
+    def _fetched(self, collection : str, data : dict, entry : LocalEntry = None) -> dict:
+        """
+        Store a document fetched from the remote abstraction, unless the local copy is newer because it wasn't written back yet.
+        """
+        data = dict(data)
+        version = data.pop(VERSION_FIELD, 0)
+        key = data.get(KEY_FIELDS[collection])
+        if entry is None:
+            entry = self.local.get(collection, key)
+        if entry is not None:
+            if entry.dirty and entry.version > version:
+                return entry.data
+            if version > entry.version:
+                self.stats.stale += 1
+        self.local.put(collection, key, data, version=version)
+        return data
+
+    def _insert(self, collection : str, data : dict, insert):
+        key = data[KEY_FIELDS[collection]]
+        stamped = {**data, VERSION_FIELD: 1}
+        if self.write_queue is not None:
+            self._store_write(collection, key, stamped, version=1, insert=True)
+            return None
+        result = insert(data=stamped)
+        self._store_write(collection, key, stamped, version=1)
+        return result
+
+    def _update(self, collection : str, key : Any, fields : Union[dict, None], updator : dict, update):
+        if key is None or fields or set(updator) != {"$set"}:
+            # Only setting fields of a document found by its key can be applied locally.
+            if key is not None:
+                self._flush_key(collection, key)
+                result = update(key, fields=fields, updator=updator)
+                self.local.delete(collection, key)
+                return result
+            self.flush()
+            result = update(key, fields=fields, updator=updator)
+            self.local.clear(collection)
+            return result
+        changes = self._stamp_update(collection, key, updator["$set"])
+        if self.write_queue is not None:
+            return None
+        try:
+            return update(key, updator={"$set": changes})
+        except BaseException:
+            self.local.delete(collection, key)
+            raise
+
+    def _stamp_update(self, collection : str, key : Any, changes : dict, additions : dict[str, list] = None) -> Union[dict, None]:
+        """
+        Apply set fields and additions to lists to the local copy and stamp them with its next version.
+        Returns the changes to send to the remote abstraction with the additions, or None if they were queued to be written back.
+        """
+        with self._lock:
+            entry = self.local.get(collection, key)
+            if entry is None:
+                # Without a local copy there is no version to continue from, so the write isn't stamped.
+                if self.write_queue is not None:
+                    self.write_queue.update(collection, KEY_FIELDS[collection], key, changes, additions)
+                    self.stats.writes += 1
+                    return None
+                self.stats.writes += 1
+                return dict(changes)
+            version = entry.version + 1
+            data = {**entry.data, **changes}
+            for name, items in (additions or {}).items():
+                data[name] = [*data.get(name, ()), *(item for item in items if item not in data.get(name, ()))]
+            self.local.put(collection, key, data, version=version, dirty=self.write_queue is not None)
+            self.stats.writes += 1
+        stamped = {**changes, VERSION_FIELD: version}
+        if self.write_queue is not None:
+            self.write_queue.update(collection, KEY_FIELDS[collection], key, stamped, additions)
+            return None
+        return stamped
+
+    def _store_write(self, collection : str, key : Any, data : dict, *, version : int, insert : bool = False):
+        with self._lock:
+            self.local.put(collection, key, _strip(data), version=version, dirty=self.write_queue is not None)
+            self.stats.writes += 1
+        if self.write_queue is not None and insert:
+            self.write_queue.insert(collection, KEY_FIELDS[collection], data)
+
+    def _remote_dungeon_write(self, write, *, dungeon_id : DungeonId, **kwargs) -> Union[dict, None]:
+        self._flush_key("dungeons", dungeon_id)
+        result = write(dungeon_id=dungeon_id, **kwargs)
+        self.local.delete("dungeons", dungeon_id)
+        return result
+
+    def _flush_key(self, collection : str, key : Any):
+        if self.write_queue is not None and self.write_queue.is_pending(collection, key):
+            self.write_queue.flush()
+
+    def _write_back(self, operations : list[WriteOperation]):
+        try:
+            self.remote.bulk_write(operations=operations)
+        except PartialWriteError as e:
+            failed_ids = {id(operation) for operation in e.failed}
+            self._mark_written([operation for operation in operations if id(operation) not in failed_ids])
+            raise
+        self._mark_written(operations)
+
+    def _mark_written(self, operations : list[WriteOperation]):
+        for operation in operations:
+            if VERSION_FIELD in operation.data:
+                self.local.mark_clean(operation.collection, operation.key, operation.data[VERSION_FIELD])
+
+
+def _strip(data : dict) -> dict:
+    if VERSION_FIELD in data:
+        data = dict(data)
+        del data[VERSION_FIELD]
+    return data
@@ -0,0 +1,86 @@
+"""
+Submodule for using synchronous database abstractions from coroutines.
+"""
+from __future__ import annotations
+import asyncio, functools
+from concurrent.futures import Executor
+from typing import Any, Union
+from .dmtypes import BaseAsyncDatabaseAbstraction, BaseDatabaseAbstraction, UserId, DungeonId, RoomId
+from .unit_of_work import WriteOperation
+
+
+class ThreadedDatabaseAbstraction(BaseAsyncDatabaseAbstraction):
+    """
+    Class for running the calls of a synchronous database abstraction in worker threads.
+    """
+    database_abstraction : BaseDatabaseAbstraction
+    executor : Union[Executor, None]
+
+    def __init__(self, database_abstraction : BaseDatabaseAbstraction, *, executor : Executor = None):
+        self.database_abstraction = database_abstraction
+        self.executor = executor
+
+    async def call(self, name : str, *args, **kwargs) -> Any:
+        """
+        Run a method of the wrapped abstraction in a worker thread.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(getattr(self.database_abstraction, name), *args, **kwargs))
+
+    async def select_user(self, user_id : UserId = None, *, fields : dict = None) -> dict:
+        return await self.call("select_user", user_id, fields=fields)
+
+    async def select_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None) -> dict:
+        return await self.call("select_dungeon", dungeon_id, fields=fields)
+
+    async def select_room(self, room_id : RoomId = None, *, fields : dict = None) -> dict:
+        return await self.call("select_room", room_id, fields=fields)
+
+    async def select_users(self, user_ids : list[UserId], *, fields : dict = None) -> list[dict]:
+        return await self.call("select_users", user_ids, fields=fields)
+
+    async def select_dungeons(self, dungeon_ids : list[DungeonId], *, fields : dict = None) -> list[dict]:
+        return await self.call("select_dungeons", dungeon_ids, fields=fields)
+
+    async def select_rooms(self, room_ids : list[RoomId], *, fields : dict = None) -> list[dict]:
+        return await self.call("select_rooms", room_ids, fields=fields)
+
+    async def bulk_write(self, *, operations : list[WriteOperation]):
+        return await self.call("bulk_write", operations=operations)
+
+    async def add_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        return await self.call("add_liker", dungeon_id, user_id)
+
+    async def remove_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        return await self.call("remove_liker", dungeon_id, user_id)
+
+    async def add_view(self, dungeon_id : DungeonId) -> Union[dict, None]:
+        return await self.call("add_view", dungeon_id)
+
+    async def random_dungeons(self, *, amount : int = 1) -> list[dict]:
+        return await self.call("random_dungeons", amount=amount)
+
+    async def sorted_dungeons(
+        self,
+        *,
+        amount : int = 20,
+        offset : int = 0,
+        field : str = "score",
+        aggregation : list[dict] = None,
+        after : tuple[Any, DungeonId] = None
+    ) -> list[dict]:
+        return await self.call("sorted_dungeons", amount=amount, offset=offset, field=field, aggregation=aggregation, after=after)
+
+    async def refresh_owner_names(self) -> int:
+        return await self.call("refresh_owner_names")
+
+    async def select_room_content(self, content_hash : str) -> dict:
+        return await self.call("select_room_content", content_hash)
+
+    async def select_room_contents(self, content_hashes : list[str]) -> list[dict]:
+        return await self.call("select_room_contents", content_hashes)
+
+    async def insert_room_content(self, *, data : dict = None):
+        return await self.call("insert_room_content", data=data)
+
+    async def add_room_transitions(self, *, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> int:
+        return await self.call("add_room_transitions", transitions=transitions)
@@ -0,0 +1,374 @@
+"""
+Submodule for asyncio sessions.
+"""
+from __future__ import annotations
+import asyncio, random, warnings, traceback
+from typing import AsyncContextManager, Literal, Mapping, Sequence, Union, assert_never
+from . import dungeon, user, room
+from .session import DMSession, COLLECTIONS, LOCK_NAMESPACES
+from .feeds import TabFeedCache, POPULAR_TAB, NEWEST_TAB, DEFAULT_TAB, TAB_SORT_FIELDS
+from .locks import AsyncLockTable
+from .metrics import MetricsRegistry, TimedDatabaseAbstraction
+from .pagination import decode_cursor
+from .content import CONTENT_HASH_FIELD, unpack_content
+from .dmtypes import DungeonId, RoomId, UserId, BaseAsyncDatabaseAbstraction, BaseDungeonUser
+from .selectors import DUNGEON, ROOM, USER
+
+
+class AsyncDMSession(DMSession):
+    """
+    Class for Dungeon Maker sessions doing their database calls as coroutines.
+    It shares the caches of DMSession, but find, flush and the tab methods have to be awaited.
+    Writing objects only queues their changes, which are sent by awaiting flush or write.
+    """
+    database_abstraction : BaseAsyncDatabaseAbstraction
+    async_locks : AsyncLockTable
+    _flush_lock : asyncio.Lock
+    _flusher : Union[asyncio.Task, None]
+
+    def __init__(
+        self,
+        *,
+        database_abstraction : BaseAsyncDatabaseAbstraction,
+        cache_capacity : Union[int, Mapping[str, Union[int, None]], None] = None,
+        cache_ttl : Union[float, None] = 300,
+        flush_interval : float = 0.05,
+        flush_size : int = 100,
+        feed_size : int = 100,
+        feed_refresh_interval : float = 60,
+        metrics : Union[MetricsRegistry, None] = None
+    ):
+        super().__init__(cache_capacity=cache_capacity, cache_ttl=cache_ttl, write_behind=True, flush_interval=flush_interval, flush_size=flush_size)
+        assert isinstance(database_abstraction, BaseAsyncDatabaseAbstraction)
+        self.database_abstraction = database_abstraction
+        self.metrics = metrics
+        if metrics is not None:
+            self.database_abstraction = TimedDatabaseAbstraction(database_abstraction, metrics=metrics)
+        self.tab_feeds = TabFeedCache(
+            loaders={
+                POPULAR_TAB: lambda size: self.load_feed(size),
+                NEWEST_TAB: lambda size: self.load_feed(size, field="creation_time", aggregation=[]),
+                DEFAULT_TAB: lambda size: self.load_feed(size, aggregation=[{"$sample": {"size": size}}]),
+            },
+            size=feed_size,
+            refresh_interval=feed_refresh_interval
+        )
+        self.async_locks = AsyncLockTable()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+
+    def add_database_abstraction(self, dba):
+        """
+        Not supported, pass the database abstraction to the constructor.
+        """
+        raise NotImplementedError("AsyncDMSession uses a single asynchronous database abstraction.")
+
+    async def start(self):
+        """
+        Start flushing queued writes in the background.
+        """
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def close(self):
+        """
+        Stop flushing in the background and write everything that is still pending.
+        """
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        self._flusher = None
+        await self.flush()
+
+    def locked(self, *objects : tuple[Literal["dungeon", "room", "user", "username", "linked_user"], Union[DungeonId, RoomId, UserId, str]]) -> AsyncContextManager[None]:
+        """
+        Serialize access to objects given as (type, id) pairs between coroutines.
+        """
+        return self.async_locks.lock_all(*((LOCK_NAMESPACES[__type], __id) for __type, __id in objects))
+
+    async def flush(self, __type : Literal["dungeon", "room", "user"] = None, __id : Union[DungeonId, RoomId, UserId] = None) -> int:
+        """
+        Write queued writes now. If a type and id are given, only flush if that object has queued writes.
+        """
+        if __type is not None and not self.write_queue.is_pending(COLLECTIONS[__type], __id):
+            return 0
+        async with self._flush_lock:
+            await self.flush_room_contents()
+            operations = self.write_queue.take()
+            if not operations:
+                return 0
+            try:
+                await self.database_abstraction.bulk_write(operations=operations)
+            except Exception as e:
+                self.write_queue.settle_failure(operations, e)
+                raise
+            self.write_queue.record_flush(operations)
+            return len(operations)
+
+    async def flush_room_contents(self):
+        """
+        Store queued room content.
+        """
+        while self._pending_contents:
+            with self._contents_lock:
+                digest, document = next(iter(self._pending_contents.items()))
+            await self.database_abstraction.insert_room_content(data=document)
+            with self._contents_lock:
+                self._pending_contents.pop(digest, None)
+            self.room_contents.stats.record(document)
+
+    async def load_room_content(self, data : dict) -> dict:
+        """
+        Replace the content hash of a room document by the content. Documents with inline content are returned as they are.
+        """
+        if CONTENT_HASH_FIELD not in data:
+            return data
+        data = dict(data)
+        digest = data.pop(CONTENT_HASH_FIELD)
+        if (content := self.room_contents.get(digest)) is None:
+            document = await self.database_abstraction.select_room_content(digest)
+            content = unpack_content(document)
+            self.room_contents.stored(document, content)
+        data["content"] = content
+        return data
+
+    async def load_room_contents(self, documents : list[dict]) -> list[dict]:
+        """
+        Replace the content hashes of several room documents by the content, fetching all missing content with one query.
+        """
+        missing = {data[CONTENT_HASH_FIELD] for data in documents if CONTENT_HASH_FIELD in data and self.room_contents.get(data[CONTENT_HASH_FIELD]) is None}
+        if missing:
+            for document in await self.database_abstraction.select_room_contents(content_hashes=list(missing)):
+                self.room_contents.stored(document)
+        return [await self.load_room_content(data) for data in documents]
+
+    async def write(self, *objects : Union[dungeon.Dungeon, room.Room, user.User]):
+        """
+        Write objects and send their changes.
+        """
+        for __object in objects:
+            __object.write()
+        await self.flush()
+
+    async def like(self, __dungeon : dungeon.Dungeon, __user : user.User) -> bool:
+        """
+        Register a like. Returns whether the like was new.
+        """
+        if __dungeon.new:
+            return __dungeon.like(__user)
+        await self.flush(DUNGEON, __dungeon.dungeon_id)
+        counts = await self.database_abstraction.add_liker(dungeon_id=__dungeon.dungeon_id, user_id=__user.user_id)
+        if counts is None:
+            return False
+        __dungeon.likers.append(__user.user_id)
+        __dungeon.apply_counts(counts)
+        return True
+
+    async def unlike(self, __dungeon : dungeon.Dungeon, __user : user.User) -> bool:
+        """
+        Register an unlike. Returns whether there was a like to remove.
+        """
+        if __dungeon.new:
+            return __dungeon.unlike(__user)
+        await self.flush(DUNGEON, __dungeon.dungeon_id)
+        counts = await self.database_abstraction.remove_liker(dungeon_id=__dungeon.dungeon_id, user_id=__user.user_id)
+        if counts is None:
+            return False
+        try:
+            __dungeon.likers.remove(__user.user_id)
+        except ValueError:
+            pass
+        __dungeon.apply_counts(counts)
+        return True
+
+    async def view(self, __dungeon : dungeon.Dungeon):
+        """
+        Register a view.
+        """
+        if __dungeon.new:
+            return __dungeon.view()
+        await self.flush(DUNGEON, __dungeon.dungeon_id)
+        counts = await self.database_abstraction.add_view(dungeon_id=__dungeon.dungeon_id)
+        __dungeon.apply_counts(counts or {"views": __dungeon.views + 1})
+
+    async def get_dungeon_user(self, __dungeon : dungeon.Dungeon, username : str) -> BaseDungeonUser:
+        """
+        Get a user of a dungeon by name.
+        """
+        return __dungeon.get_user(user_id=(await self.find(USER, name=username)).user_id)
+
+    async def get_popular_tab(self, *, offset : int = 0, amount : int = 20, after : str = None) -> list[dungeon.Dungeon]:
+        """
+        Get a default of 20 dungeons with no offset from the most popular dungeons.
+        """
+        return await self.get_sorted_tab(POPULAR_TAB, offset=offset, amount=amount, after=after)
+
+    async def get_random_tab(self, *, offset : int = 0, amount : int = 20) -> list[dungeon.Dungeon]:
+        """
+        Get a default of 20 dungeons of random dungeons.
+        """
+        return await self.hydrate_dungeons(await self.database_abstraction.random_dungeons(amount=amount))
+
+    async def get_default_tab(self, *, offset : int = 0, amount : int = 20) -> list[dungeon.Dungeon]:
+        """
+        Get a default of 20 dungeons of random dungeons.
+        """
+        if 3 * amount <= self.tab_feeds.size:
+            return await self.get_dungeons(await self.tab_feeds.sample_async(DEFAULT_TAB, amount=amount))
+        data = await self.hydrate_dungeons(await self.database_abstraction.sorted_dungeons(amount=3*amount, aggregation=[{"$sample": {"size": amount * 3}}]))
+        return data[:amount // 2] + random.sample(data[amount // 2:], min(len(data[amount // 2:]), amount - amount // 2))
+
+    async def get_newest_tab(self, *, offset : int = 0, amount : int = 20, after : str = None) -> list[dungeon.Dungeon]:
+        """
+        Get a default of 20 dungeons of the newest dungeons.
+        """
+        return await self.get_sorted_tab(NEWEST_TAB, offset=offset, amount=amount, after=after)
+
+    async def get_sorted_tab(self, tab : str, *, offset : int = 0, amount : int = 20, after : str = None) -> list[dungeon.Dungeon]:
+        """
+        Get a page of a sorted tab, starting behind the cursor token after if one is given.
+        """
+        cursor = decode_cursor(after) if after else None
+        if cursor is None:
+            dungeon_ids = await self.tab_feeds.page_async(tab, offset=offset, amount=amount)
+        else:
+            dungeon_ids = await self.tab_feeds.page_after_async(tab, cursor[1], offset=offset, amount=amount)
+        if dungeon_ids is not None:
+            return await self.get_dungeons(dungeon_ids)
+        return await self.hydrate_dungeons(await self.database_abstraction.sorted_dungeons(offset=offset, amount=amount, field=TAB_SORT_FIELDS[tab], aggregation=[], after=cursor))
+
+    async def search_for_term(self, term : str, *, amount : int = 10) -> list[dungeon.Dungeon]:
+        """
+        Searches for terms.
+        """
+        aggregator = [{"$search": {"index": "namesearch", "text": {"query": term, "path": {"wildcard": "*"}, "fuzzy": {"maxEdits": 2, "maxExpansions": 2}}}}]
+        return await self.hydrate_dungeons(await self.database_abstraction.sorted_dungeons(amount=amount, field="score", aggregation=aggregator))
+
+    async def hydrate_dungeons(self, dungeon_datas : Sequence[dict]) -> list[dungeon.Dungeon]:
+        """
+        Build dungeons from their documents, resolving all missing owner names with a single query.
+        """
+        dungeon_datas = list(dungeon_datas)
+        missing_owners = {
+            dungeon_data["owner"]
+            for dungeon_data in dungeon_datas
+            if dungeon_data.get("owner_name") is None and not self.lookup_cache("dungeons", dungeon_data["dungeon_id"]) and not self.lookup_cache("users", dungeon_data["owner"])
+        }
+        if missing_owners:
+            for user_data in await self.database_abstraction.select_users(user_ids=list(missing_owners)):
+                __user = user.User(**user_data, session=self)
+                if not self.lookup_cache("users", __user.user_id):
+                    self.cache_user(__user)
+        dungeons = []
+        for dungeon_data in dungeon_datas:
+            if (value := self.lookup_cache("dungeons", dungeon_data["dungeon_id"])):
+                dungeons.append(value)
+                continue
+            if dungeon_data.get("owner_name") is None:
+                owner = self.lookup_cache("users", dungeon_data["owner"])
+                dungeon_data["owner_name"] = owner.username if owner else ""
+            __dungeon = dungeon.Dungeon(**dungeon_data, session=self)
+            self.save_cache("dungeons", __dungeon.dungeon_id, __dungeon)
+            dungeons.append(__dungeon)
+        return dungeons
+
+    async def get_dungeons(self, dungeon_ids : Sequence[DungeonId]) -> list[dungeon.Dungeon]:
+        """
+        Get several dungeons in the given order, loading all uncached ones with a single query.
+        """
+        found = {dungeon_id: value for dungeon_id in dungeon_ids if (value := self.lookup_cache("dungeons", dungeon_id))}
+        if (missing := [dungeon_id for dungeon_id in dungeon_ids if dungeon_id not in found]):
+            for __dungeon in await self.hydrate_dungeons(await self.database_abstraction.select_dungeons(dungeon_ids=missing)):
+                found[__dungeon.dungeon_id] = __dungeon
+        return [found[dungeon_id] for dungeon_id in dungeon_ids if dungeon_id in found]
+
+    async def dungeon_ids(self, dungeon_datas : Sequence[dict]) -> list[DungeonId]:
+        """
+        Hydrate dungeon documents into the cache and return their ids.
+        """
+        return [__dungeon.dungeon_id for __dungeon in await self.hydrate_dungeons(dungeon_datas)]
+
+    async def load_feed(self, size : int, **kwargs) -> list[DungeonId]:
+        """
+        Load the dungeon ids of a tab feed, passing kwargs on to sorted_dungeons.
+        """
+        return await self.dungeon_ids(await self.database_abstraction.sorted_dungeons(amount=size, **kwargs))
+
+    async def refresh_owner_names(self) -> int:
+        """
+        Maintenance job that rewrites the stored owner name of every dungeon from its owner's current username.
+        """
+        updated = await self.database_abstraction.refresh_owner_names()
+        self._cached["dungeons"].clear()
+        return updated
+
+    async def find_linked_user(self, linked_user : str) -> user.User:
+        """
+        Find the user that linked a certain scratch account.
+        """
+        if (value := self.lookup_user_cache("linked_user", linked_user)):
+            return value
+        __user = user.User(**await self.database_abstraction.select_user(fields={"linked_user": linked_user}), session=self)
+        if (value := self.lookup_cache("users", __user.user_id)):
+            return value
+        self.cache_user(__user)
+        return __user
+
+    async def find_rooms(self, room_ids : Sequence[RoomId]) -> list[room.Room]:
+        """
+        Find several rooms with one query for the rooms not cached and one for their content. Rooms that don't exist are left out.
+        """
+        found = {}
+        for room_id in room_ids:
+            if (value := self.lookup_cache("rooms", room_id)):
+                found[room_id] = value
+        if (missing := [room_id for room_id in dict.fromkeys(room_ids) if room_id not in found]):
+            for data in await self.load_room_contents(await self.database_abstraction.select_rooms(room_ids=missing)):
+                __room = room.Room(**data, session=self)
+                if (value := self.lookup_cache("rooms", __room.room_id)):
+                    __room = value
+                else:
+                    self.save_cache("rooms", __room.room_id, __room)
+                found[__room.room_id] = __room
+        return [found[room_id] for room_id in room_ids if room_id in found]
+
+    async def find(self, __type : Literal["dungeon", "room", "user"], __id : Union[DungeonId, RoomId, UserId] = None, *, name : str = None) -> Union[dungeon.Dungeon, room.Room, user.User]:
+        """
+        Finds something.
+        """
+        if __type == DUNGEON:
+            if (value := self.lookup_cache("dungeons", __id)):
+                return value
+            return (await self.hydrate_dungeons([await self.database_abstraction.select_dungeon(dungeon_id=__id)]))[0]
+        if __type == ROOM:
+            if (value := self.lookup_cache("rooms", __id)):
+                return value
+            __room = room.Room(**await self.load_room_content(await self.database_abstraction.select_room(room_id=__id)), session=self)
+            if (value := self.lookup_cache("rooms", __id)):
+                return value
+            self.save_cache("rooms", __id, __room)
+            return __room
+        if __type == USER:
+            if __id is None:
+                value = self.lookup_user_cache("username", name)
+            elif (value := self.lookup_cache("users", __id)) and name is not None and value.username != name:
+                value = None
+            if value:
+                return value
+            __user = user.User(**await self.database_abstraction.select_user(user_id=__id, fields={"username": name} if name else {}), session=self)
+            if (value := self.lookup_cache("users", __user.user_id)):
+                return value
+            self.cache_user(__user)
+            return __user
+        assert_never(__type)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.write_queue.interval)
+            try:
+                await self.flush()
+            except Exception:
+                warnings.warn(f"Couldn't flush pending writes, retrying: \n{traceback.format_exc()}", RuntimeWarning)
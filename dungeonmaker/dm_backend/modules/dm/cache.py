@@ -0,0 +1,154 @@
+"""
+Submodule for the session cache.
+"""
+from __future__ import annotations
+import time, threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Union
+from dataclasses import dataclass, field
+
+
+@dataclass(slots=True)
+class CacheStats:
+    """
+    Class for cache statistics.
+    """
+    hits : int = field(kw_only=True, default=0)
+    misses : int = field(kw_only=True, default=0)
+    evictions : int = field(kw_only=True, default=0)
+    expirations : int = field(kw_only=True, default=0)
+
+    def to_object(self) -> dict:
+        """
+        Convert to an object.
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations}
+
+
+class IdentityMap:
+    """
+    Class for a bounded identity map with LRU eviction and an optional TTL.
+    Objects are held by strong references so they survive between requests.
+    """
+    capacity : Union[int, None]
+    ttl : Union[float, None]
+    stats : CacheStats
+    on_evict : Union[Callable[[Hashable, Any], None], None]
+    _entries : OrderedDict[Hashable, tuple[Any, float]]
+    _lock : threading.RLock
+
+    def __init__(self, *, capacity : Union[int, None] = 1024, ttl : Union[float, None] = None, on_evict : Union[Callable[[Hashable, Any], None], None] = None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, __key : Hashable, __default : Any = None) -> Any:
+        """
+        Get an object and mark it as recently used.
+        """
+        with self._lock:
+            try:
+                value, stored_at = self._entries[__key]
+            except KeyError:
+                self.stats.misses += 1
+                return __default
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._entries[__key]
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                self._evicted(__key, value)
+                return __default
+            self._entries.move_to_end(__key)
+            self.stats.hits += 1
+            return value
+
+    def peek(self, __key : Hashable, __default : Any = None) -> Any:
+        """
+        Get an object without marking it as recently used or counting a hit or miss.
+        """
+        with self._lock:
+            try:
+                value, stored_at = self._entries[__key]
+            except KeyError:
+                return __default
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                return __default
+            return value
+
+    def put(self, __key : Hashable, __value : Any):
+        """
+        Store an object and evict the least recently used ones if needed.
+        """
+        with self._lock:
+            self._entries[__key] = (__value, time.monotonic())
+            self._entries.move_to_end(__key)
+            if self.capacity is None:
+                return
+            while len(self._entries) > self.capacity:
+                key, (value, _) = self._entries.popitem(last=False)
+                self.stats.evictions += 1
+                self._evicted(key, value)
+
+    def pop(self, __key : Hashable, __default : Any = None) -> Any:
+        """
+        Remove an object.
+        """
+        with self._lock:
+            entry = self._entries.pop(__key, None)
+            if entry is None:
+                return __default
+            self._evicted(__key, entry[0])
+            return entry[0]
+
+    def clear(self):
+        """
+        Remove all objects.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+            self._entries.clear()
+            for key, (value, _) in entries:
+                self._evicted(key, value)
+
+    def prune(self) -> int:
+        """
+        Remove all expired objects. Returns the amount removed.
+        """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            expired = [(key, value) for key, (value, stored_at) in self._entries.items() if now - stored_at > self.ttl]
+            for key, value in expired:
+                del self._entries[key]
+                self.stats.expirations += 1
+                self._evicted(key, value)
+        return len(expired)
+
+    def _evicted(self, __key : Hashable, __value : Any):
+        if self.on_evict is not None:
+            self.on_evict(__key, __value)
+
+    def __contains__(self, __key : Hashable) -> bool:
+        return self.get(__key, _MISSING) is not _MISSING
+
+    def __getitem__(self, __key : Hashable) -> Any:
+        if (value := self.get(__key, _MISSING)) is _MISSING:
+            raise KeyError(__key)
+        return value
+
+    def __setitem__(self, __key : Hashable, __value : Any):
+        self.put(__key, __value)
+
+    def __delitem__(self, __key : Hashable):
+        if self.pop(__key, _MISSING) is _MISSING:
+            raise KeyError(__key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_MISSING = object()
@@ -0,0 +1,128 @@
+"""
+Submodule for storing room content compressed and addressed by its hash.
+"""
+from __future__ import annotations
+import zlib, hashlib, threading
+from typing import Union
+from dataclasses import dataclass, field
+from .cache import IdentityMap
+from .tiles import encode_room, decode_room
+
+CONTENT_HASH_FIELD = "content_hash"
+
+PACKED_CODECS : tuple[str, ...] = ("grid", "grid-zlib")
+
+
+@dataclass(slots=True)
+class ContentStats:
+    """
+    Class for statistics about stored room content. Sizes are of the encoded content.
+    """
+    stored : int = field(kw_only=True, default=0)
+    deduplicated : int = field(kw_only=True, default=0)
+    bytes_raw : int = field(kw_only=True, default=0)
+    bytes_stored : int = field(kw_only=True, default=0)
+    _lock : threading.Lock = field(init=False, repr=False, compare=False, default_factory=threading.Lock)
+
+    def record(self, document : dict):
+        """
+        Record content that was stored.
+        """
+        with self._lock:
+            self.stored += 1
+            self.bytes_raw += document["size"]
+            self.bytes_stored += len(document["data"])
+
+    def record_duplicate(self):
+        """
+        Record content that was already stored.
+        """
+        with self._lock:
+            self.deduplicated += 1
+
+    def to_object(self) -> dict:
+        """
+        Convert to an object.
+        """
+        return {"stored": self.stored, "deduplicated": self.deduplicated, "bytes_raw": self.bytes_raw, "bytes_stored": self.bytes_stored}
+
+
+def content_hash(content : str) -> str:
+    """
+    Get the hash content is stored under.
+    """
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def pack_content(content : str, *, digest : str = None, level : int = 6, min_size : int = 64) -> dict:
+    """
+    Build the document storing content. Content is encoded as a tile grid, which is compressed with zlib if that is smaller, unless it is small or doesn't get smaller.
+    The window is only as large as the content, as the default one makes zlib allocate hundreds of kilobytes per room.
+    """
+    raw = content.encode()
+    data, codec = raw, "raw"
+    if len(raw) >= min_size:
+        grid = encode_room(content)
+        if len(grid) < len(data):
+            data, codec = grid, "grid"
+        compressor = zlib.compressobj(level, zlib.DEFLATED, min(15, max(9, len(grid).bit_length())), 6)
+        compressed = compressor.compress(grid) + compressor.flush()
+        if len(compressed) < len(data):
+            data, codec = compressed, "grid-zlib"
+    return {CONTENT_HASH_FIELD: digest or hashlib.sha256(raw).hexdigest(), "codec": codec, "size": len(raw), "data": data}
+
+def unpack_content(document : dict) -> str:
+    """
+    Get the content stored in a document.
+    """
+    data = bytes(document["data"])
+    if document["codec"] == "grid":
+        return decode_room(data)
+    if document["codec"] == "grid-zlib":
+        return decode_room(zlib.decompress(data))
+    if document["codec"] == "zlib":
+        data = zlib.decompress(data)
+    elif document["codec"] != "raw":
+        raise ValueError(f"Unknown content codec {document['codec']}.")
+    return data.decode()
+
+
+class RoomContentStore:
+    """
+    Class for moving room content out of room documents. Rooms keep the hash of their content, so rooms with the same content share one stored copy.
+    Decompressed content is kept in an LRU by hash. Content in it is known to be stored, so saving it again needs no database call.
+    """
+    cache : IdentityMap
+    stats : ContentStats
+
+    def __init__(self, *, capacity : Union[int, None] = 1024):
+        self.cache = IdentityMap(capacity=capacity, ttl=None)
+        self.stats = ContentStats()
+
+    def externalize(self, data : dict) -> tuple[dict, Union[dict, None]]:
+        """
+        Replace the content of a room document or of its changes by the hash of the content.
+        Returns the new document and the content document to store, or None if there is nothing to store.
+        """
+        content = data.get("content")
+        if not isinstance(content, str):
+            return data, None
+        digest = content_hash(content)
+        data = {**data, "content": None, CONTENT_HASH_FIELD: digest}
+        if self.cache.get(digest) is not None:
+            self.stats.record_duplicate()
+            return data, None
+        return data, pack_content(content, digest=digest)
+
+    def stored(self, document : dict, content : str = None):
+        """
+        Remember content after its document was stored or loaded.
+        """
+        if content is None:
+            content = unpack_content(document)
+        self.cache.put(document[CONTENT_HASH_FIELD], content)
+
+    def get(self, digest : str) -> Union[str, None]:
+        """
+        Get decompressed content if it is in the LRU.
+        """
+        return self.cache.get(digest)
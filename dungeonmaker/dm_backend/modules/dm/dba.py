@@ -2,204 +2,84 @@
 Submodule for database abstractions.
 """
 from __future__ import annotations
-from .dmtypes import UserId, DungeonId, RoomId, BaseDatabaseAbstraction
+from typing import Callable, Union
+from .dmtypes import BaseDatabaseAbstraction
+
+DATABASE_METHODS : tuple[str, ...] = tuple(
+    name for name, value in vars(BaseDatabaseAbstraction).items() if callable(value) and not name.startswith("_")
+)
 
 
-    
 class DatabaseAbstractionSelector(BaseDatabaseAbstraction):
     """
     Class for selecting a database abstraction.
+    Every method is resolved once to the first added abstraction overriding it, and the bound method is then called directly.
     """
     dbas : list[BaseDatabaseAbstraction]
+    dispatch_table : dict[str, Callable]
     
     def __init__(self, dbas : list[BaseDatabaseAbstraction]):
         self.dbas = dbas
+        self.dispatch_table = {}
+        self.rebuild()
         
-    def select_user(self, user_id : UserId = None, *, fields : dict = None) -> dict:
-        """
-        Automatically selects an abstraction to select a user.
-        """
-        for dba in self.dbas:
-            try:
-                return dba.select_user(user_id=user_id, fields=fields)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
-    
-    def select_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None) -> dict:
-        """
-        Automatically selects an abstraction to select a dungeon.
-        """
-        for dba in self.dbas:
-            try:
-                return dba.select_dungeon(dungeon_id=dungeon_id, fields=fields)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
-    
-    def select_room(self, room_id : RoomId = None, *, fields : dict = None) -> dict:
+    def add(self, dba : BaseDatabaseAbstraction):
         """
-        Automatically selects an abstraction to select a room.
+        Add a database abstraction and resolve the methods again.
         """
-        for dba in self.dbas:
-            try:
-                return dba.select_room(room_id=room_id, fields=fields)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
-    
-    def update_user(self, user_id : UserId = None, *, fields : dict = None, updator : dict = None):
-        """
-        Automatically selects an abstraction to update a user.
-        """
-        for dba in self.dbas:
-            try:
-                return dba.update_user(user_id=user_id, fields=fields, updator=updator)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
-    
-    def update_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None, updator : dict = None):
-        """
-        Automatically selects an abstraction to update a dungeon.
-        """
-        for dba in self.dbas:
-            try:
-                return dba.update_dungeon(dungeon_id=dungeon_id, fields=fields, updator=updator)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
-    
-    def update_room(self, room_id : RoomId = None, *, fields : dict = None, updator : dict = None):
+        assert isinstance(dba, BaseDatabaseAbstraction)
+        self.dbas.append(dba)
+        self.rebuild()
+        
+    def rebuild(self):
         """
-        Automatically selects an abstraction to update a room.
+        Resolve every method of the base database abstraction and bind the implementations on the selector, so calls skip the lookup.
         """
-        for dba in self.dbas:
-            try:
-                return dba.update_room(room_id=room_id, fields=fields, updator=updator)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
+        for name in self.dispatch_table:
+            self.__dict__.pop(name, None)
+        self.dispatch_table = {}
+        for name in DATABASE_METHODS:
+            if (method := self.resolve(name)) is not None:
+                self._bind(name, method)
     
-    def insert_user(self, *, data : dict = None):
+    def resolve(self, name : str) -> Union[Callable, None]:
         """
-        Automatically selects an abstraction to insert a user.
+        Get the bound method of the first abstraction actually implementing a method, or None if none does.
+        Methods the base database abstraction doesn't have may also be provided by an abstraction forwarding attributes.
         """
+        base = getattr(BaseDatabaseAbstraction, name, None)
         for dba in self.dbas:
-            try:
-                return dba.insert_user(data=data)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
+            implementation = getattr(type(dba), name, None)
+            if implementation is not None and implementation is not base:
+                return getattr(dba, name)
+            if base is None and (method := getattr(dba, name, None)) is not None:
+                return method
+        return None
     
-    def insert_dungeon(self, *, data : dict = None):
+    def missing(self) -> list[str]:
         """
-        Automatically selects an abstraction to insert a dungeon.
+        Get the methods of the base database abstraction no added abstraction implements.
         """
-        for dba in self.dbas:
-            try:
-                return dba.insert_dungeon(data=data)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
+        return [name for name in DATABASE_METHODS if name not in self.dispatch_table]
     
-    def insert_room(self, *, data : dict = None):
+    def validate(self, *names : str):
         """
-        Automatically selects an abstraction to insert a room.
+        Raise a NotImplementedError naming the methods no added abstraction implements. Defaults to every method of the base database abstraction.
         """
-        for dba in self.dbas:
-            try:
-                return dba.insert_room(data=data)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
+        missing = [name for name in names or DATABASE_METHODS if name not in self.dispatch_table and self.resolve(name) is None]
+        if missing:
+            raise NotImplementedError(f"No database abstraction implements {', '.join(missing)}")
     
-    def random_dungeons(self, *, amount : int = 1) -> list[dict]:
-        """
-        Automatically selects an abstraction to select random dungeons.
-        """
-        for dba in self.dbas:
-            try:
-                return dba.random_dungeons(amount=amount)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
-    
-    def sorted_dungeons(
-        self, 
-        *, 
-        amount : int = 20, 
-        offset : int = 0, 
-        field : str = "score", 
-        aggregation : list[dict] = [{"$addFields":{"score": {"$add": [{"$multiply": [20,{"$size": "$likers"},]},"$views"]}}}]
-    ) -> list[dict]:
-        """
-        Automatically selects an abstraction to select the best dungeons on your given instructions.
-        """
-        for dba in self.dbas:
-            try:
-                return dba.sorted_dungeons(amount=amount, offset=offset, field=field, aggregation=aggregation)
-            except NotImplementedError:
-                continue
-        raise NotImplementedError("No database abstraction capable of doing that was added")
+    def _bind(self, name : str, method : Callable):
+        self.dispatch_table[name] = method
+        self.__dict__[name] = method
     
     def __getattr__(self, attr):
-        def wrapper(*args, **kwargs):
-            """
-            Automatically selects an abstractions which can execute this function.
-            """
-            for dba in self.dbas:
-                try:
-                    return getattr(dba, attr)(*args, **kwargs)
-                except (NotImplementedError, TypeError):
-                    continue
-            raise NotImplementedError("No database abstraction capable of doing that was added")
-        wrapper.__name__ = attr
-        return wrapper
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-        
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        method = self.resolve(attr)
+        if method is None:
+            raise AttributeError(f"No database abstraction has {attr}")
+        if callable(method):
+            self._bind(attr, method)
+        return method
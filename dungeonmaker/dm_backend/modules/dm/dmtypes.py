@@ -6,6 +6,8 @@ from typing import Literal, Any, Union, Sequence, Mapping
 from weakref import WeakValueDictionary
 from dataclasses import dataclass, field
 import secrets, time
+from .tracking import Tracked
+from .unit_of_work import WriteOperation
 
 
 
@@ -37,6 +39,24 @@ class BaseDatabaseAbstraction:
         """
         raise NotImplementedError
     
+    def select_users(self, user_ids : list[UserId], *, fields : dict = None) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def select_dungeons(self, dungeon_ids : list[DungeonId], *, fields : dict = None) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def select_rooms(self, room_ids : list[RoomId], *, fields : dict = None) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
     def update_user(self, user_id : UserId = None, *, fields : dict = None, updator : dict = None):
         """
         Do not use.
@@ -73,6 +93,30 @@ class BaseDatabaseAbstraction:
         """
         raise NotImplementedError
     
+    def bulk_write(self, *, operations : list[WriteOperation]):
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def add_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def remove_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def add_view(self, dungeon_id : DungeonId) -> Union[dict, None]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
     def random_dungeons(self, *, amount : int = 1) -> list[dict]:
         """
         Do not use.
@@ -85,14 +129,160 @@ class BaseDatabaseAbstraction:
         amount : int = 20, 
         offset : int = 0,
         field : str = "score", 
-        aggregation : list[dict] = [{"$addFields":{"score": {"$add": [{"$multiply": [20,{"$size": "$likers"},]},"$views"]}}}]
+        aggregation : list[dict] = None,
+        after : tuple[Any, DungeonId] = None
     ) -> list[dict]:
         """
         Do not use.
         """
         raise NotImplementedError
+    
+    def refresh_owner_names(self) -> int:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def select_room_content(self, content_hash : str) -> dict:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def select_room_contents(self, content_hashes : list[str]) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def insert_room_content(self, *, data : dict = None):
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    def add_room_transitions(self, *, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> int:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+
 
 
+class BaseAsyncDatabaseAbstraction:
+    """
+    Base class for database abstractions whose methods are coroutines.
+    """
+    async def select_user(self, user_id : UserId = None, *, fields : dict = None) -> dict:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def select_dungeon(self, dungeon_id : DungeonId = None, *, fields : dict = None) -> dict:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def select_room(self, room_id : RoomId = None, *, fields : dict = None) -> dict:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def select_users(self, user_ids : list[UserId], *, fields : dict = None) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def select_dungeons(self, dungeon_ids : list[DungeonId], *, fields : dict = None) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def select_rooms(self, room_ids : list[RoomId], *, fields : dict = None) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def bulk_write(self, *, operations : list[WriteOperation]):
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def add_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def remove_liker(self, dungeon_id : DungeonId, user_id : UserId) -> Union[dict, None]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def add_view(self, dungeon_id : DungeonId) -> Union[dict, None]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def random_dungeons(self, *, amount : int = 1) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def sorted_dungeons(
+        self, 
+        *, 
+        amount : int = 20, 
+        offset : int = 0,
+        field : str = "score", 
+        aggregation : list[dict] = None,
+        after : tuple[Any, DungeonId] = None
+    ) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def refresh_owner_names(self) -> int:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def select_room_content(self, content_hash : str) -> dict:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def select_room_contents(self, content_hashes : list[str]) -> list[dict]:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def insert_room_content(self, *, data : dict = None):
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+    
+    async def add_room_transitions(self, *, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]) -> int:
+        """
+        Do not use.
+        """
+        raise NotImplementedError
+
 
 
 
@@ -128,7 +318,7 @@ class Permissions(list[Permission]):
         
     def can_edit_room(self, *, room_id : RoomId = None, room : BaseRoom = None):
         room_id = room_id or room.room_id
-        if self.get("edit_rooms"):
+        if self.get("edit_rooms").value:
             return True
         return any(i.value == room_id for i in self.get_all("edit_room"))
 
@@ -141,7 +331,7 @@ class Stats(dict):
 
 
 @dataclass(slots=True)
-class BaseRoom:
+class BaseRoom(Tracked):
     """
     Base class for rooms.
     """
@@ -150,7 +340,9 @@ class BaseRoom:
     content : Any = field(kw_only=True, default=None)
     new : bool = field(kw_only=True, default=True)
     _id : Any = field(kw_only=True, default=None)
+    _version : Any = field(kw_only=True, default=None, repr=False, compare=False)
     session : BaseDMSession = field(kw_only=True)
+    _snapshot : Union[dict, None] = field(kw_only=True, default=None, repr=False, compare=False)
 
 
 
@@ -170,7 +362,7 @@ class BaseDungeonUser:
 
 
 @dataclass(slots=True)
-class BaseUser:
+class BaseUser(Tracked):
     """
     Base class for users.
     """
@@ -182,7 +374,9 @@ class BaseUser:
     admin_level : int = field(kw_only=True, default=0)
     new : bool = field(kw_only=True, default=True)
     _id : Any = field(kw_only=True, default=None)
+    _version : Any = field(kw_only=True, default=None, repr=False, compare=False)
     session : BaseDMSession = field(kw_only=True)
+    _snapshot : Union[dict, None] = field(kw_only=True, default=None, repr=False, compare=False)
     passdata : bytes = field(kw_only=True)
     linked_user : Union[str, None] = field(kw_only=True, default=None)
     remaining_dungeons : int = field(kw_only=True, default=16)
@@ -192,7 +386,7 @@ class BaseUser:
 
 
 @dataclass(slots=True)
-class BaseDungeon:
+class BaseDungeon(Tracked):
     """
     Base class for dungeons.
     """
@@ -202,6 +396,7 @@ class BaseDungeon:
     permissions : dict[UserId, Permissions] = field(kw_only=True, default_factory=dict)
     views : int = field(kw_only=True, default=0)
     likers : list[UserId] = field(kw_only=True, default_factory=list)
+    like_count : int = field(kw_only=True, default=None)
     new : bool = field(kw_only=True, default=True)
     dungeon_id : DungeonId = field(kw_only=True, default_factory=lambda : secrets.randbits(32))
     name : str = field(kw_only=True)
@@ -209,8 +404,10 @@ class BaseDungeon:
     creation_time : float = field(kw_only=True, default_factory=time.time)
     update_time : float = field(kw_only=True, default_factory=time.time)
     _id : Any = field(kw_only=True, default=None)
+    _version : Any = field(kw_only=True, default=None, repr=False, compare=False)
     score : Any = field(kw_only=True, default=None)
     session : BaseDMSession = field(kw_only=True)
+    _snapshot : Union[dict, None] = field(kw_only=True, default=None, repr=False, compare=False)
     stats : Stats = field(kw_only=True, default_factory=Stats)
     start : tuple = field(kw_only=True)
 
@@ -228,7 +425,7 @@ class BaseDMSession:
         raise NotImplementedError
 
 
-    def get_popular_tab(self, *, offset : int = 0, amount : int = 20) -> list[BaseDungeon]:
+    def get_popular_tab(self, *, offset : int = 0, amount : int = 20, after : str = None) -> list[BaseDungeon]:
         """
         Get a default of 20 dungeons with no offset from the most popular dungeons.
         """
@@ -246,7 +443,7 @@ class BaseDMSession:
         """
         raise NotImplementedError
 
-    def get_newest_tab(self, *, offset : int = 0, amount : int = 20) -> list[BaseDungeon]:
+    def get_newest_tab(self, *, offset : int = 0, amount : int = 20, after : str = None) -> list[BaseDungeon]:
         """
         Get a default of 20 dungeons of the newest dungeons. 
         """
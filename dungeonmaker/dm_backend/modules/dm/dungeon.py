@@ -12,21 +12,30 @@ from .dmtypes import (
     RoomId, 
     Permission, 
     BaseDungeonUser, 
-    Permissions
+    Permissions,
+    Stats
 )
 from .room import Room
 from .user import User
 from . import room
 from . import session as _session
-from .utils import s_vars
-from .selectors import ROOM
+from .utils import s_vars, popularity_score, merge_transitions, TRANSITIONS_FIELD
+from .selectors import DUNGEON, ROOM, USER
+from .feeds import POPULAR_TAB
+
+ATOMIC_FIELDS : tuple[str, ...] = ("likers", "like_count", "views", "score", "stats")
 
 class Dungeon(BaseDungeon):
     """
     Class for dungeons.
     """
+    MERGED_FIELDS = ("rooms",)
+
     def __init__(self, *args, **kwargs):
-        kwargs.setdefault("permissions", {})
+        kwargs["permissions"] = {
+            user_id: Permissions(perm if isinstance(perm, Permission) else Permission(**perm) for perm in perms) 
+            for user_id, perms in kwargs.get("permissions", {}).items()
+        }
         kwargs["permissions"][kwargs["owner"]] = Permissions([
             Permission(type="read", value=True),
             Permission(type="edit_rooms", value=True),
@@ -34,55 +43,96 @@ class Dungeon(BaseDungeon):
             Permission(type="edit_permissions", value=True),
             Permission(type="permission_level", value=999),
         ])
-        kwargs["owner_name"] = User.read(kwargs["owner"], session=kwargs["session"]).username
         super().__init__(*args, **kwargs)
+        if self.like_count is None:
+            self.like_count = len(self.likers)
+        if self.score is None:
+            self.score = popularity_score(likes=self.likes, views=self.views)
     
     @property
     def likes(self) -> int:
         """
         Amount of likes.
         """
-        return len(self.likers)
+        return self.like_count
     
     def get_rooms(self) -> list[BaseRoom]:
         """
-        Get corresponding rooms.
+        Get corresponding rooms with a single query.
+        """
+        return self.session.find_rooms(self.rooms)
+    
+    def nearby_rooms(self, room_id : RoomId = None, *, radius : int = 4) -> list[RoomId]:
+        """
+        Get a room and the rooms next to it in the order of the dungeon, nearest first. Defaults to the start room.
+        """
+        if room_id is None:
+            room_id = self.start[0] if self.start else (self.rooms[0] if self.rooms else None)
+        if room_id not in self.rooms:
+            return [] if room_id is None else [room_id]
+        index = self.rooms.index(room_id)
+        nearby = [room_id]
+        for distance in range(1, radius + 1):
+            nearby.extend(self.rooms[position] for position in (index + distance, index - distance) if 0 <= position < len(self.rooms))
+        return nearby
+    
+    def transitions_from(self, room_id : RoomId) -> dict[RoomId, int]:
+        """
+        Get how often players entered each room right after a room.
         """
-        return [room.Room.read(room_id=room_id) for room_id in self.rooms]
+        return {int(to_room): count for to_room, count in self.stats.get(TRANSITIONS_FIELD, {}).get(str(room_id), {}).items()}
+    
+    def apply_transitions(self, counts : dict[RoomId, dict[RoomId, int]]):
+        """
+        Add transition counts that were written to the database. The stats are replaced instead of changed, as other threads may be reading them.
+        """
+        self.stats = Stats({**self.stats, TRANSITIONS_FIELD: merge_transitions(self.stats.get(TRANSITIONS_FIELD, {}), counts)})
     
     def get_user(self, username : str = None, *, user_id : UserId = None) -> BaseDungeonUser:
         """
         Get a user of the dungeon.
         """
-        user_id = user_id or User.lookup_user(username=username, session=self.session).user_id
+        user_id = user_id or self.session.find(USER, name=username).user_id
         permissions = self.permissions.get(user_id, Permissions([Permission(type="read", value=True)]))
         owner = self.owner == user_id
-        d_user = DungeonUser(user_id=user_id, permissions=permissions, owner=owner, dungeon=self)
-        self.permissions[user_id] = d_user
-        return d_user
+        return DungeonUser(user_id=user_id, permissions=permissions, owner=owner, dungeon=self)
         
     
     @classmethod
     def read(cls, dungeon_id : DungeonId, *, session : _session.DMSession) -> Self:
         """
-        Method for reading a dungeon.
+        Method for reading a dungeon. Documents written before owner_name was stored get it from their owner.
         """
         data = session.database_abstraction.select_dungeon(dungeon_id=dungeon_id)
-        return cls(**data)
+        if data.get("owner_name") is None:
+            data["owner_name"] = session.find(USER, data["owner"]).username
+        return cls(**data, session=session)
+    
+    def to_document(self) -> dict:
+        """
+        Convert to the document stored in the database.
+        """
+        data = s_vars(self)
+        data["new"] = False
+        data["permissions"] = {
+            user_id: [{"type": perm.type, "value": perm.value} for perm in perms] 
+            for user_id, perms in self.permissions.items()
+        }
+        return data
     
     def write(self):
         """
         Method for writing a dungeon.
         """
-        data = copy.deepcopy(s_vars(self))
-        data["new"] = False
-        for _, perms in (data["permissions"]).items():
-            perms[:] = [{"type": perm.type, "value": perm.value} for perm in perms]
-        if self.new:
-            self.new = False
-            self.session.database_abstraction.insert_dungeon(data=data)
-            return
-        self.session.database_abstraction.update_dungeon(dungeon_id=self.dungeon_id, updator={"$set": data})
+        new = self.new
+        self.write_document(
+            insert=lambda data: self.session.persist_insert(DUNGEON, data),
+            update=lambda changes, additions: self.session.persist_update(DUNGEON, self.dungeon_id, changes, additions),
+            stats=self.session.write_stats,
+            exclude=ATOMIC_FIELDS
+        )
+        if new:
+            self.session.tab_feeds.invalidate()
         
     def new_room(self, *, content : str = None, room_id : RoomId = None) -> Room:
         """
@@ -98,27 +148,62 @@ class Dungeon(BaseDungeon):
         """
         self.update_time = time.time()
         
-    def like(self, user : User):
+    def like(self, user : User) -> bool:
         """
-        Register a like.
+        Register a like. Returns whether the like was new.
         """
-        if user.user_id in self.likers:
-            return
+        if self.new:
+            if user.user_id in self.likers:
+                return False
+            self.likers.append(user.user_id)
+            self.apply_counts({"like_count": self.like_count + 1})
+            return True
+        self.session.flush(DUNGEON, self.dungeon_id)
+        counts = self.session.database_abstraction.add_liker(dungeon_id=self.dungeon_id, user_id=user.user_id)
+        if counts is None:
+            return False
         self.likers.append(user.user_id)
+        self.apply_counts(counts)
+        return True
         
-    def unlike(self, user : User):
-        """
-        Register an unlike.
-        """
-        if not user.user_id in self.likers:
-            return
-        self.likers.remove(user.user_id)
+    def unlike(self, user : User) -> bool:
+        """
+        Register an unlike. Returns whether there was a like to remove.
+        """
+        if not self.new:
+            self.session.flush(DUNGEON, self.dungeon_id)
+            counts = self.session.database_abstraction.remove_liker(dungeon_id=self.dungeon_id, user_id=user.user_id)
+            if counts is None:
+                return False
+        elif not user.user_id in self.likers:
+            return False
+        else:
+            counts = {"like_count": self.like_count - 1}
+        try:
+            self.likers.remove(user.user_id)
+        except ValueError:
+            pass
+        self.apply_counts(counts)
+        return True
         
     def view(self):
         """
         Register a view.
         """
-        self.views += 1
+        counts = {"views": self.views + 1}
+        if not self.new:
+            self.session.flush(DUNGEON, self.dungeon_id)
+            counts = self.session.database_abstraction.add_view(dungeon_id=self.dungeon_id) or counts
+        self.apply_counts(counts)
+        
+    def apply_counts(self, counts : dict):
+        """
+        Update the counters from the values returned by an atomic update.
+        """
+        self.like_count = counts.get("like_count", self.like_count)
+        self.views = counts.get("views", self.views)
+        self.score = counts.get("score", popularity_score(likes=self.likes, views=self.views))
+        self.session.tab_feeds.invalidate(POPULAR_TAB)
         
     def to_object(self) -> dict:
         """
@@ -134,6 +219,7 @@ class Dungeon(BaseDungeon):
         data.pop("stats")
         data.pop("start")
         data.pop("likers")
+        data.pop("like_count")
         data["likes"] = self.likes
         return data
         
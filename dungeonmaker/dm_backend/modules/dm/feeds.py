@@ -0,0 +1,201 @@
+"""
+Submodule for precomputed tab feeds.
+"""
+from __future__ import annotations
+import time, random, threading, warnings, traceback
+from typing import Awaitable, Callable, Literal, Union
+from dataclasses import dataclass, field
+from .dmtypes import DungeonId
+
+POPULAR_TAB : Literal["popular"] = "popular"
+NEWEST_TAB : Literal["new"] = "new"
+DEFAULT_TAB : Literal["random"] = "random"
+
+TAB_SORT_FIELDS : dict[str, str] = {
+    POPULAR_TAB: "score",
+    NEWEST_TAB: "creation_time",
+}
+
+
+@dataclass(slots=True)
+class TabFeed:
+    """
+    Class for a ranked list of dungeon ids.
+    """
+    dungeon_ids : list[DungeonId] = field(kw_only=True, default_factory=list)
+    positions : dict[DungeonId, int] = field(kw_only=True, default_factory=dict)
+    complete : bool = field(kw_only=True, default=True)
+    refreshed_at : float = field(kw_only=True, default=float("-inf"))
+    stale : bool = field(kw_only=True, default=True)
+
+
+class TabFeedCache:
+    """
+    Class for caching the ranked dungeon ids of every tab so pages can be served from memory.
+    Asynchronous sessions give loaders returning awaitables and use the methods ending in _async. They refresh inline instead of in a background thread.
+    """
+    loaders : dict[str, Callable[[int], Union[list[DungeonId], Awaitable[list[DungeonId]]]]]
+    size : int
+    refresh_interval : float
+    min_refresh_interval : float
+    _feeds : dict[str, TabFeed]
+    _lock : threading.Lock
+    _refresher : Union[threading.Thread, None]
+    _stop : threading.Event
+    _changed : threading.Event
+
+    def __init__(self, *, loaders : dict[str, Callable[[int], Union[list[DungeonId], Awaitable[list[DungeonId]]]]], size : int = 100, refresh_interval : float = 60, min_refresh_interval : float = 5):
+        self.loaders = dict(loaders)
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self._feeds = {tab: TabFeed() for tab in self.loaders}
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+        self._changed = threading.Event()
+
+    def page(self, tab : str, *, offset : int = 0, amount : int = 20) -> Union[list[DungeonId], None]:
+        """
+        Get the dungeon ids of a page, or None if the page lies outside of the cached feed.
+        """
+        return self._page(self.get_feed(tab), offset=offset, amount=amount)
+
+    def page_after(self, tab : str, dungeon_id : DungeonId, *, offset : int = 0, amount : int = 20) -> Union[list[DungeonId], None]:
+        """
+        Get the dungeon ids following a dungeon, or None if they lie outside of the cached feed.
+        """
+        return self._page_after(self.get_feed(tab), dungeon_id, offset=offset, amount=amount)
+
+    def sample(self, tab : str, *, amount : int = 20) -> list[DungeonId]:
+        """
+        Get a random mix of the feed, half from the best of a sample and half at random.
+        """
+        return self._sample(self.get_feed(tab), amount=amount)
+
+    async def page_async(self, tab : str, *, offset : int = 0, amount : int = 20) -> Union[list[DungeonId], None]:
+        """
+        Like page, for asynchronous loaders.
+        """
+        return self._page(await self.get_feed_async(tab), offset=offset, amount=amount)
+
+    async def page_after_async(self, tab : str, dungeon_id : DungeonId, *, offset : int = 0, amount : int = 20) -> Union[list[DungeonId], None]:
+        """
+        Like page_after, for asynchronous loaders.
+        """
+        return self._page_after(await self.get_feed_async(tab), dungeon_id, offset=offset, amount=amount)
+
+    async def sample_async(self, tab : str, *, amount : int = 20) -> list[DungeonId]:
+        """
+        Like sample, for asynchronous loaders.
+        """
+        return self._sample(await self.get_feed_async(tab), amount=amount)
+
+    def get_feed(self, tab : str) -> TabFeed:
+        """
+        Get the feed of a tab, refreshing it first if it is outdated.
+        """
+        feed = self._feeds[tab]
+        if self._outdated(feed):
+            feed = self.refresh(tab)
+        return feed
+
+    async def get_feed_async(self, tab : str) -> TabFeed:
+        """
+        Like get_feed, for asynchronous loaders.
+        """
+        feed = self._feeds[tab]
+        if self._outdated(feed):
+            feed = await self.refresh_async(tab)
+        return feed
+
+    def refresh(self, tab : str) -> TabFeed:
+        """
+        Reload the feed of a tab.
+        """
+        with self._lock:
+            feed = self._feeds[tab]
+            if not feed.stale and time.monotonic() - feed.refreshed_at < self.min_refresh_interval:
+                return feed
+            feed = self._feeds[tab] = self._build(self.loaders[tab](self.size))
+            return feed
+
+    async def refresh_async(self, tab : str) -> TabFeed:
+        """
+        Like refresh, for asynchronous loaders. Runs on the event loop, so it doesn't take the lock.
+        """
+        feed = self._feeds[tab]
+        if not feed.stale and time.monotonic() - feed.refreshed_at < self.min_refresh_interval:
+            return feed
+        feed = self._feeds[tab] = self._build(await self.loaders[tab](self.size))
+        return feed
+
+    def invalidate(self, *tabs : str):
+        """
+        Mark feeds as outdated. All feeds are marked if no tab is given, tabs without a feed are ignored.
+        """
+        for tab in tabs or self._feeds:
+            if (feed := self._feeds.get(tab)) is not None:
+                feed.stale = True
+        self._changed.set()
+
+    def start(self):
+        """
+        Start refreshing the feeds in a background thread.
+        """
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="TabFeedCache", daemon=True)
+        self._refresher.start()
+
+    def stop(self):
+        """
+        Stop refreshing the feeds in the background.
+        """
+        self._stop.set()
+        self._changed.set()
+        if self._refresher is not None:
+            self._refresher.join(5)
+        self._refresher = None
+
+    def _outdated(self, feed : TabFeed) -> bool:
+        age = time.monotonic() - feed.refreshed_at
+        return age >= self.refresh_interval or (feed.stale and age >= self.min_refresh_interval)
+
+    def _build(self, dungeon_ids : list[DungeonId]) -> TabFeed:
+        return TabFeed(dungeon_ids=dungeon_ids, positions={dungeon_id: position for position, dungeon_id in enumerate(dungeon_ids)}, complete=len(dungeon_ids) < self.size, refreshed_at=time.monotonic(), stale=False)
+
+    @staticmethod
+    def _page(feed : TabFeed, *, offset : int, amount : int) -> Union[list[DungeonId], None]:
+        if not feed.complete and offset + amount > len(feed.dungeon_ids):
+            return None
+        return feed.dungeon_ids[offset:offset + amount]
+
+    @classmethod
+    def _page_after(cls, feed : TabFeed, dungeon_id : DungeonId, *, offset : int, amount : int) -> Union[list[DungeonId], None]:
+        if (position := feed.positions.get(dungeon_id)) is None:
+            return None
+        return cls._page(feed, offset=position + 1 + offset, amount=amount)
+
+    @staticmethod
+    def _sample(feed : TabFeed, *, amount : int) -> list[DungeonId]:
+        dungeon_ids = feed.dungeon_ids
+        positions = sorted(random.sample(range(len(dungeon_ids)), min(len(dungeon_ids), 3 * amount)))
+        best, rest = positions[:amount // 2], positions[amount // 2:]
+        return [dungeon_ids[position] for position in best + random.sample(rest, min(len(rest), amount - amount // 2))]
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            for tab in self.loaders:
+                if self._stop.is_set():
+                    return
+                try:
+                    feed = self._feeds[tab]
+                    if feed.stale or time.monotonic() - feed.refreshed_at >= self.refresh_interval:
+                        self.refresh(tab)
+                except Exception:
+                    warnings.warn(f"Couldn't refresh the {tab} tab feed: \n{traceback.format_exc()}", RuntimeWarning)
+            self._changed.wait(self.refresh_interval)
+            self._stop.wait(self.min_refresh_interval)
+            self._changed.clear()
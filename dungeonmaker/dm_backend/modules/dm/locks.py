@@ -0,0 +1,88 @@
+"""
+Submodule for per-entity locking.
+"""
+from __future__ import annotations
+import asyncio, threading
+from contextlib import contextmanager, asynccontextmanager, ExitStack, AsyncExitStack
+from typing import Any, AsyncIterator, Hashable, Iterator
+
+
+class LockTable:
+    """
+    Class for reentrant locks created on demand per key and dropped again once nobody holds or waits for them.
+    """
+    _locks : dict[Hashable, list[Any]]
+    _lock : threading.Lock
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, key : Hashable) -> Iterator[None]:
+        """
+        Hold the lock of a key.
+        """
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    @contextmanager
+    def lock_all(self, *keys : Hashable) -> Iterator[None]:
+        """
+        Hold the locks of several keys, always taken in the same order to avoid deadlocks.
+        """
+        with ExitStack() as stack:
+            for key in sorted(set(keys), key=repr):
+                stack.enter_context(self.lock(key))
+            yield
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class AsyncLockTable:
+    """
+    Class for asyncio locks created on demand per key and dropped again once nobody holds or waits for them.
+    Unlike LockTable, the locks are not reentrant.
+    """
+    _locks : dict[Hashable, list[Any]]
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def lock(self, key : Hashable) -> AsyncIterator[None]:
+        """
+        Hold the lock of a key.
+        """
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    @asynccontextmanager
+    async def lock_all(self, *keys : Hashable) -> AsyncIterator[None]:
+        """
+        Hold the locks of several keys, always taken in the same order to avoid deadlocks.
+        """
+        async with AsyncExitStack() as stack:
+            for key in sorted(set(keys), key=repr):
+                await stack.enter_async_context(self.lock(key))
+            yield
+
+    def __len__(self) -> int:
+        return len(self._locks)
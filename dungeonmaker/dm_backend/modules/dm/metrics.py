@@ -0,0 +1,283 @@
+"""
+Submodule for metrics.
+"""
+from __future__ import annotations
+import time, inspect, threading, functools
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Union
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+@dataclass(slots=True)
+class HistogramSeries:
+    """
+    Class for the observations of one label set of a histogram.
+    """
+    counts : list[int] = field(kw_only=True)
+    total : float = field(kw_only=True, default=0)
+    count : int = field(kw_only=True, default=0)
+
+    def quantile(self, q : float, buckets : tuple[float, ...]) -> Union[float, None]:
+        """
+        Estimate a quantile as the upper bound of the bucket it falls into.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, amount in zip(buckets, self.counts):
+            cumulative += amount
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class Counter:
+    """
+    Class for a counter with labels.
+    """
+    name : str
+    help : str
+    series : dict[Labels, float]
+    _lock : threading.Lock
+
+    def __init__(self, *, name : str, help : str):
+        self.name = name
+        self.help = help
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount : float = 1, **labels : str):
+        """
+        Increase the counter of a label set.
+        """
+        key = _labels(labels)
+        with self._lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def to_prometheus(self) -> list[str]:
+        """
+        Render in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self.series.items():
+                lines.append(f"{self.name}{_render(key)} {value:g}")
+        return lines
+
+    def snapshot(self) -> dict[str, float]:
+        """
+        Get the current values.
+        """
+        with self._lock:
+            return {_render(key): value for key, value in self.series.items()}
+
+
+class Histogram:
+    """
+    Class for a histogram with fixed buckets and labels.
+    """
+    name : str
+    help : str
+    buckets : tuple[float, ...]
+    series : dict[Labels, HistogramSeries]
+    _lock : threading.Lock
+
+    def __init__(self, *, name : str, help : str, buckets : tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value : float, **labels : str):
+        """
+        Record an observation for a label set.
+        """
+        key = _labels(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = HistogramSeries(counts=[0] * (len(self.buckets) + 1))
+            series.counts[index] += 1
+            series.total += value
+            series.count += 1
+
+    @contextmanager
+    def time(self, **labels : str) -> Iterator[None]:
+        """
+        Observe how long the body takes.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def to_prometheus(self) -> list[str]:
+        """
+        Render in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self.series.items():
+                cumulative = 0
+                for bound, amount in zip((*self.buckets, float("inf")), series.counts):
+                    cumulative += amount
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{_render((*key, ('le', le)))} {cumulative}")
+                lines.append(f"{self.name}_sum{_render(key)} {series.total:g}")
+                lines.append(f"{self.name}_count{_render(key)} {series.count}")
+        return lines
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """
+        Get the count, sum and estimated p50 and p99 of every label set.
+        """
+        with self._lock:
+            return {
+                _render(key): {
+                    "count": series.count,
+                    "sum": series.total,
+                    "p50": series.quantile(0.5, self.buckets),
+                    "p99": series.quantile(0.99, self.buckets),
+                }
+                for key, series in self.series.items()
+            }
+
+
+class MetricsRegistry:
+    """
+    Class for a set of metrics.
+    """
+    metrics : dict[str, Union[Counter, Histogram]]
+    _lock : threading.Lock
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name : str, *, help : str = "") -> Counter:
+        """
+        Get a counter, creating it if needed.
+        """
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = Counter(name=name, help=help)
+            return self.metrics[name]
+
+    def histogram(self, name : str, *, help : str = "", buckets : tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        """
+        Get a histogram, creating it if needed.
+        """
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = Histogram(name=name, help=help, buckets=buckets)
+            return self.metrics[name]
+
+    def to_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.to_prometheus()) + "\n"
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """
+        Get the current state of all metrics.
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+@dataclass(slots=True)
+class RequestTrace:
+    """
+    Class for counting the calls made while handling one request.
+    """
+    db_calls : int = field(kw_only=True, default=0)
+    db_seconds : float = field(kw_only=True, default=0)
+    scratch_calls : int = field(kw_only=True, default=0)
+    scratch_seconds : float = field(kw_only=True, default=0)
+
+
+current_trace : ContextVar[Union[RequestTrace, None]] = ContextVar("current_trace", default=None)
+
+
+def record_db_call(metrics : MetricsRegistry, method : str, seconds : float):
+    """
+    Record a database call and count it for the current request.
+    """
+    metrics.histogram("dm_db_call_seconds", help="Duration of database abstraction calls.").observe(seconds, method=method)
+    if (trace := current_trace.get()) is not None:
+        trace.db_calls += 1
+        trace.db_seconds += seconds
+
+def record_scratch_call(metrics : MetricsRegistry, operation : str, seconds : float):
+    """
+    Record a call to the Scratch API and count it for the current request.
+    """
+    metrics.histogram("dm_scratch_call_seconds", help="Duration of Scratch API calls.").observe(seconds, operation=operation)
+    if (trace := current_trace.get()) is not None:
+        trace.scratch_calls += 1
+        trace.scratch_seconds += seconds
+
+
+class TimedDatabaseAbstraction:
+    """
+    Class wrapping a database abstraction or selector, sync or async, to time every call made through it.
+    The wrapper of a method is created on first use and kept. It looks the method up on every call, so a selector can still rebuild its dispatch table.
+    """
+    database_abstraction : Any
+    metrics : MetricsRegistry
+
+    def __init__(self, database_abstraction : Any, *, metrics : MetricsRegistry):
+        self.database_abstraction = database_abstraction
+        self.metrics = metrics
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        method = getattr(self.database_abstraction, attr)
+        if not callable(method):
+            return method
+        database_abstraction, metrics = self.database_abstraction, self.metrics
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await getattr(database_abstraction, attr)(*args, **kwargs)
+                finally:
+                    record_db_call(metrics, attr, time.perf_counter() - start)
+            self.__dict__[attr] = async_wrapper
+            return async_wrapper
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return getattr(database_abstraction, attr)(*args, **kwargs)
+            finally:
+                record_db_call(metrics, attr, time.perf_counter() - start)
+        self.__dict__[attr] = wrapper
+        return wrapper
+
+
+def _labels(labels : dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _render(key : Labels) -> str:
+    if not key:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(key, escaped)) + "}"
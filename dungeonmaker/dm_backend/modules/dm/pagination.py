@@ -0,0 +1,44 @@
+"""
+Submodule for cursor based pagination.
+"""
+from __future__ import annotations
+import json, base64, binascii
+from typing import Any, Sequence, Union
+from .dmtypes import DungeonId, BaseDungeon
+
+Cursor = tuple[Any, DungeonId]
+
+
+def encode_cursor(value : Any, dungeon_id : DungeonId) -> str:
+    """
+    Build an opaque token pointing behind a dungeon sorted by a value.
+    """
+    return base64.urlsafe_b64encode(json.dumps([value, dungeon_id], separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token : str) -> Cursor:
+    """
+    Read a token built by encode_cursor.
+    """
+    try:
+        value, dungeon_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError, binascii.Error) as e:
+        raise ValueError("Invalid cursor.") from e
+    return value, dungeon_id
+
+
+def next_cursor(dungeons : Sequence[BaseDungeon], *, field : str, amount : int) -> Union[str, None]:
+    """
+    Build the token for the page after a full page of dungeons.
+    """
+    if not dungeons or len(dungeons) < amount:
+        return None
+    return encode_cursor(getattr(dungeons[-1], field), dungeons[-1].dungeon_id)
+
+
+def cursor_filter(cursor : Cursor, *, field : str) -> dict:
+    """
+    Build the MongoDB filter matching everything after a cursor in descending (field, dungeon_id) order.
+    """
+    value, dungeon_id = cursor
+    return {"$or": [{field: {"$lt": value}}, {field: value, "dungeon_id": {"$lt": dungeon_id}}]}
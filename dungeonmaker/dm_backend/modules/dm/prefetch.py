@@ -0,0 +1,358 @@
+"""
+Submodule for prefetching the rooms players are likely to enter next.
+"""
+from __future__ import annotations
+import time, queue, asyncio, threading, warnings, traceback
+from typing import Union
+from dataclasses import dataclass, field
+from . import dungeon as _dungeon, session as _session
+from .cache import IdentityMap
+from .dmtypes import DungeonId, RoomId
+from .selectors import DUNGEON
+
+
+@dataclass(slots=True)
+class PrefetchStats:
+    """
+    Class for prefetching statistics.
+    """
+    scheduled : int = field(kw_only=True, default=0)
+    dropped : int = field(kw_only=True, default=0)
+    prefetched : int = field(kw_only=True, default=0)
+    already_cached : int = field(kw_only=True, default=0)
+    transitions : int = field(kw_only=True, default=0)
+    flushes : int = field(kw_only=True, default=0)
+
+    def to_object(self) -> dict:
+        """
+        Convert to an object.
+        """
+        return {
+            "scheduled": self.scheduled,
+            "dropped": self.dropped,
+            "prefetched": self.prefetched,
+            "already_cached": self.already_cached,
+            "transitions": self.transitions,
+            "flushes": self.flushes,
+        }
+
+
+class RoomPrefetcher:
+    """
+    Class for loading the rooms players are likely to enter next into the session cache in a background thread, so loading them is served from memory.
+    Rooms players often entered right after the current one come first, then the rooms next to it in the order of the dungeon.
+    Which room a player entered after which is counted in memory and added to the stats of the dungeon in batches.
+    Visits arriving within batch_delay of each other are prefetched together, as a single room rarely is worth its own queries.
+    """
+    session : _session.DMSession
+    amount : int
+    radius : int
+    flush_interval : float
+    flush_size : int
+    batch_delay : float
+    batch_size : int
+    stats : PrefetchStats
+    _positions : IdentityMap
+    _transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]
+    _recorded : int
+    _lock : threading.Lock
+    _queue : Union[queue.Queue, asyncio.Queue]
+    _stop : threading.Event
+    _worker : Union[threading.Thread, None]
+
+    def __init__(
+        self,
+        *,
+        session : _session.DMSession,
+        amount : int = 4,
+        radius : int = 4,
+        flush_interval : float = 10,
+        flush_size : int = 500,
+        batch_delay : float = 0.005,
+        batch_size : int = 64,
+        queue_size : int = 1024,
+        client_capacity : Union[int, None] = 10000,
+        client_ttl : Union[float, None] = 1800
+    ):
+        self.session = session
+        self.amount = amount
+        self.radius = radius
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.stats = PrefetchStats()
+        self._positions = IdentityMap(capacity=client_capacity, ttl=client_ttl)
+        self._transitions = {}
+        self._recorded = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._worker = None
+
+    def visit(self, client_id : str, dungeon_id : DungeonId, room_id : RoomId = None):
+        """
+        Record that a client entered a room of a dungeon, or the dungeon itself if no room is given, and schedule prefetching the rooms it likely enters next.
+        """
+        previous = self._positions.get(client_id)
+        self._positions.put(client_id, (dungeon_id, room_id))
+        if previous is not None and room_id is not None and previous[0] == dungeon_id and previous[1] not in (None, room_id):
+            self.record(dungeon_id, previous[1], room_id)
+        self.schedule(dungeon_id, room_id)
+
+    def record(self, dungeon_id : DungeonId, from_room : RoomId, to_room : RoomId):
+        """
+        Count that a player entered a room right after another one.
+        """
+        self.restore({dungeon_id: {from_room: {to_room: 1}}})
+        self.stats.transitions += 1
+
+    def schedule(self, dungeon_id : DungeonId, room_id : RoomId = None) -> bool:
+        """
+        Schedule prefetching the rooms likely entered after a room. Returns False if too much is scheduled already.
+        """
+        try:
+            self._queue.put_nowait((dungeon_id, room_id))
+        except (queue.Full, asyncio.QueueFull):
+            self.stats.dropped += 1
+            return False
+        self.stats.scheduled += 1
+        return True
+
+    def predict(self, __dungeon : _dungeon.Dungeon, room_id : RoomId = None) -> list[RoomId]:
+        """
+        Get the rooms of a dungeon a player in a room likely enters next, most likely first. Without a room the player is entering the dungeon at its start.
+        """
+        counts = __dungeon.transitions_from(room_id) if room_id is not None else {}
+        with self._lock:
+            for to_room, count in self._transitions.get(__dungeon.dungeon_id, {}).get(room_id, {}).items():
+                counts[to_room] = counts.get(to_room, 0) + count
+        candidates = dict.fromkeys([*sorted(counts, key=counts.get, reverse=True), *__dungeon.nearby_rooms(room_id, radius=self.radius)])
+        candidates.pop(room_id, None)
+        rooms = set(__dungeon.rooms)
+        return [candidate for candidate in candidates if candidate in rooms][:self.amount]
+
+    def uncached(self, room_ids : list[RoomId]) -> list[RoomId]:
+        """
+        Get the rooms that aren't cached yet.
+        """
+        missing = [room_id for room_id in room_ids if not self.session.is_cached("rooms", room_id)]
+        self.stats.already_cached += len(room_ids) - len(missing)
+        self.stats.prefetched += len(missing)
+        return missing
+
+    def prefetch(self, *visits : tuple[DungeonId, Union[RoomId, None]]) -> int:
+        """
+        Load the rooms likely entered after the visited rooms into the session cache with one query. Returns the amount of rooms loaded.
+        """
+        predicted = []
+        for dungeon_id, room_id in dict.fromkeys(visits):
+            try:
+                __dungeon = self.session.find(DUNGEON, dungeon_id)
+            except KeyError:
+                continue
+            predicted.extend(self.predict(__dungeon, room_id))
+        if (missing := self.uncached(list(dict.fromkeys(predicted)))):
+            self.session.find_rooms(missing)
+        return len(missing)
+
+    def take(self) -> dict[DungeonId, dict[RoomId, dict[RoomId, int]]]:
+        """
+        Take the transitions counted since the last flush.
+        """
+        with self._lock:
+            transitions, self._transitions, self._recorded = self._transitions, {}, 0
+        return transitions
+
+    def restore(self, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]):
+        """
+        Add transition counts to the ones waiting to be written.
+        """
+        with self._lock:
+            for dungeon_id, counts in transitions.items():
+                pending = self._transitions.setdefault(dungeon_id, {})
+                for from_room, targets in counts.items():
+                    known = pending.setdefault(from_room, {})
+                    for to_room, count in targets.items():
+                        known[to_room] = known.get(to_room, 0) + count
+                        self._recorded += count
+
+    def applied(self, transitions : dict[DungeonId, dict[RoomId, dict[RoomId, int]]]):
+        """
+        Add written transition counts to the cached dungeons.
+        """
+        for dungeon_id, counts in transitions.items():
+            if (cached := self.session.lookup_cache("dungeons", dungeon_id)):
+                cached.apply_transitions(counts)
+        self.stats.flushes += 1
+
+    def flush(self) -> int:
+        """
+        Write the counted transitions to the stats of their dungeons. Returns the amount of dungeons updated.
+        """
+        if not (transitions := self.take()):
+            return 0
+        try:
+            for dungeon_id in transitions:
+                self.session.flush(DUNGEON, dungeon_id)
+            updated = self.session.database_abstraction.add_room_transitions(transitions=transitions)
+        except Exception:
+            self.restore(transitions)
+            raise
+        self.applied(transitions)
+        return updated
+
+    def due(self, last_flush : float) -> bool:
+        """
+        Check whether the counted transitions should be written.
+        """
+        return self._recorded >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval
+
+    def start(self):
+        """
+        Start prefetching in a background thread.
+        """
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._loop, name="RoomPrefetcher", daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        """
+        Stop prefetching and write the counted transitions.
+        """
+        self._stop.set()
+        try:
+            self._queue.put_nowait((None, None))
+        except queue.Full:
+            pass
+        if self._worker is not None:
+            self._worker.join(5)
+        self._worker = None
+        try:
+            self.flush()
+        except Exception:
+            warnings.warn(f"Couldn't write room transitions: \n{traceback.format_exc()}", RuntimeWarning)
+
+    def _next_batch(self, timeout : float) -> list[tuple[DungeonId, Union[RoomId, None]]]:
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size and (remaining := deadline - time.monotonic()) > 0:
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return [visit for visit in batch if visit[0] is not None]
+
+    def _loop(self):
+        last_flush = time.monotonic()
+        while not self._stop.is_set():
+            if (batch := self._next_batch(max(0.01, last_flush + self.flush_interval - time.monotonic()))):
+                try:
+                    self.prefetch(*batch)
+                except Exception:
+                    warnings.warn(f"Couldn't prefetch rooms: \n{traceback.format_exc()}", RuntimeWarning)
+            if self.due(last_flush):
+                last_flush = time.monotonic()
+                try:
+                    self.flush()
+                except Exception:
+                    warnings.warn(f"Couldn't write room transitions: \n{traceback.format_exc()}", RuntimeWarning)
+
+
+class AsyncRoomPrefetcher(RoomPrefetcher):
+    """
+    Class for prefetching rooms into the cache of an asyncio session in a task on its event loop.
+    """
+    _task : Union[asyncio.Task, None]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._queue = asyncio.Queue(maxsize=self._queue.maxsize)
+        self._task = None
+
+    async def prefetch(self, *visits : tuple[DungeonId, Union[RoomId, None]]) -> int:
+        """
+        Load the rooms likely entered after the visited rooms into the session cache with one query. Returns the amount of rooms loaded.
+        """
+        predicted = []
+        for dungeon_id, room_id in dict.fromkeys(visits):
+            try:
+                __dungeon = await self.session.find(DUNGEON, dungeon_id)
+            except KeyError:
+                continue
+            predicted.extend(self.predict(__dungeon, room_id))
+        if (missing := self.uncached(list(dict.fromkeys(predicted)))):
+            await self.session.find_rooms(missing)
+        return len(missing)
+
+    async def flush(self) -> int:
+        """
+        Write the counted transitions to the stats of their dungeons. Returns the amount of dungeons updated.
+        """
+        if not (transitions := self.take()):
+            return 0
+        try:
+            for dungeon_id in transitions:
+                await self.session.flush(DUNGEON, dungeon_id)
+            updated = await self.session.database_abstraction.add_room_transitions(transitions=transitions)
+        except Exception:
+            self.restore(transitions)
+            raise
+        self.applied(transitions)
+        return updated
+
+    async def start(self):
+        """
+        Start prefetching in a task.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        """
+        Stop prefetching and write the counted transitions.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            warnings.warn(f"Couldn't write room transitions: \n{traceback.format_exc()}", RuntimeWarning)
+
+    async def _next_batch(self, timeout : float) -> list[tuple[DungeonId, Union[RoomId, None]]]:
+        try:
+            batch = [await asyncio.wait_for(self._queue.get(), timeout)]
+        except TimeoutError:
+            return []
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size and (remaining := deadline - time.monotonic()) > 0:
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except TimeoutError:
+                break
+        return batch
+
+    async def _loop(self):
+        last_flush = time.monotonic()
+        while True:
+            if (batch := await self._next_batch(max(0.01, last_flush + self.flush_interval - time.monotonic()))):
+                try:
+                    await self.prefetch(*batch)
+                except Exception:
+                    warnings.warn(f"Couldn't prefetch rooms: \n{traceback.format_exc()}", RuntimeWarning)
+            if self.due(last_flush):
+                last_flush = time.monotonic()
+                try:
+                    await self.flush()
+                except Exception:
+                    warnings.warn(f"Couldn't write room transitions: \n{traceback.format_exc()}", RuntimeWarning)
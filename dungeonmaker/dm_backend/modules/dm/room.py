@@ -6,8 +6,7 @@ from typing import Self
 from .dmtypes import RoomId, BaseDungeon, BaseRoom, UserId
 from . import dungeon, user
 from . import session as _session
-from .utils import s_vars
-from .selectors import DUNGEON
+from .selectors import DUNGEON, ROOM
 
 class Room(BaseRoom):
     """
@@ -24,18 +23,18 @@ class Room(BaseRoom):
         """
         Classmethod for reading a room.
         """
-        data = session.database_abstraction.select_room(room_id=room_id)
-        return cls(**data)
+        data = session.load_room_content(session.database_abstraction.select_room(room_id=room_id))
+        return cls(**data, session=session)
     
     def write(self):
         """
         Method for writing a room.
         """
-        if self.new:
-            self.new = False
-            self.session.database_abstraction.insert_room(data=s_vars(self))
-            return
-        self.session.database_abstraction.update_room(room_id=self.room_id, updator={"$set": s_vars(self)})
+        self.write_document(
+            insert=lambda data: self.session.persist_insert(ROOM, data),
+            update=lambda changes, additions: self.session.persist_update(ROOM, self.room_id, changes, additions),
+            stats=self.session.write_stats
+        )
         
     def get_dungeon(self):
         """
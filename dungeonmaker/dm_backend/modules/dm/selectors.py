@@ -6,3 +6,7 @@ from typing import Literal
 DUNGEON : Literal["dungeon"] = "dungeon"
 ROOM : Literal["room"] = "room"
 USER : Literal["user"] = "user"
+
+# Only used for locking claims on names that aren't records of their own. User records are always locked by user_id.
+USERNAME : Literal["username"] = "username"
+LINKED_USER : Literal["linked_user"] = "linked_user"
@@ -2,65 +2,312 @@
 Submodule for database connection.
 """
 from __future__ import annotations
-import random
-from weakref import WeakValueDictionary
-from typing import Literal, Union, assert_never, Sequence, Mapping
+import random, threading
+from typing import Literal, Union, assert_never, Sequence, Mapping, ContextManager
 from dataclasses import dataclass, field
 from . import dungeon, user, room
 from . import dba as _dba
+from .cache import IdentityMap
+from .feeds import TabFeedCache, POPULAR_TAB, NEWEST_TAB, DEFAULT_TAB, TAB_SORT_FIELDS
+from .pagination import decode_cursor, next_cursor
+from .tracking import WriteStats
+from .content import RoomContentStore, CONTENT_HASH_FIELD, unpack_content
+from .unit_of_work import WriteBehindQueue, WriteOperation, update_operators
+from .locks import LockTable
+from .metrics import MetricsRegistry, TimedDatabaseAbstraction
 from .dmtypes import DungeonId, RoomId, UserId, BaseDatabaseAbstraction
-from .selectors import DUNGEON, ROOM, USER
+from .selectors import DUNGEON, ROOM, USER, USERNAME, LINKED_USER
+
+DEFAULT_CACHE_CAPACITY : dict[str, int] = {
+    "dungeons": 512,
+    "users": 1024,
+    "rooms": 4096,
+}
+
+USER_INDEX_KEYS : tuple[str, ...] = ("username", "linked_user")
+
+COLLECTIONS : dict[str, str] = {
+    DUNGEON: "dungeons",
+    ROOM: "rooms",
+    USER: "users",
+}
+
+LOCK_NAMESPACES : dict[str, str] = {
+    **COLLECTIONS,
+    USERNAME: "usernames",
+    LINKED_USER: "linked_users",
+}
+
+KEY_FIELDS : dict[str, str] = {
+    DUNGEON: "dungeon_id",
+    ROOM: "room_id",
+    USER: "user_id",
+}
 
 @dataclass
 class DMSession:
-    database_abstraction : _dba.DatabaseAbstractionSelector
+    database_abstraction : Union[_dba.DatabaseAbstractionSelector, TimedDatabaseAbstraction]
+    database_selector : _dba.DatabaseAbstractionSelector
     database_abstractions : list[BaseDatabaseAbstraction]
-    _cached : dict[WeakValueDictionary[str, Union[dungeon.Dungeon, user.User, room.Room]]]
+    _cached : dict[str, IdentityMap]
+    cache_capacity : dict[str, Union[int, None]]
+    cache_ttl : Union[float, None]
+    _user_index : dict[str, dict[str, UserId]]
+    _indexed_users : dict[UserId, dict[str, str]]
+    _index_lock : threading.RLock
+    tab_feeds : TabFeedCache
+    write_stats : WriteStats
+    room_contents : RoomContentStore
+    write_queue : Union[WriteBehindQueue, None]
+    _pending_contents : dict[str, dict]
+    _contents_lock : threading.Lock
+    locks : LockTable
+    metrics : Union[MetricsRegistry, None]
 
-    def __init__(self, *, database_abstractions : list = None):
+    def __init__(
+        self, 
+        *, 
+        database_abstractions : list = None, 
+        cache_capacity : Union[int, Mapping[str, Union[int, None]], None] = None, 
+        cache_ttl : Union[float, None] = 300,
+        feed_size : int = 100,
+        feed_refresh_interval : float = 60,
+        write_behind : bool = False,
+        flush_interval : float = 0.05,
+        flush_size : int = 100,
+        metrics : Union[MetricsRegistry, None] = None,
+        room_content_capacity : Union[int, None] = 1024
+    ):
         self.database_abstractions = list(database_abstractions or ())
-        self.database_abstraction = _dba.DatabaseAbstractionSelector(self.database_abstractions)
+        self.database_selector = _dba.DatabaseAbstractionSelector(self.database_abstractions)
+        self.database_abstraction = self.database_selector
+        self.metrics = metrics
+        if metrics is not None:
+            self.database_abstraction = TimedDatabaseAbstraction(self.database_abstraction, metrics=metrics)
+        if not isinstance(cache_capacity, Mapping):
+            cache_capacity = dict.fromkeys(DEFAULT_CACHE_CAPACITY, cache_capacity) if cache_capacity is not None else {}
+        self.cache_capacity = {**DEFAULT_CACHE_CAPACITY, **cache_capacity}
+        self.cache_ttl = cache_ttl
+        self.write_stats = WriteStats()
+        self.room_contents = RoomContentStore(capacity=room_content_capacity)
+        self.locks = LockTable()
+        self._pending_contents = {}
+        self._contents_lock = threading.Lock()
+        self.write_queue = WriteBehindQueue(
+            flush_callback=self.write_operations,
+            interval=flush_interval,
+            max_operations=flush_size
+        ) if write_behind else None
         self.setup_cache()
+        self.tab_feeds = TabFeedCache(
+            loaders={
+                POPULAR_TAB: lambda size: self.dungeon_ids(self.database_abstraction.sorted_dungeons(amount=size)),
+                NEWEST_TAB: lambda size: self.dungeon_ids(self.database_abstraction.sorted_dungeons(amount=size, field="creation_time", aggregation=[])),
+                DEFAULT_TAB: lambda size: self.dungeon_ids(self.database_abstraction.sorted_dungeons(amount=size, aggregation=[{"$sample": {"size": size}}])),
+            },
+            size=feed_size,
+            refresh_interval=feed_refresh_interval
+        )
         
     def setup_cache(self):
+        """
+        Set up the identity maps for dungeons, users and rooms.
+        """
         self._cached = {}
-        self._cached["dungeons"] = WeakValueDictionary()
-        self._cached["users"] = WeakValueDictionary()
-        self._cached["rooms"] = WeakValueDictionary()
+        self._user_index = {key: {} for key in USER_INDEX_KEYS}
+        self._indexed_users = {}
+        self._index_lock = threading.RLock()
+        for cache_type, capacity in self.cache_capacity.items():
+            self._cached[cache_type] = IdentityMap(capacity=capacity, ttl=self.cache_ttl)
+        self._cached["users"].on_evict = lambda user_id, _: self.unindex_user(user_id)
+        
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        """
+        Get the hit, miss and eviction counters of every cache.
+        """
+        return {cache_type: cache.stats.to_object() for cache_type, cache in self._cached.items()}
         
 
     def add_database_abstraction(self, dba : BaseDatabaseAbstraction):
         """
-        Add a database abstraction.
+        Add a database abstraction. Its methods take precedence over the ones of abstractions added later.
+        """
+        self.database_selector.add(dba)
+
+    def start(self):
+        """
+        Start the background work of the session.
+        """
+        self.tab_feeds.start()
+        if self.write_queue is not None:
+            self.write_queue.start()
+
+    def close(self):
+        """
+        Stop all background work of the session and write everything that is still pending.
+        """
+        self.tab_feeds.stop()
+        if self.write_queue is not None:
+            self.write_queue.stop()
+
+    def locked(self, *objects : tuple[Literal["dungeon", "room", "user", "username", "linked_user"], Union[DungeonId, RoomId, UserId, str]]) -> ContextManager[None]:
+        """
+        Serialize access to objects given as (type, id) pairs. Requests touching other objects keep running in parallel.
+        Usernames and linked users have their own namespaces, so claiming a name never collides with a user id.
+        """
+        return self.locks.lock_all(*((LOCK_NAMESPACES[__type], __id) for __type, __id in objects))
+
+    def flush(self, __type : Literal["dungeon", "room", "user"] = None, __id : Union[DungeonId, RoomId, UserId] = None):
+        """
+        Write pending writes now. If a type and id are given, only flush if that object has pending writes.
+        """
+        if self.write_queue is None:
+            return
+        if __type is not None and not self.write_queue.is_pending(COLLECTIONS[__type], __id):
+            return
+        self.write_queue.flush()
+
+    def write_operations(self, operations : list[WriteOperation]):
+        """
+        Write a batch of queued operations, storing the room content they refer to first.
+        """
+        self.flush_room_contents()
+        return self.database_abstraction.bulk_write(operations=operations)
+
+    def persist_insert(self, __type : Literal["dungeon", "room", "user"], data : dict):
+        """
+        Insert a document now, or queue it if write-behind is enabled.
+        """
+        if __type == ROOM:
+            data = self.store_room_content(data)
+        if self.write_queue is not None:
+            return self.write_queue.insert(COLLECTIONS[__type], KEY_FIELDS[__type], data)
+        if __type == DUNGEON:
+            return self.database_abstraction.insert_dungeon(data=data)
+        if __type == ROOM:
+            return self.database_abstraction.insert_room(data=data)
+        if __type == USER:
+            return self.database_abstraction.insert_user(data=data)
+        assert_never(__type)
+
+    def persist_update(self, __type : Literal["dungeon", "room", "user"], __id : Union[DungeonId, RoomId, UserId], changes : dict, additions : dict[str, list] = None):
+        """
+        Set changed fields of a document and add elements to its lists now, or queue them if write-behind is enabled.
+        Additions are sent with $addToSet, so elements other processes added in the meantime are kept.
+        """
+        if __type == ROOM:
+            changes = self.store_room_content(changes)
+        if self.write_queue is not None:
+            return self.write_queue.update(COLLECTIONS[__type], KEY_FIELDS[__type], __id, changes, additions)
+        updator = update_operators(changes, additions)
+        if __type == DUNGEON:
+            return self.database_abstraction.update_dungeon(dungeon_id=__id, updator=updator)
+        if __type == ROOM:
+            return self.database_abstraction.update_room(room_id=__id, updator=updator)
+        if __type == USER:
+            return self.database_abstraction.update_user(user_id=__id, updator=updator)
+        assert_never(__type)
+
+    def store_room_content(self, data : dict) -> dict:
+        """
+        Store the content of a room document or of its changes in the room content store. Returns the document referring to it by hash.
+        With write-behind, storing it is queued until the rooms are flushed.
+        """
+        externalized, document = self.room_contents.externalize(data)
+        if document is None:
+            return externalized
+        if self.write_queue is not None:
+            with self._contents_lock:
+                self._pending_contents[document[CONTENT_HASH_FIELD]] = document
+        else:
+            self.database_abstraction.insert_room_content(data=document)
+            self.room_contents.stats.record(document)
+        self.room_contents.stored(document, data["content"])
+        return externalized
+
+    def flush_room_contents(self):
+        """
+        Store queued room content.
+        """
+        while self._pending_contents:
+            with self._contents_lock:
+                digest, document = next(iter(self._pending_contents.items()))
+            self.database_abstraction.insert_room_content(data=document)
+            with self._contents_lock:
+                self._pending_contents.pop(digest, None)
+            self.room_contents.stats.record(document)
+
+    def load_room_content(self, data : dict) -> dict:
+        """
+        Replace the content hash of a room document by the content. Documents with inline content are returned as they are.
         """
-        assert isinstance(dba, BaseDatabaseAbstraction)
-        self.database_abstractions.append(dba)
+        if CONTENT_HASH_FIELD not in data:
+            return data
+        data = dict(data)
+        digest = data.pop(CONTENT_HASH_FIELD)
+        if (content := self.room_contents.get(digest)) is None:
+            document = self.database_abstraction.select_room_content(digest)
+            content = unpack_content(document)
+            self.room_contents.stored(document, content)
+        data["content"] = content
+        return data
 
+    def load_room_contents(self, documents : list[dict]) -> list[dict]:
+        """
+        Replace the content hashes of several room documents by the content, fetching all missing content with one query.
+        """
+        missing = {data[CONTENT_HASH_FIELD] for data in documents if CONTENT_HASH_FIELD in data and self.room_contents.get(data[CONTENT_HASH_FIELD]) is None}
+        if missing:
+            for document in self.database_abstraction.select_room_contents(content_hashes=list(missing)):
+                self.room_contents.stored(document)
+        return [self.load_room_content(data) for data in documents]
 
-    def get_popular_tab(self, *, offset : int = 0, amount : int = 20) -> list[dungeon.Dungeon]:
+
+    def get_popular_tab(self, *, offset : int = 0, amount : int = 20, after : str = None) -> list[dungeon.Dungeon]:
         """
         Get a default of 20 dungeons with no offset from the most popular dungeons.
         """
-        return [dungeon.Dungeon(**dungeon_data) for dungeon_data in self.database_abstraction.sorted_dungeons(offset=offset, amount=amount)]
+        return self.get_sorted_tab(POPULAR_TAB, offset=offset, amount=amount, after=after)
 
     def get_random_tab(self, *, offset : int = 0, amount : int = 20) -> list[dungeon.Dungeon]:
         """
         Get a default of 20 dungeons of random dungeons. 
         """
-        return [dungeon.Dungeon(**dungeon_data) for dungeon_data in self.database_abstraction.random_dungeons(amount=amount)]
+        return self.hydrate_dungeons(self.database_abstraction.random_dungeons(amount=amount))
 
     def get_default_tab(self, *, offset : int = 0, amount : int = 20) -> list[dungeon.Dungeon]:
         """
         Get a default of 20 dungeons of random dungeons. 
         """
-        data = [dungeon.Dungeon(**dungeon_data) for dungeon_data in self.database_abstraction.sorted_dungeons(amount=3*amount, aggregation=[{"$sample": {"size": amount * 3}}, {"$addFields": {"score": {"$add": [{"$multiply": [20, {"$size": "$likers" }] }, "$views"]}}}])]
+        if 3 * amount <= self.tab_feeds.size:
+            return self.get_dungeons(self.tab_feeds.sample(DEFAULT_TAB, amount=amount))
+        data = self.hydrate_dungeons(self.database_abstraction.sorted_dungeons(amount=3*amount, aggregation=[{"$sample": {"size": amount * 3}}]))
         return data[:amount // 2] + random.sample(data[amount // 2:], min(len(data[amount // 2:]), amount - amount // 2))
 
-    def get_newest_tab(self, *, offset : int = 0, amount : int = 20) -> list[dungeon.Dungeon]:
+    def get_newest_tab(self, *, offset : int = 0, amount : int = 20, after : str = None) -> list[dungeon.Dungeon]:
         """
         Get a default of 20 dungeons of the newest dungeons. 
         """
-        return [dungeon.Dungeon(**dungeon_data) for dungeon_data in self.database_abstraction.sorted_dungeons(offset=offset, amount=amount, field="creation_time", aggregation=[])]
+        return self.get_sorted_tab(NEWEST_TAB, offset=offset, amount=amount, after=after)
+
+    def get_sorted_tab(self, tab : str, *, offset : int = 0, amount : int = 20, after : str = None) -> list[dungeon.Dungeon]:
+        """
+        Get a page of a sorted tab, starting behind the cursor token after if one is given.
+        """
+        cursor = decode_cursor(after) if after else None
+        if cursor is None:
+            dungeon_ids = self.tab_feeds.page(tab, offset=offset, amount=amount)
+        else:
+            dungeon_ids = self.tab_feeds.page_after(tab, cursor[1], offset=offset, amount=amount)
+        if dungeon_ids is not None:
+            return self.get_dungeons(dungeon_ids)
+        return self.hydrate_dungeons(self.database_abstraction.sorted_dungeons(offset=offset, amount=amount, field=TAB_SORT_FIELDS[tab], aggregation=[], after=cursor))
+
+    def next_tab_cursor(self, tab : str, dungeons : Sequence[dungeon.Dungeon], *, amount : int = 20) -> Union[str, None]:
+        """
+        Get the cursor token for the page after a page of a sorted tab, or None if it was the last one.
+        """
+        return next_cursor(dungeons, field=TAB_SORT_FIELDS[tab], amount=amount)
 
     def search_for_term(self, term : str, *, amount : int = 10) -> list[dungeon.Dungeon]:
         """
@@ -81,30 +328,79 @@ class DMSession:
                         }
                     }
                 }
-            },
-            {
-                "$addFields": {
-                    "score": {
-                        "$add": [
-                            {"$multiply":
-                                [
-                                    20, {"$size": "$likers" }
-                                ]
-                            },
-                            "$views"
-                        ]
-                    }
-                }
             }
         ]
-        return [dungeon.Dungeon(**dungeon_data) for dungeon_data in self.database_abstraction.sorted_dungeons(amount=amount, field="score", aggregation=aggregator)]
+        return self.hydrate_dungeons(self.database_abstraction.sorted_dungeons(amount=amount, field="score", aggregation=aggregator))
+
+    def hydrate_dungeons(self, dungeon_datas : Sequence[dict]) -> list[dungeon.Dungeon]:
+        """
+        Build dungeons from their documents, resolving all missing owner names with a single query.
+        """
+        dungeon_datas = list(dungeon_datas)
+        missing_owners = {
+            dungeon_data["owner"] 
+            for dungeon_data in dungeon_datas 
+            if dungeon_data.get("owner_name") is None and not self.lookup_cache("dungeons", dungeon_data["dungeon_id"])
+        }
+        owner_names = {}
+        for owner in list(missing_owners):
+            if (value := self.lookup_cache("users", owner)):
+                owner_names[owner] = value.username
+                missing_owners.discard(owner)
+        if missing_owners:
+            for user_data in self.database_abstraction.select_users(user_ids=list(missing_owners)):
+                __user = user.User(**user_data, session=self)
+                owner_names[__user.user_id] = __user.username
+                self.cache_user(__user)
+        dungeons = []
+        for dungeon_data in dungeon_datas:
+            if (value := self.lookup_cache("dungeons", dungeon_data["dungeon_id"])):
+                dungeons.append(value)
+                continue
+            if dungeon_data.get("owner_name") is None:
+                dungeon_data["owner_name"] = owner_names.get(dungeon_data["owner"], "")
+            __dungeon = dungeon.Dungeon(**dungeon_data, session=self)
+            self.save_cache("dungeons", __dungeon.dungeon_id, __dungeon)
+            dungeons.append(__dungeon)
+        return dungeons
+
+    def get_dungeons(self, dungeon_ids : Sequence[DungeonId]) -> list[dungeon.Dungeon]:
+        """
+        Get several dungeons in the given order, loading all uncached ones with a single query.
+        """
+        found = {dungeon_id: value for dungeon_id in dungeon_ids if (value := self.lookup_cache("dungeons", dungeon_id))}
+        if (missing := [dungeon_id for dungeon_id in dungeon_ids if dungeon_id not in found]):
+            for __dungeon in self.hydrate_dungeons(self.database_abstraction.select_dungeons(dungeon_ids=missing)):
+                found[__dungeon.dungeon_id] = __dungeon
+        return [found[dungeon_id] for dungeon_id in dungeon_ids if dungeon_id in found]
+
+    def dungeon_ids(self, dungeon_datas : Sequence[dict]) -> list[DungeonId]:
+        """
+        Hydrate dungeon documents into the cache and return their ids.
+        """
+        return [__dungeon.dungeon_id for __dungeon in self.hydrate_dungeons(dungeon_datas)]
+
+    def refresh_owner_names(self) -> int:
+        """
+        Maintenance job that rewrites the stored owner name of every dungeon from its owner's current username.
+        """
+        updated = self.database_abstraction.refresh_owner_names()
+        self._cached["dungeons"].clear()
+        return updated
 
     def lookup_cache(self, cache_type : str, __id : Union[DungeonId, RoomId, UserId]) -> Union[None, dungeon.Dungeon, room.Room, user.User]:
         """
         Don't use.
         """
-        if __id in (cache := self._cached[cache_type]):
-            return cache[__id]
+        if __id is None:
+            return None
+        return self._cached[cache_type].get(__id)
+        
+    def is_cached(self, cache_type : str, __id : Union[DungeonId, RoomId, UserId]) -> bool:
+        """
+        Check whether something is cached without touching the cache statistics.
+        """
+        return self._cached[cache_type].peek(__id) is not None
         
     def save_cache(self, cache_type : str, __id : Union[DungeonId, RoomId, UserId], value : Union[dungeon.Dungeon, room.Room, user.User]):
         """
@@ -112,6 +408,75 @@ class DMSession:
         """
         self._cached[cache_type][__id] = value
 
+    def index_user(self, __user : user.User):
+        """
+        Update the username and linked user index of the cache for a user.
+        """
+        with self._index_lock:
+            self.unindex_user(__user.user_id)
+            values = {key: value for key in USER_INDEX_KEYS if (value := getattr(__user, key)) is not None}
+            for key, value in values.items():
+                self._user_index[key][value] = __user.user_id
+            self._indexed_users[__user.user_id] = values
+
+    def unindex_user(self, user_id : UserId):
+        """
+        Remove a user from the username and linked user index of the cache.
+        """
+        with self._index_lock:
+            for key, value in self._indexed_users.pop(user_id, {}).items():
+                if self._user_index[key].get(value) == user_id:
+                    del self._user_index[key][value]
+
+    def cache_user(self, __user : user.User):
+        """
+        Save a user in the cache and index it.
+        """
+        self.save_cache("users", __user.user_id, __user)
+        self.index_user(__user)
+
+    def lookup_user_cache(self, key : Literal["username", "linked_user"], value : str) -> Union[None, user.User]:
+        """
+        Look up a cached user by its username or linked user.
+        """
+        if value is None:
+            return None
+        user_id = self._user_index[key].get(value)
+        __user = self.lookup_cache("users", user_id)
+        if __user is None or getattr(__user, key) != value:
+            return None
+        return __user
+
+    def find_linked_user(self, linked_user : str) -> user.User:
+        """
+        Find the user that linked a certain scratch account.
+        """
+        if (value := self.lookup_user_cache("linked_user", linked_user)):
+            return value
+        __user = user.User(**self.database_abstraction.select_user(fields={"linked_user": linked_user}), session=self)
+        if (value := self.lookup_cache("users", __user.user_id)):
+            return value
+        self.cache_user(__user)
+        return __user
+
+    def find_rooms(self, room_ids : Sequence[RoomId]) -> list[room.Room]:
+        """
+        Find several rooms with one query for the rooms not cached and one for their content. Rooms that don't exist are left out.
+        """
+        found = {}
+        for room_id in room_ids:
+            if (value := self.lookup_cache("rooms", room_id)):
+                found[room_id] = value
+        if (missing := [room_id for room_id in dict.fromkeys(room_ids) if room_id not in found]):
+            for data in self.load_room_contents(self.database_abstraction.select_rooms(room_ids=missing)):
+                __room = room.Room(**data, session=self)
+                if (value := self.lookup_cache("rooms", __room.room_id)):
+                    __room = value
+                else:
+                    self.save_cache("rooms", __room.room_id, __room)
+                found[__room.room_id] = __room
+        return [found[room_id] for room_id in room_ids if room_id in found]
+
     def find(self, __type : Literal["dungeon", "room", "user"], __id : Union[DungeonId, RoomId, UserId] = None, *, name : str = None) -> Union[dungeon.Dungeon, room.Room, user.User]:
         """
         Finds something.
@@ -129,10 +494,16 @@ class DMSession:
             self.save_cache("rooms", __id, __room)
             return __room
         if __type == USER:
-            if (value := self.lookup_cache("users", __id)):
+            if __id is None:
+                value = self.lookup_user_cache("username", name)
+            elif (value := self.lookup_cache("users", __id)) and name is not None and value.username != name:
+                value = None
+            if value:
                 return value
             __user = user.User.lookup_user(user_id=__id, username=name, session=self)
-            self.save_cache("users", __id, __user)
+            if (value := self.lookup_cache("users", __user.user_id)):
+                return value
+            self.cache_user(__user)
             return __user
         assert_never(__type)
 
@@ -160,7 +531,7 @@ class DMSession:
             __id = __user.user_id
             if self.lookup_cache("users", __id):
                 raise ValueError("User already exists (in cache!!)")
-            self.save_cache("users", __id, __user)
+            self.cache_user(__user)
             return __user
         assert_never(__type)
 
@@ -0,0 +1,337 @@
+"""
+Submodule for the binary tile grid format of room content.
+
+Room content built by the Scratch project is a string of tiles, each tile_width characters long, laid out in rows of width tiles.
+An encoded room starts with a header:
+
+    magic "DMRG", format version (u8), flags (u8), tile_width (u8), index bits (u8), then as varints: tile count, width, palette size
+
+followed by the palette, each tile as a varint length and its UTF-8 bytes, and the body.
+The body is either runs of palette indices as varint pairs of index and length (FLAG_RLE), or the index of every tile packed into 1, 2, 4, 8 or 16 bits.
+Packed indices fill each byte from its lowest bits, and 16 bit indices are little-endian.
+Content that doesn't split into tiles, or is smaller as text, has FLAG_TEXT and its UTF-8 bytes as body instead of a palette.
+NumPy is used for splitting, run detection and joining when it is installed.
+"""
+from __future__ import annotations
+import sys, struct
+from array import array
+from typing import Union
+from dataclasses import dataclass, field
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"DMRG"
+
+FORMAT_VERSION = 1
+
+FLAG_RLE = 1
+
+FLAG_TEXT = 2
+
+MAX_PALETTE_SIZE = 1 << 16
+
+MAX_TILES = 1 << 20
+
+INDEX_BITS : tuple[int, ...] = (1, 2, 4, 8, 16)
+
+HEADER = struct.Struct("<4sBBBB")
+
+
+def encode_varint(value : int, out : bytearray):
+    """
+    Append an unsigned LEB128 varint.
+    """
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data : bytes, position : int) -> tuple[int, int]:
+    """
+    Read an unsigned LEB128 varint. Returns the value and the position after it.
+    """
+    value = shift = 0
+    while True:
+        try:
+            byte = data[position]
+        except IndexError:
+            raise ValueError("Encoded room is truncated.") from None
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def varint_size(value : int) -> int:
+    """
+    Get the amount of bytes of a varint.
+    """
+    return max(1, -(-value.bit_length() // 7))
+
+
+@dataclass(slots=True)
+class RoomGrid:
+    """
+    Class for room content as a palette of distinct tiles and the palette index of every tile.
+    """
+    tile_width : int = field(kw_only=True, default=1)
+    width : int = field(kw_only=True, default=0)
+    palette : list[str] = field(kw_only=True, default_factory=list)
+    tiles : array = field(kw_only=True, default_factory=lambda : array("H"))
+
+    @classmethod
+    def from_text(cls, text : str, *, tile_width : int = 1, width : int = 0) -> RoomGrid:
+        """
+        Convert room content in its string form. Raises ValueError if it doesn't split into tiles.
+        """
+        if not 0 < tile_width < 256 or len(text) % tile_width:
+            raise ValueError(f"Content doesn't split into tiles of {tile_width} characters.")
+        if numpy is not None and text:
+            palette, tiles = _index_numpy(text, tile_width)
+        else:
+            palette, tiles = _index_python(text, tile_width)
+        if len(palette) > MAX_PALETTE_SIZE:
+            raise ValueError(f"Rooms can have at most {MAX_PALETTE_SIZE} distinct tiles.")
+        return cls(tile_width=tile_width, width=width, palette=palette, tiles=tiles)
+
+    def to_text(self) -> str:
+        """
+        Convert back to the string form.
+        """
+        if numpy is not None and self.tile_width == 1 and self.tiles and all(len(tile) == 1 for tile in self.palette):
+            codes = numpy.array([ord(tile) for tile in self.palette], dtype="<u4")
+            return codes[numpy.frombuffer(self.tiles, dtype=numpy.uint16)].tobytes().decode("utf-32-le")
+        return "".join(map(self.palette.__getitem__, self.tiles))
+
+    @property
+    def height(self) -> int:
+        """
+        Amount of rows.
+        """
+        return -(-len(self.tiles) // self.width) if self.width else 1
+
+    def runs(self) -> tuple[list[int], list[int]]:
+        """
+        Get the palette index and length of every run of equal tiles.
+        """
+        if numpy is not None and self.tiles:
+            indices = numpy.frombuffer(self.tiles, dtype=numpy.uint16)
+            starts = numpy.flatnonzero(numpy.diff(indices)) + 1
+            starts = numpy.concatenate(([0], starts))
+            lengths = numpy.diff(numpy.concatenate((starts, [len(indices)])))
+            return indices[starts].tolist(), lengths.tolist()
+        values, lengths = [], []
+        for tile in self.tiles:
+            if values and values[-1] == tile:
+                lengths[-1] += 1
+            else:
+                values.append(tile)
+                lengths.append(1)
+        return values, lengths
+
+    @property
+    def index_bits(self) -> int:
+        """
+        Amount of bits a packed palette index takes.
+        """
+        needed = max(1, (len(self.palette) - 1).bit_length())
+        return next(bits for bits in INDEX_BITS if bits >= needed)
+
+    def encode(self) -> bytes:
+        """
+        Encode with a run-length body if that is smaller than the packed indices.
+        """
+        out = bytearray()
+        bits = self.index_bits
+        values, lengths = self.runs()
+        packed_size = -(-len(self.tiles) * bits // 8)
+        # Every run takes at least two bytes, which rules out most rooms without sizing each run.
+        rle = 2 * len(values) < packed_size and sum(varint_size(value) + varint_size(length) for value, length in zip(values, lengths)) < packed_size
+        out += HEADER.pack(MAGIC, FORMAT_VERSION, FLAG_RLE if rle else 0, self.tile_width, bits)
+        for value in (len(self.tiles), self.width, len(self.palette)):
+            encode_varint(value, out)
+        for tile in self.palette:
+            encoded = tile.encode()
+            encode_varint(len(encoded), out)
+            out += encoded
+        if rle:
+            for value, length in zip(values, lengths):
+                encode_varint(value, out)
+                encode_varint(length, out)
+        else:
+            out += _pack_indices(self.tiles, bits)
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, data : bytes, *, max_size : Union[int, None] = None) -> RoomGrid:
+        """
+        Decode an encoded room that isn't stored as text.
+        Raises ValueError before expanding any tiles if the room would be longer than max_size characters.
+        """
+        flags, tile_width, bits, count, width, position = _read_header(data)
+        if flags & FLAG_TEXT:
+            raise ValueError("Encoded room is stored as text.")
+        if tile_width == 0:
+            raise ValueError("Encoded room is corrupt.")
+        if max_size is not None and count * tile_width > max_size:
+            raise ValueError(f"Rooms can be at most {max_size} characters long.")
+        palette_size, position = decode_varint(data, position)
+        if palette_size > MAX_PALETTE_SIZE:
+            raise ValueError(f"Rooms can have at most {MAX_PALETTE_SIZE} distinct tiles.")
+        palette = []
+        for _ in range(palette_size):
+            size, position = decode_varint(data, position)
+            tile = bytes(data[position:position + size]).decode()
+            # Every tile has to be tile_width characters long, otherwise the string form isn't count * tile_width long.
+            if len(tile) != tile_width:
+                raise ValueError("Encoded room is corrupt.")
+            palette.append(tile)
+            position += size
+        if flags & FLAG_RLE:
+            values, lengths = [], []
+            while position < len(data):
+                value, position = decode_varint(data, position)
+                length, position = decode_varint(data, position)
+                if value >= palette_size:
+                    raise ValueError("Encoded room is corrupt.")
+                values.append(value)
+                lengths.append(length)
+            if sum(lengths) != count:
+                raise ValueError("Encoded room is corrupt.")
+            tiles = _expand_runs(values, lengths)
+        elif bits in INDEX_BITS:
+            tiles = _unpack_indices(bytes(data[position:position + -(-count * bits // 8)]), count, bits)
+            if tiles and _max_index(tiles) >= palette_size:
+                raise ValueError("Encoded room is corrupt.")
+        else:
+            raise ValueError(f"Unsupported index size of {bits} bits.")
+        if len(tiles) != count:
+            raise ValueError("Encoded room is corrupt.")
+        return cls(tile_width=tile_width, width=width, palette=palette, tiles=tiles)
+
+
+def encode_room(text : str, *, tile_width : int = 1, width : int = 0) -> bytes:
+    """
+    Encode room content in its string form, as a tile grid or as text, whichever is smaller.
+    """
+    raw = text.encode()
+    encoded = None
+    try:
+        encoded = RoomGrid.from_text(text, tile_width=tile_width, width=width).encode()
+    except ValueError:
+        pass
+    if encoded is not None and len(encoded) < HEADER.size + varint_size(len(raw)) + varint_size(width) + len(raw):
+        return encoded
+    out = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, FLAG_TEXT, tile_width, 0))
+    encode_varint(len(raw), out)
+    encode_varint(width, out)
+    return bytes(out + raw)
+
+def decode_room(data : bytes, *, max_size : Union[int, None] = None) -> str:
+    """
+    Decode an encoded room to its string form. Raises ValueError if it would be longer than max_size characters.
+    """
+    flags, _, _, count, _, position = _read_header(data)
+    if flags & FLAG_TEXT:
+        raw = bytes(data[position:])
+        if len(raw) != count:
+            raise ValueError("Encoded room is corrupt.")
+        text = raw.decode()
+        if max_size is not None and len(text) > max_size:
+            raise ValueError(f"Rooms can be at most {max_size} characters long.")
+        return text
+    return RoomGrid.decode(data, max_size=max_size).to_text()
+
+def is_encoded_room(data : Union[bytes, bytearray, memoryview]) -> bool:
+    """
+    Check whether data starts like an encoded room.
+    """
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def _read_header(data : bytes) -> tuple[int, int, int, int, int, int]:
+    if len(data) < HEADER.size:
+        raise ValueError("Encoded room is truncated.")
+    magic, version, flags, tile_width, bits = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Data is not an encoded room.")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported room format version {version}.")
+    count, position = decode_varint(data, HEADER.size)
+    width, position = decode_varint(data, position)
+    if count > (MAX_TILES if not flags & FLAG_TEXT else 4 * MAX_TILES):
+        raise ValueError("Encoded room is too large.")
+    return flags, tile_width, bits, count, width, position
+
+def _index_python(text : str, tile_width : int) -> tuple[list[str], array]:
+    tiles = [text[position:position + tile_width] for position in range(0, len(text), tile_width)] if tile_width > 1 else list(text)
+    palette = sorted(set(tiles))
+    if len(palette) > MAX_PALETTE_SIZE:
+        return palette, array("H")
+    positions = {tile: index for index, tile in enumerate(palette)}
+    return palette, array("H", map(positions.__getitem__, tiles))
+
+def _index_numpy(text : str, tile_width : int) -> tuple[list[str], array]:
+    codes = numpy.frombuffer(text.encode("utf-32-le"), dtype="<u4").reshape(-1, tile_width)
+    unique, inverse = numpy.unique(codes, axis=0, return_inverse=True)
+    palette = [row.tobytes().decode("utf-32-le") for row in unique]
+    if len(palette) > MAX_PALETTE_SIZE:
+        return palette, array("H")
+    return palette, array("H", inverse.reshape(-1).astype(numpy.uint16).tobytes())
+
+def _max_index(tiles : array) -> int:
+    if numpy is not None:
+        return int(numpy.frombuffer(tiles, dtype=numpy.uint16).max())
+    return max(tiles)
+
+def _expand_runs(values : list[int], lengths : list[int]) -> array:
+    if numpy is not None and values:
+        return array("H", numpy.repeat(numpy.array(values, dtype=numpy.uint16), lengths).tobytes())
+    tiles = array("H")
+    for value, length in zip(values, lengths):
+        tiles.extend(array("H", (value,)) * length)
+    return tiles
+
+def _pack_indices(tiles : array, bits : int) -> bytes:
+    if bits == 16:
+        if sys.byteorder == "little":
+            return tiles.tobytes()
+        swapped = array("H", tiles)
+        swapped.byteswap()
+        return swapped.tobytes()
+    if bits == 8:
+        return array("B", tiles).tobytes()
+    per_byte = 8 // bits
+    if numpy is not None and tiles:
+        padded = numpy.zeros(-(-len(tiles) // per_byte) * per_byte, dtype=numpy.uint8)
+        padded[:len(tiles)] = numpy.frombuffer(tiles, dtype=numpy.uint16)
+        shifts = numpy.arange(per_byte, dtype=numpy.uint8) * bits
+        return (padded.reshape(-1, per_byte) << shifts).sum(axis=1, dtype=numpy.uint8).tobytes()
+    padded = tiles + array("H", bytes(2 * (-len(tiles) % per_byte)))
+    packed = list(padded[::per_byte])
+    for offset in range(1, per_byte):
+        shift = offset * bits
+        packed = [value | index << shift for value, index in zip(packed, padded[offset::per_byte])]
+    return bytes(packed)
+
+def _unpack_indices(data : bytes, count : int, bits : int) -> array:
+    if bits == 16:
+        tiles = array("H", data)
+        if sys.byteorder != "little":
+            tiles.byteswap()
+        return tiles
+    if bits == 8:
+        return array("H", list(data))
+    per_byte, mask = 8 // bits, (1 << bits) - 1
+    if numpy is not None and data:
+        shifts = numpy.arange(per_byte, dtype=numpy.uint8) * bits
+        indices = (numpy.frombuffer(data, dtype=numpy.uint8)[:, None] >> shifts) & mask
+        return array("H", indices.reshape(-1)[:count].astype(numpy.uint16).tobytes())
+    indices = [0] * (len(data) * per_byte)
+    for offset in range(per_byte):
+        shift = offset * bits
+        indices[offset::per_byte] = [byte >> shift & mask for byte in data]
+    return array("H", indices[:count])
@@ -0,0 +1,167 @@
+"""
+Submodule for tracking which fields of an object changed since it was last written.
+"""
+from __future__ import annotations
+import copy, pickle, hashlib, threading
+from typing import Any, Callable, Collection
+from dataclasses import dataclass, field
+from .utils import s_vars
+
+Fingerprint = tuple[bytes, int]
+
+
+def fingerprint(value : Any) -> Fingerprint:
+    """
+    Get a compact digest and the approximate encoded size of a value.
+    """
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    return hashlib.blake2b(data, digest_size=16).digest(), len(data)
+
+def detached(value : Any) -> Any:
+    """
+    Copy lists and dicts one level deep, so changing them in place doesn't change the copy. Nested containers have to be replaced instead of changed.
+    """
+    if isinstance(value, (list, dict)):
+        return copy.copy(value)
+    return value
+
+
+@dataclass(slots=True, frozen=True)
+class Loaded:
+    """
+    Class for a field as it was loaded, kept instead of its fingerprint until the object is written for the first time.
+    """
+    value : Any
+
+
+@dataclass(slots=True)
+class WriteStats:
+    """
+    Class for statistics about writes. Sizes are approximations of the encoded field sizes.
+    """
+    writes : int = field(kw_only=True, default=0)
+    skipped_writes : int = field(kw_only=True, default=0)
+    fields_sent : int = field(kw_only=True, default=0)
+    fields_skipped : int = field(kw_only=True, default=0)
+    bytes_sent : int = field(kw_only=True, default=0)
+    bytes_saved : int = field(kw_only=True, default=0)
+    _lock : threading.Lock = field(init=False, repr=False, compare=False, default_factory=threading.Lock)
+
+    def record(self, *, sent : dict[str, Fingerprint], skipped : dict[str, Fingerprint]):
+        """
+        Record a write that sent some fields and skipped the unchanged ones.
+        """
+        with self._lock:
+            if sent:
+                self.writes += 1
+            else:
+                self.skipped_writes += 1
+            self.fields_sent += len(sent)
+            self.fields_skipped += len(skipped)
+            self.bytes_sent += sum(size for _, size in sent.values())
+            self.bytes_saved += sum(size for _, size in skipped.values())
+
+    def to_object(self) -> dict:
+        """
+        Convert to an object.
+        """
+        return {
+            "writes": self.writes,
+            "skipped_writes": self.skipped_writes,
+            "fields_sent": self.fields_sent,
+            "fields_skipped": self.fields_skipped,
+            "bytes_sent": self.bytes_sent,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+class Tracked:
+    """
+    Mixin for slotted objects remembering the fingerprints of the fields they were last written with.
+    Loaded objects only keep copies of their fields, and fingerprint them when they are first written, as most are never written.
+    Lists in MERGED_FIELDS keep their copies, so the elements added to them can be sent instead of the whole list.
+    Needs a _snapshot slot and a new attribute.
+    """
+    __slots__ = ()
+    MERGED_FIELDS : tuple[str, ...] = ()
+
+    def __post_init__(self):
+        if not self.new:
+            self.mark_loaded()
+
+    def to_document(self) -> dict:
+        """
+        Convert to the document stored in the database.
+        """
+        return {**s_vars(self), "new": False}
+
+    def mark_clean(self, document : dict = None):
+        """
+        Remember the current state as the written one.
+        """
+        document = self.to_document() if document is None else document
+        self._snapshot = {key: Loaded(detached(value)) if key in self.MERGED_FIELDS else fingerprint(value) for key, value in document.items()}
+
+    def mark_loaded(self):
+        """
+        Remember the current state as the loaded one, without fingerprinting it.
+        """
+        self._snapshot = {key: Loaded(detached(value)) for key, value in self.to_document().items()}
+
+    def mark_dirty(self, *keys : str):
+        """
+        Force fields to be written next time. All fields are marked if no key is given.
+        """
+        if not keys or self._snapshot is None:
+            self._snapshot = None
+            return
+        for key in keys:
+            self._snapshot.pop(key, None)
+
+    def write_document(self, *, insert : Callable[[dict], Any], update : Callable[[dict, dict], Any], stats : WriteStats, exclude : Collection[str] = ()) -> bool:
+        """
+        Insert the document of a new object, or update only the fields that changed since the last write.
+        update gets the fields to set and the elements added to merged fields. Fields in exclude are never sent in updates. Returns whether anything was sent.
+        """
+        document = self.to_document()
+        if self.new:
+            self.new = False
+            insert(document)
+            self.mark_clean(document)
+            stats.record(sent={key: fingerprint(document[key]) if type(value) is Loaded else value for key, value in self._snapshot.items()}, skipped={})
+            return True
+        changes, additions, sent, skipped = self.diff(document)
+        snapshot = {**skipped, **sent}
+        for key in self.MERGED_FIELDS:
+            if key in document:
+                snapshot[key] = Loaded(detached(document[key]))
+        for key in exclude:
+            changes.pop(key, None)
+            additions.pop(key, None)
+            sent.pop(key, None)
+        stats.record(sent=sent, skipped=skipped)
+        if changes or additions:
+            update(changes, additions)
+        self._snapshot = snapshot
+        return bool(changes or additions)
+
+    def diff(self, document : dict = None) -> tuple[dict[str, Any], dict[str, list], dict[str, Fingerprint], dict[str, Fingerprint]]:
+        """
+        Split a document into the changed fields, the elements added to merged fields, their fingerprints and the fingerprints of the unchanged ones.
+        Merged fields that weren't only appended to are changed as a whole.
+        """
+        document = self.to_document() if document is None else document
+        snapshot = self._snapshot or {}
+        changes, additions, sent, skipped = {}, {}, {}, {}
+        for key, value in document.items():
+            current = fingerprint(value)
+            previous = snapshot.get(key)
+            if previous == current or type(previous) is Loaded and type(previous.value) is type(value) and previous.value == value:
+                skipped[key] = current
+                continue
+            sent[key] = current
+            if key in self.MERGED_FIELDS and type(previous) is Loaded and isinstance(value, list) and value[:len(previous.value)] == previous.value:
+                additions[key] = value[len(previous.value):]
+                continue
+            changes[key] = value
+        return changes, additions, sent, skipped
@@ -0,0 +1,214 @@
+"""
+Submodule for write-behind batching of entity writes.
+"""
+from __future__ import annotations
+import threading, warnings, traceback
+from collections import OrderedDict
+from typing import Any, Callable, Literal, Union
+from dataclasses import dataclass, field
+
+
+@dataclass(slots=True)
+class WriteOperation:
+    """
+    Class for a pending write of one document. Inserts carry the whole document, updates only the fields to $set and the elements to add to lists.
+    """
+    kind : Literal["insert", "update"] = field(kw_only=True)
+    collection : Literal["users", "dungeons", "rooms"] = field(kw_only=True)
+    key_field : str = field(kw_only=True)
+    key : Any = field(kw_only=True)
+    data : dict = field(kw_only=True)
+    additions : dict[str, list] = field(kw_only=True, default_factory=dict)
+
+    def merge(self, changes : dict, additions : dict[str, list] = None):
+        """
+        Add later changes and additions of the same document. Additions to fields that are set are added to the set value instead.
+        """
+        self.data.update(changes)
+        for key in changes:
+            self.additions.pop(key, None)
+        for key, items in (additions or {}).items():
+            if key in self.data:
+                self.data[key] = [*self.data[key], *(item for item in items if item not in self.data[key])]
+                continue
+            pending = self.additions.setdefault(key, [])
+            pending.extend(item for item in items if item not in pending)
+
+
+def update_operators(changes : dict, additions : dict[str, list] = None) -> dict:
+    """
+    Get the update operators setting changed fields and adding elements to lists.
+    """
+    updator = {}
+    if changes:
+        updator["$set"] = changes
+    if additions:
+        updator["$addToSet"] = {key: {"$each": items} for key, items in additions.items()}
+    return updator
+
+
+class PartialWriteError(Exception):
+    """
+    Exception for bulk writes of which only some operations were written. The others are in failed.
+    """
+    failed : list[WriteOperation]
+
+    def __init__(self, message : str, *, failed : list[WriteOperation]):
+        super().__init__(message)
+        self.failed = failed
+
+
+class WriteBehindQueue:
+    """
+    Class for collecting writes and flushing them in batches, merging all pending writes of a document into one operation.
+    """
+    flush_callback : Callable[[list[WriteOperation]], Any]
+    interval : float
+    max_operations : int
+    flushed_operations : int
+    flushes : int
+    _pending : OrderedDict[tuple[str, Any], WriteOperation]
+    _lock : threading.Lock
+    _flush_lock : threading.Lock
+    _wakeup : threading.Event
+    _stop : threading.Event
+    _flusher : Union[threading.Thread, None]
+
+    def __init__(self, *, flush_callback : Callable[[list[WriteOperation]], Any], interval : float = 0.05, max_operations : int = 100):
+        self.flush_callback = flush_callback
+        self.interval = interval
+        self.max_operations = max_operations
+        self.flushed_operations = 0
+        self.flushes = 0
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._flusher = None
+
+    def insert(self, collection : str, key_field : str, data : dict):
+        """
+        Queue the insert of a document.
+        """
+        with self._lock:
+            self._pending[(collection, data[key_field])] = WriteOperation(kind="insert", collection=collection, key_field=key_field, key=data[key_field], data=dict(data))
+            self._queued()
+
+    def update(self, collection : str, key_field : str, key : Any, changes : dict, additions : dict[str, list] = None):
+        """
+        Queue setting some fields of a document and adding elements to its lists.
+        """
+        with self._lock:
+            if (operation := self._pending.get((collection, key))) is None:
+                operation = self._pending[(collection, key)] = WriteOperation(kind="update", collection=collection, key_field=key_field, key=key, data={})
+            operation.merge(changes, additions)
+            self._queued()
+
+    def is_pending(self, collection : str, key : Any) -> bool:
+        """
+        Return whether a document has writes that weren't flushed yet.
+        """
+        with self._lock:
+            return (collection, key) in self._pending
+
+    def flush(self) -> int:
+        """
+        Write all pending operations now. Returns the amount of operations written.
+        """
+        with self._flush_lock:
+            operations = self.take()
+            if not operations:
+                return 0
+            try:
+                self.flush_callback(operations)
+            except Exception as e:
+                self.settle_failure(operations, e)
+                raise
+            self.record_flush(operations)
+            return len(operations)
+
+    def take(self) -> list[WriteOperation]:
+        """
+        Remove and return all pending operations, for writing them elsewhere.
+        """
+        with self._lock:
+            operations = list(self._pending.values())
+            self._pending.clear()
+        return operations
+
+    def restore(self, operations : list[WriteOperation]):
+        """
+        Put back taken operations that couldn't be written.
+        """
+        with self._lock:
+            for operation in reversed(operations):
+                self._requeue(operation)
+
+    def settle_failure(self, operations : list[WriteOperation], error : Exception):
+        """
+        Put back the taken operations a failed write didn't write and count the others. Only a PartialWriteError tells which ones were written.
+        """
+        failed = error.failed if isinstance(error, PartialWriteError) else operations
+        self.restore(failed)
+        failed_ids = {id(operation) for operation in failed}
+        written = [operation for operation in operations if id(operation) not in failed_ids]
+        if written:
+            self.record_flush(written)
+
+    def record_flush(self, operations : list[WriteOperation]):
+        """
+        Count taken operations that were written.
+        """
+        self.flushed_operations += len(operations)
+        self.flushes += 1
+
+    def start(self):
+        """
+        Start flushing in a background thread.
+        """
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, name="WriteBehindQueue", daemon=True)
+        self._flusher.start()
+
+    def stop(self):
+        """
+        Stop the background thread and flush everything that is still pending.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join(5)
+        self._flusher = None
+        self.flush()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _queued(self):
+        if len(self._pending) >= self.max_operations:
+            self._wakeup.set()
+
+    def _requeue(self, operation : WriteOperation):
+        """
+        Put back a failed operation in front of the newer writes of the same document.
+        """
+        newer = self._pending.pop((operation.collection, operation.key), None)
+        if newer is not None:
+            operation.merge(newer.data, newer.additions)
+            if newer.kind == "insert":
+                operation.kind = "insert"
+        self._pending[(operation.collection, operation.key)] = operation
+        self._pending.move_to_end((operation.collection, operation.key), last=False)
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                warnings.warn(f"Couldn't flush pending writes, retrying: \n{traceback.format_exc()}", RuntimeWarning)
+                self._stop.wait(self.interval)
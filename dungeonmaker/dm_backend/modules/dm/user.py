@@ -4,7 +4,7 @@ Submodule for handling users.
 from __future__ import annotations
 from typing import Self
 from .dmtypes import BaseUser, UserId, BaseDMSession
-from .utils import s_vars
+from .selectors import USER
 
 
 
@@ -12,29 +12,32 @@ class User(BaseUser):
     """
     Class for handling users.
     """
+    MERGED_FIELDS = ("owned_dungeons", "permitted_dungeons")
+
     @classmethod
     def lookup_user(cls, *, username : str = None, user_id : UserId = None, session : BaseDMSession) -> Self:
         """
         Find a user based on its username or user id.
         """
-        return cls(**session.database_abstraction.select_user(user_id=user_id, fields={"username": username} if username else {}))
+        return cls(**session.database_abstraction.select_user(user_id=user_id, fields={"username": username} if username else {}), session=session)
     
     @classmethod
     def read(cls, user_id : UserId, *, session : BaseDMSession) -> Self:
         """
         Read a user based on its user_id.
         """
-        return cls(**session.database_abstraction.select_user(user_id=user_id))
+        return cls(**session.database_abstraction.select_user(user_id=user_id), session=session)
     
     def write(self):
         """
         Method for writing a user.
         """
-        if self.new:
-            self.new = False
-            self.session.database_abstraction.insert_user(data=s_vars(self))
-            return
-        self.session.database_abstraction.update_user(user_id=self.user_id, updator={"$set": s_vars(self)})
+        self.write_document(
+            insert=lambda data: self.session.persist_insert(USER, data),
+            update=lambda changes, additions: self.session.persist_update(USER, self.user_id, changes, additions),
+            stats=self.session.write_stats
+        )
+        self.session.index_user(self)
 
 
 
@@ -1,5 +1,63 @@
+LIKE_WEIGHT = 20
+
+TRANSITIONS_FIELD = "transitions"
+
+TRANSITION_TARGETS = 16
+
+
 def s_vars(__obj) -> dict:
     """
     Use like vars() but for objects with __slots__.
     """
-    return {slot: getattr(__obj, slot) for slot in __obj.__slots__ if not slot in ["_id", "session", "_cached"]}
\ No newline at end of file
+    return {slot: getattr(__obj, slot) for slot in __obj.__slots__ if not slot in ["_id", "_version", "session", "_cached", "_snapshot"]}
+
+
+def popularity_score(*, likes : int, views : int) -> int:
+    """
+    Calculate the popularity score of a dungeon.
+    """
+    return LIKE_WEIGHT * likes + views
+
+
+def transition_increments(counts : dict) -> dict[str, int]:
+    """
+    Get the $inc paths adding counts of rooms entered after each other to the stats of a dungeon.
+    """
+    return {
+        f"stats.{TRANSITIONS_FIELD}.{from_room}.{to_room}": count 
+        for from_room, targets in counts.items() 
+        for to_room, count in targets.items()
+    }
+
+
+def merge_transitions(transitions : dict, counts : dict) -> dict:
+    """
+    Get stored transition counts with counts added, without changing them. Room ids are stored as strings, as document keys have to be strings.
+    """
+    merged = {from_room: dict(targets) for from_room, targets in transitions.items()}
+    for from_room, targets in counts.items():
+        known = merged.setdefault(str(from_room), {})
+        for to_room, count in targets.items():
+            known[str(to_room)] = known.get(str(to_room), 0) + count
+        merged[str(from_room)] = top_transitions(known)
+    return merged
+
+
+def top_transitions(targets : dict, limit : int = TRANSITION_TARGETS) -> dict:
+    """
+    Get the counts of the limit rooms most often entered after a room.
+    """
+    if len(targets) <= limit:
+        return targets
+    return dict(sorted(targets.items(), key=lambda item: item[1], reverse=True)[:limit])
+
+
+def transition_unsets(transitions : dict, limit : int = TRANSITION_TARGETS) -> dict[str, str]:
+    """
+    Get the $unset paths removing all but the limit rooms most often entered after each room from the stats of a dungeon.
+    """
+    unsets = {}
+    for from_room, targets in transitions.items():
+        kept = top_transitions(targets, limit)
+        unsets.update({f"stats.{TRANSITIONS_FIELD}.{from_room}.{to_room}": "" for to_room in targets if to_room not in kept})
+    return unsets
@@ -0,0 +1,94 @@
+"""
+Submodule for validating and sanitizing room content before it is stored.
+"""
+from __future__ import annotations
+import re, hashlib, unicodedata
+from typing import Union
+from dataclasses import dataclass, field
+from .cache import IdentityMap
+
+MAX_ROOM_SIZE = 1 << 18
+
+MAX_ROOM_CHARACTERS = 4096
+
+UNSAFE_CHARACTERS = re.compile("[\x00-\x08\x0b-\x1f\x7f-\x9f\ud800-\udfff]")
+
+
+def normalize_content(content : str) -> str:
+    """
+    Remove control characters and lone surrogates, which can't be stored, and bring content into NFC.
+    """
+    if UNSAFE_CHARACTERS.search(content) is not None:
+        content = UNSAFE_CHARACTERS.sub("", content)
+    if not unicodedata.is_normalized("NFC", content):
+        content = unicodedata.normalize("NFC", content)
+    return content
+
+
+@dataclass(slots=True)
+class RoomVerdict:
+    """
+    Class for the outcome of validating room content.
+    Only whether content had to be normalized is kept, so remembered verdicts stay small however large rooms are.
+    """
+    error : Union[str, None] = field(kw_only=True, default=None)
+    normalized : bool = field(kw_only=True, default=False)
+    distinct_characters : int = field(kw_only=True, default=0)
+
+    @property
+    def valid(self) -> bool:
+        """
+        Whether the content may be stored.
+        """
+        return self.error is None
+
+
+class RoomValidator:
+    """
+    Class for checking room content against its length and the amount of distinct characters in it, remembering the verdict per content hash so identical resubmissions are free.
+    It doesn't know the tile layout of the Scratch project, so it can't tell whether the project can draw the content.
+    """
+    max_size : int
+    max_characters : int
+    verdicts : IdentityMap
+
+    def __init__(self, *, max_size : int = MAX_ROOM_SIZE, max_characters : int = MAX_ROOM_CHARACTERS, capacity : Union[int, None] = 4096, ttl : Union[float, None] = None):
+        self.max_size = max_size
+        self.max_characters = max_characters
+        self.verdicts = IdentityMap(capacity=capacity, ttl=ttl)
+
+    def judge(self, content : str) -> RoomVerdict:
+        """
+        Validate normalized content without looking at remembered verdicts.
+        """
+        if len(content) > self.max_size:
+            return RoomVerdict(error=f"Rooms can be at most {self.max_size} characters long.")
+        if (distinct := len(set(content))) > self.max_characters:
+            return RoomVerdict(error=f"Rooms can have at most {self.max_characters} distinct characters.")
+        return RoomVerdict(distinct_characters=distinct)
+
+    def validate(self, content : str) -> RoomVerdict:
+        """
+        Get the verdict on content, remembering it for the next time the same content is sent.
+        """
+        if not isinstance(content, str):
+            return RoomVerdict(error="Room content has to be a string.")
+        if len(content) > self.max_size:
+            return RoomVerdict(error=f"Rooms can be at most {self.max_size} characters long.")
+        digest = hashlib.sha256(content.encode("utf-8", "surrogatepass")).digest()
+        verdict = self.verdicts.get(digest)
+        if verdict is None:
+            normalized = normalize_content(content)
+            verdict = self.judge(normalized)
+            verdict.normalized = normalized != content
+            self.verdicts.put(digest, verdict)
+        return verdict
+
+    def sanitize(self, content : str) -> str:
+        """
+        Get content as it is stored. Raises ValueError if it isn't valid.
+        """
+        verdict = self.validate(content)
+        if not verdict.valid:
+            raise ValueError(verdict.error)
+        return normalize_content(content) if verdict.normalized else content
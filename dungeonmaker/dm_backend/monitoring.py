@@ -0,0 +1,183 @@
+"""
+Submodule for instrumenting request handlers and exporting metrics.
+"""
+from __future__ import annotations
+import sys, json, time, inspect, threading, functools, dataclasses, warnings, traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Union
+from scratchcommunication.cloudrequests import RequestHandler, ErrorMessage
+from .modules.dm.metrics import MetricsRegistry, RequestTrace, current_trace, COUNT_BUCKETS
+
+
+def instrument_requests(request_handler : RequestHandler, metrics : MetricsRegistry):
+    """
+    Wrap every registered request to record its latency, outcome and the database and Scratch calls it makes.
+    Requests that are already instrumented are skipped.
+    """
+    for name, specific in list(request_handler.requests.items()):
+        if getattr(specific.function, "__instrumented__", False):
+            continue
+        request_handler.requests[name] = dataclasses.replace(specific, function=instrument(specific.function, name=name, metrics=metrics))
+
+def instrument(function : Callable, *, name : str, metrics : MetricsRegistry) -> Callable:
+    """
+    Wrap one request function. Coroutine functions stay coroutine functions.
+    """
+    latency = metrics.histogram("dm_request_seconds", help="Duration of requests by handler.")
+    requests = metrics.counter("dm_requests_total", help="Requests by handler and outcome.")
+    db_calls = metrics.histogram("dm_request_db_calls", help="Database calls made per request.", buckets=COUNT_BUCKETS)
+    scratch_calls = metrics.histogram("dm_request_scratch_calls", help="Scratch API calls made per request.", buckets=COUNT_BUCKETS)
+
+    def finish(trace : RequestTrace, start : float, outcome : str):
+        latency.observe(time.perf_counter() - start, handler=name)
+        requests.inc(handler=name, outcome=outcome)
+        db_calls.observe(trace.db_calls, handler=name)
+        scratch_calls.observe(trace.scratch_calls, handler=name)
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            trace = RequestTrace()
+            token = current_trace.set(trace)
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await function(*args, **kwargs)
+                outcome = "ok"
+                return result
+            except ErrorMessage:
+                outcome = "rejected"
+                raise
+            finally:
+                current_trace.reset(token)
+                finish(trace, start, outcome)
+        async_wrapper.__instrumented__ = True
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        trace = RequestTrace()
+        token = current_trace.set(trace)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = function(*args, **kwargs)
+            outcome = "ok"
+            return result
+        except ErrorMessage:
+            outcome = "rejected"
+            raise
+        finally:
+            current_trace.reset(token)
+            finish(trace, start, outcome)
+    wrapper.__instrumented__ = True
+    return wrapper
+
+
+class MetricsServer:
+    """
+    Class for serving metrics in the Prometheus text format over HTTP.
+    """
+    metrics : MetricsRegistry
+    host : str
+    port : int
+    server : Union[ThreadingHTTPServer, None]
+    _thread : Union[threading.Thread, None]
+
+    def __init__(self, *, metrics : MetricsRegistry, host : str = "127.0.0.1", port : int = 9464):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start serving in a background thread.
+        """
+        if self.server is not None:
+            return
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self._thread is not None:
+            self._thread.join(5)
+        self.server = None
+        self._thread = None
+
+
+class MetricsReporter:
+    """
+    Class for periodically reporting a snapshot of the metrics, by default as a JSON line on stderr.
+    """
+    metrics : MetricsRegistry
+    interval : float
+    report : Callable[[dict[str, Any]], None]
+    _reporter : Union[threading.Thread, None]
+    _stop : threading.Event
+
+    def __init__(self, *, metrics : MetricsRegistry, interval : float = 60, report : Union[Callable[[dict[str, Any]], None], None] = None):
+        self.metrics = metrics
+        self.interval = interval
+        self.report = report or write_snapshot
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Start reporting in a background thread.
+        """
+        if self._reporter is not None and self._reporter.is_alive():
+            return
+        self._stop.clear()
+        self._reporter = threading.Thread(target=self._report_loop, name="MetricsReporter", daemon=True)
+        self._reporter.start()
+
+    def stop(self):
+        """
+        Stop reporting.
+        """
+        self._stop.set()
+        if self._reporter is not None:
+            self._reporter.join(5)
+        self._reporter = None
+
+    def _report_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report(self.metrics.snapshot())
+            except Exception:
+                warnings.warn(f"Couldn't report metrics: \n{traceback.format_exc()}", RuntimeWarning)
+
+
+def write_snapshot(snapshot : dict[str, Any]):
+    """
+    Write a metrics snapshot as a JSON line to stderr.
+    """
+    sys.stderr.write(json.dumps({"time": time.time(), "metrics": snapshot}, default=str) + "\n")
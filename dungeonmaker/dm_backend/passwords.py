@@ -0,0 +1,176 @@
+"""
+Submodule for hashing and verifying passwords.
+"""
+from __future__ import annotations
+import os, hmac, pickle, base64, hashlib, secrets, asyncio, threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Union
+from .modules.dm.cache import IdentityMap
+from .modules.dm.dmtypes import UserId
+
+LEGACY_SALT = "Dungeon Maker: Reinvented - Login System Salt"
+SCRYPT_PREFIX = b"$scrypt$"
+
+
+@dataclass(slots=True, frozen=True)
+class ScryptParameters:
+    """
+    Class for the cost parameters of scrypt. It needs about 128 * n * r bytes of memory per hash.
+    """
+    n : int = field(kw_only=True, default=2**14)
+    r : int = field(kw_only=True, default=8)
+    p : int = field(kw_only=True, default=1)
+    salt_size : int = field(kw_only=True, default=16)
+    length : int = field(kw_only=True, default=32)
+
+    @property
+    def maxmem(self) -> int:
+        """
+        Memory limit passed to scrypt.
+        """
+        return 2 * 128 * self.n * self.r * self.p
+
+    def encode(self) -> bytes:
+        """
+        Encode the parameters for the hash header.
+        """
+        return f"n={self.n},r={self.r},p={self.p}".encode()
+
+    @classmethod
+    def decode(cls, data : bytes) -> ScryptParameters:
+        """
+        Decode the parameters of a hash header.
+        """
+        values = dict(item.split("=") for item in data.decode().split(","))
+        return cls(n=int(values["n"]), r=int(values["r"]), p=int(values["p"]))
+
+
+def gen_passdata(*, username : str, password : str) -> bytes:
+    """
+    Generate legacy passdata (version 1) for an account.
+    """
+    passdata = hashlib.sha3_256(pickle.dumps((username, password, LEGACY_SALT))).digest()
+    return passdata
+
+def passdata_version(passdata : bytes) -> int:
+    """
+    Get the format version of passdata. Version 1 is the legacy sha3 digest, version 2 is scrypt.
+    """
+    return 2 if passdata.startswith(SCRYPT_PREFIX) else 1
+
+def hash_password(password : str, *, params : ScryptParameters) -> bytes:
+    """
+    Hash a password into passdata of the current version.
+    """
+    salt = secrets.token_bytes(params.salt_size)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=params.n, r=params.r, p=params.p, maxmem=params.maxmem, dklen=params.length)
+    return b"$".join((SCRYPT_PREFIX.rstrip(b"$"), params.encode(), base64.b64encode(salt), base64.b64encode(digest)))
+
+def check_password(*, username : str, password : str, passdata : bytes) -> bool:
+    """
+    Check a password against passdata of any version.
+    """
+    if passdata_version(passdata) == 1:
+        return hmac.compare_digest(gen_passdata(username=username, password=password), passdata)
+    _, _, encoded_params, salt, digest = passdata.split(b"$")
+    params = ScryptParameters.decode(encoded_params)
+    digest = base64.b64decode(digest)
+    computed = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=params.n, r=params.r, p=params.p, maxmem=params.maxmem, dklen=len(digest))
+    return hmac.compare_digest(computed, digest)
+
+
+class PasswordHasher:
+    """
+    Class for hashing passwords on a process pool, so hashing does not hold the GIL of the request handler.
+    Successful verifications are cached for a while, keyed by a keyed digest of the password so no password is kept in memory.
+    """
+    params : ScryptParameters
+    processes : Union[int, None]
+    executor : Union[Executor, None]
+    verified : IdentityMap
+    _cache_key : bytes
+    _executor_lock : threading.Lock
+
+    def __init__(self, *, params : ScryptParameters = ScryptParameters(), processes : Union[int, None] = None, cache_capacity : Union[int, None] = 1024, cache_ttl : Union[float, None] = 600):
+        """
+        processes=0 hashes on the calling thread, which is best when the backend already runs on several processes.
+        """
+        self.params = params
+        self.processes = processes
+        self.executor = None
+        self.verified = IdentityMap(capacity=cache_capacity, ttl=cache_ttl)
+        self._cache_key = secrets.token_bytes(32)
+        self._executor_lock = threading.Lock()
+
+    def hash(self, password : str) -> bytes:
+        """
+        Hash a password.
+        """
+        if self.processes == 0:
+            return hash_password(password, params=self.params)
+        return self._get_executor().submit(hash_password, password, params=self.params).result()
+
+    async def hash_async(self, password : str) -> bytes:
+        """
+        Hash a password without blocking the event loop.
+        """
+        if self.processes == 0:
+            return await asyncio.to_thread(hash_password, password, params=self.params)
+        return await asyncio.wrap_future(self._get_executor().submit(hash_password, password, params=self.params))
+
+    def verify(self, *, user_id : UserId, username : str, password : str, passdata : bytes) -> bool:
+        """
+        Verify the password of a user.
+        """
+        key = self._key(user_id, password, passdata)
+        if self.verified.get(key):
+            return True
+        if self.processes == 0:
+            result = check_password(username=username, password=password, passdata=passdata)
+        else:
+            result = self._get_executor().submit(check_password, username=username, password=password, passdata=passdata).result()
+        if result:
+            self.verified.put(key, True)
+        return result
+
+    async def verify_async(self, *, user_id : UserId, username : str, password : str, passdata : bytes) -> bool:
+        """
+        Verify the password of a user without blocking the event loop.
+        """
+        key = self._key(user_id, password, passdata)
+        if self.verified.get(key):
+            return True
+        if self.processes == 0:
+            result = await asyncio.to_thread(check_password, username=username, password=password, passdata=passdata)
+        else:
+            result = await asyncio.wrap_future(self._get_executor().submit(check_password, username=username, password=password, passdata=passdata))
+        if result:
+            self.verified.put(key, True)
+        return result
+
+    def needs_rehash(self, passdata : bytes) -> bool:
+        """
+        Check if passdata uses an old version or other parameters than the current ones.
+        """
+        if passdata_version(passdata) != 2:
+            return True
+        return passdata.split(b"$")[2] != self.params.encode()
+
+    def close(self):
+        """
+        Shut down the process pool.
+        """
+        with self._executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def _key(self, user_id : UserId, password : str, passdata : bytes) -> tuple[UserId, bytes, bytes]:
+        return (user_id, passdata, hmac.digest(self._cache_key, password.encode(), "sha256"))
+
+    def _get_executor(self) -> Executor:
+        with self._executor_lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.processes or os.cpu_count())
+            return self.executor
@@ -0,0 +1,96 @@
+"""
+Submodule for simulating cloud clients and the Scratch project, so the backend can run without a network.
+"""
+from __future__ import annotations
+import queue, secrets, threading
+from dataclasses import dataclass, field
+from scratchcommunication.cloudrequests import RequestHandler
+
+
+class SimulatedProject:
+    """
+    Class standing in for a Scratch project with comments.
+    """
+    id : int
+    _comments : list[dict]
+    _lock : threading.Lock
+
+    def __init__(self, *, project_id : int = 0):
+        self.id = project_id
+        self._comments = []
+        self._lock = threading.Lock()
+
+    def post_comment(self, *, author : str, content : str) -> int:
+        """
+        Post a comment. Returns its id.
+        """
+        with self._lock:
+            comment_id = len(self._comments) + 1
+            self._comments.append({"id": comment_id, "author": {"username": author}, "content": content})
+        return comment_id
+
+    def comments(self, *, limit : int = 40, offset : int = 0) -> list[dict]:
+        """
+        Get comments, newest first, like the Scratch API returns them.
+        """
+        with self._lock:
+            newest_first = self._comments[::-1]
+        return newest_first[offset:offset + limit]
+
+
+@dataclass(slots=True)
+class SimulatedClient:
+    """
+    Class standing in for a client connected through the cloud socket.
+    """
+    client_id : str = field(kw_only=True)
+    username : str = field(kw_only=True)
+    responses : queue.SimpleQueue = field(kw_only=True, default_factory=queue.SimpleQueue)
+
+    def send(self, data : str):
+        """
+        Receive a response from the backend.
+        """
+        self.responses.put(data)
+
+    def recv(self, timeout : float = 10) -> str:
+        """
+        Wait for the next response.
+        """
+        try:
+            return self.responses.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No response from the backend.") from None
+
+    def emit(self, event : str, **kwargs):
+        """
+        Events are ignored.
+        """
+
+
+class CloudDriver:
+    """
+    Class for sending requests to a request handler the way its cloud loop does, and waiting for the responses.
+    Works with every request handler of the backend, including the ones answering on other threads or processes.
+    """
+    request_handler : RequestHandler
+    timeout : float
+
+    def __init__(self, *, request_handler : RequestHandler, timeout : float = 30):
+        self.request_handler = request_handler
+        self.timeout = timeout
+
+    def connect(self, *, username : str) -> SimulatedClient:
+        """
+        Connect a new simulated client.
+        """
+        return SimulatedClient(client_id=secrets.token_hex(8), username=username)
+
+    def request(self, client : SimulatedClient, msg : str) -> str:
+        """
+        Send a raw request and wait for its response.
+        """
+        response = self.request_handler.process_request(msg=msg, client=client, username=client.username, send_response=client.send)
+        if response:
+            return response
+        return client.recv(timeout=self.timeout)
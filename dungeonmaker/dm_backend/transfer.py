@@ -0,0 +1,184 @@
+"""
+Submodule for transferring room content in chunks, so large rooms fit through the cloud socket and uploads can be resumed.
+"""
+from __future__ import annotations
+import zlib, base64, binascii, secrets
+from typing import Sequence, Union
+from dataclasses import dataclass, field
+from .modules.dm.cache import IdentityMap
+from .modules.dm.dmtypes import DungeonId, RoomId, UserId
+from .modules.dm.tiles import encode_room, decode_room
+from .modules.dm.validation import MAX_ROOM_SIZE
+
+CHUNK_SIZE = 1024
+
+MIN_CHUNK_SIZE = 64
+
+MAX_CHUNK_SIZE = 8192
+
+MAX_CONTENT_SIZE = MAX_ROOM_SIZE
+
+# Encoded as text, every character takes up to 4 bytes of UTF-8 after a header of at most 28 bytes.
+MAX_ENCODED_SIZE = 4 * MAX_CONTENT_SIZE + 28
+
+
+def checksum(text : str) -> int:
+    """
+    Get the CRC-32 of text, which clients send along with chunks and compare with the ones they receive.
+    """
+    return zlib.crc32(text.encode())
+
+def clamp_chunk_size(chunk_size : Union[int, None]) -> int:
+    """
+    Keep a requested chunk size within the supported range.
+    """
+    return min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, chunk_size or CHUNK_SIZE))
+
+def chunk_count(size : int, chunk_size : int) -> int:
+    """
+    Get the amount of chunks content of a size is split into. Empty content is one empty chunk.
+    """
+    return max(1, -(-size // chunk_size))
+
+def content_chunk(content : str, index : int, *, chunk_size : int = CHUNK_SIZE) -> dict:
+    """
+    Get one chunk of content, with the checksums of the chunk and of the whole content.
+    A client resumes a download by asking for the chunks it is missing and restarts it if the checksum of the whole content changed.
+    """
+    count = chunk_count(len(content), chunk_size)
+    if not 0 <= index < count:
+        raise IndexError(f"There are only {count} chunks.")
+    data = content[index * chunk_size:(index + 1) * chunk_size]
+    return {"index": index, "chunks": count, "size": len(content), "crc": checksum(data), "content_crc": checksum(content), "data": data}
+
+def apply_delta(content : str, edits : Sequence[Sequence]) -> str:
+    """
+    Apply edits given as [start, end, replacement] to content. Positions refer to the content before any edit and edits may not overlap.
+    """
+    pieces = []
+    position = 0
+    for edit in sorted(edits, key=lambda edit: edit[0]):
+        start, end, replacement = edit
+        if not (isinstance(start, int) and isinstance(end, int) and isinstance(replacement, str)):
+            raise ValueError("Edits have to be [start, end, replacement].")
+        if start < position or end < start or end > len(content):
+            raise ValueError("Edits are out of range or overlap.")
+        pieces.append(content[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(content[position:])
+    return "".join(pieces)
+
+def encoded_content(content : str) -> str:
+    """
+    Encode content in the tile grid format as base64, which is usually much shorter than the string form for the cloud socket to send.
+    """
+    return base64.b64encode(encode_room(content)).decode()
+
+def decoded_content(data : str) -> str:
+    """
+    Decode content sent by encoded_content. Raises ValueError if it isn't valid.
+    """
+    try:
+        encoded = base64.b64decode(data, validate=True)
+    except binascii.Error:
+        raise ValueError("Encoded room is not valid base64.") from None
+    if len(encoded) > MAX_ENCODED_SIZE:
+        raise ValueError(f"Encoded rooms can be at most {MAX_ENCODED_SIZE} bytes long.")
+    return decode_room(encoded, max_size=MAX_CONTENT_SIZE)
+
+
+@dataclass(slots=True)
+class Upload:
+    """
+    Class for the chunks of an upload received so far.
+    """
+    upload_id : str = field(kw_only=True)
+    user_id : UserId = field(kw_only=True)
+    room_id : RoomId = field(kw_only=True)
+    bound_dungeon : DungeonId = field(kw_only=True)
+    size : int = field(kw_only=True)
+    content_crc : int = field(kw_only=True)
+    chunk_size : int = field(kw_only=True)
+    chunks : dict[int, str] = field(kw_only=True, default_factory=dict)
+
+    @property
+    def count(self) -> int:
+        """
+        Amount of chunks of the upload.
+        """
+        return chunk_count(self.size, self.chunk_size)
+
+    def missing(self) -> list[int]:
+        """
+        Get the indices of the chunks not received yet.
+        """
+        return [index for index in range(self.count) if index not in self.chunks]
+
+    def add(self, index : int, data : str, crc : int):
+        """
+        Store a chunk after checking it. Sending a chunk again replaces it.
+        """
+        if not 0 <= index < self.count:
+            raise ValueError(f"There are only {self.count} chunks.")
+        expected = min(self.chunk_size, self.size - index * self.chunk_size)
+        if len(data) != expected:
+            raise ValueError(f"Chunk {index} has to be {expected} characters long.")
+        if checksum(data) != crc:
+            raise ValueError(f"Checksum of chunk {index} doesn't match.")
+        self.chunks[index] = data
+
+    def assemble(self) -> str:
+        """
+        Join all chunks and check the checksum of the content.
+        """
+        if (missing := self.missing()):
+            raise ValueError(f"Chunks {missing} are missing.")
+        content = "".join(self.chunks[index] for index in range(self.count))
+        if checksum(content) != self.content_crc:
+            raise ValueError("Checksum of the content doesn't match.")
+        return content
+
+
+class UploadStore:
+    """
+    Class for keeping unfinished uploads, dropping ones idle for longer than ttl and the oldest ones above capacity.
+    """
+    uploads : IdentityMap
+
+    def __init__(self, *, ttl : Union[float, None] = 600, capacity : Union[int, None] = 1000):
+        self.uploads = IdentityMap(capacity=capacity, ttl=ttl)
+
+    def begin(self, *, user_id : UserId, room_id : RoomId, bound_dungeon : DungeonId, size : int, content_crc : int, chunk_size : int = None) -> Upload:
+        """
+        Start an upload.
+        """
+        if not 0 <= size <= MAX_CONTENT_SIZE:
+            raise ValueError(f"Rooms can be at most {MAX_CONTENT_SIZE} characters long.")
+        upload = Upload(
+            upload_id=secrets.token_hex(8),
+            user_id=user_id,
+            room_id=room_id,
+            bound_dungeon=bound_dungeon,
+            size=size,
+            content_crc=content_crc,
+            chunk_size=clamp_chunk_size(chunk_size)
+        )
+        self.uploads.put(upload.upload_id, upload)
+        return upload
+
+    def get(self, upload_id : str, *, user_id : UserId) -> Upload:
+        """
+        Get an unfinished upload of a user.
+        """
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload.user_id != user_id:
+            raise KeyError("Upload not found.")
+        self.uploads.put(upload_id, upload)
+        return upload
+
+    def finish(self, upload_id : str):
+        """
+        Forget an upload.
+        """
+        self.uploads.pop(upload_id)
@@ -25,5 +25,9 @@ setup(
         'pymongo',
         'scratchattach',
     ],
+    extras_require={
+        'fast': ['numpy'],
+        'test': ['pytest', 'mongomock==4.3.0'],
+    },
     python_requires='>=3.11',
 )
@@ -0,0 +1,53 @@
+"""
+Fixtures for running the database abstractions against mongomock.
+"""
+import pytest
+from dungeonmaker.dm_backend.modules.database.basetypes import BaseMongoDBAtlasSession
+from dungeonmaker.dm_backend.modules.database.dba import MongoDBDatabaseAbstraction
+
+mongomock = pytest.importorskip("mongomock")
+
+
+def _without_sort(method):
+    def wrapper(self, *args, sort=None, **kwargs):
+        assert sort is None, "mongomock can't sort bulk updates"
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+@pytest.fixture(autouse=True, scope="session")
+def mongomock_bulk_sort():
+    """
+    pymongo 4.11 and later pass sort to bulk updates, which mongomock 4.3 doesn't accept. The backend never sorts them.
+    """
+    builder = mongomock.collection.BulkOperationBuilder
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(builder, "add_update", _without_sort(builder.add_update))
+        patch.setattr(builder, "add_replace", _without_sort(builder.add_replace))
+        yield
+
+
+class MockMongoDBAtlasSession(BaseMongoDBAtlasSession):
+    """
+    Class for MongoDB Atlas sessions backed by mongomock.
+    """
+    def __init__(self):
+        super().__init__(URI="mongomock://localhost")
+        self.client = mongomock.MongoClient()
+        self.db = self.client["dungeon_maker_reinvented_db"]
+        self.users = self.db["users"]
+        self.rooms = self.db["rooms"]
+        self.room_contents = self.db["room_contents"]
+        self.dungeons = self.db["dungeons"]
+
+
+@pytest.fixture
+def mongo_session() -> MockMongoDBAtlasSession:
+    return MockMongoDBAtlasSession()
+
+
+@pytest.fixture
+def mongo_dba(mongo_session) -> MongoDBDatabaseAbstraction:
+    dba = MongoDBDatabaseAbstraction(connection=mongo_session)
+    dba.ensure_indexes()
+    return dba
@@ -0,0 +1,115 @@
+import asyncio, dataclasses, json, threading, zlib
+import pytest
+from dungeonmaker.dm_backend.async_backend import AsyncDMBackend
+from dungeonmaker.dm_backend.modules.dm.async_dba import ThreadedDatabaseAbstraction
+from dungeonmaker.dm_backend.passwords import PasswordHasher, ScryptParameters, gen_passdata, passdata_version
+from dungeonmaker.dm_backend.simulation import CloudDriver, SimulatedProject
+
+
+@pytest.fixture
+def backend(mongo_dba):
+    project = SimulatedProject()
+    backend = AsyncDMBackend(
+        cloud=None,
+        project_id=project.id,
+        project=project,
+        database_abstraction=ThreadedDatabaseAbstraction(mongo_dba),
+        password_hasher=PasswordHasher(params=ScryptParameters(n=2**4))
+    )
+    backend.comment_index.min_refresh_interval = 0
+    backend.register_requests()
+    backend.loop_thread = threading.Thread(target=backend.loop.run_forever, daemon=True)
+    backend.loop_thread.start()
+    asyncio.run_coroutine_threadsafe(backend.setup(), backend.loop).result()
+    yield backend
+    asyncio.run_coroutine_threadsafe(backend.prefetcher.stop(), backend.loop).result()
+    asyncio.run_coroutine_threadsafe(backend.dm_session.close(), backend.loop).result()
+    backend.loop.call_soon_threadsafe(backend.loop.stop)
+    backend.loop_thread.join(5)
+
+
+@pytest.fixture
+def driver(backend) -> CloudDriver:
+    return CloudDriver(request_handler=backend.request_handler, timeout=5)
+
+
+def sign_up(backend, driver, username):
+    backend.project.post_comment(author=username, content=f"My account: {username}")
+    client = driver.connect(username=username)
+    assert driver.request(client, f'sign_up("{username}", "password")') == "Success!"
+    return client
+
+
+def save_dungeon(backend, driver, client, dungeon_id=7, start_room=1):
+    backend.project.post_comment(author=client.username, content=f"Set name of {dungeon_id} to Cave")
+    return json.loads(driver.request(client, f'save_dungeon({start_room}, 0, 0, name="Cave", dungeon_id={dungeon_id})'))
+
+
+def test_sign_up_and_login(backend, driver):
+    sign_up(backend, driver, "alice")
+    client = driver.connect(username="alice")
+    assert driver.request(client, 'login("alice", "wrong")') == "Wrong credentials"
+    assert driver.request(client, 'login("alice", "password")') == "Success!"
+    profile = json.loads(driver.request(client, "load_private_profile()"))["result"]
+    assert profile["username"] == "alice"
+    assert profile["passdata"] == "maybe not"
+    assert backend.db_abstraction.database_abstraction.connection.users.count_documents({"username": "alice"}) == 1
+
+
+def test_legacy_passwords_are_rehashed_on_login(backend, driver):
+    sign_up(backend, driver, "alice")
+    users = backend.db_abstraction.database_abstraction.connection.users
+    legacy = {key: value for key, value in users.find_one({"username": "alice"}).items() if key != "_id"}
+    users.insert_one({**legacy, "user_id": "legacy", "username": "bob", "passdata": gen_passdata(username="bob", password="password")})
+    client = driver.connect(username="bob")
+    assert driver.request(client, 'login("bob", "password")') == "Success!"
+    asyncio.run_coroutine_threadsafe(backend.dm_session.flush(), backend.loop).result()
+    passdata = users.find_one({"username": "bob"})["passdata"]
+    assert passdata_version(passdata) == 2
+    assert not backend.passwords.needs_rehash(passdata)
+    assert driver.request(driver.connect(username="bob"), 'login("bob", "password")') == "Success!"
+
+
+def test_save_and_load_rooms(backend, driver):
+    client = sign_up(backend, driver, "alice")
+    assert save_dungeon(backend, driver, client) == {"dungeon_id": 7, "success": True}
+    assert driver.request(client, 'save_room(1, "abc", 7)') == "Success!"
+    assert driver.request(client, "load_room(1)") == "abc"
+    assert driver.request(client, 'save_room(1, "cafe\u0301", 7)') == "Success!"
+    saved = json.loads(driver.request(client, 'save_room_delta(1, 7, %d, 4, 4, "s")' % zlib.crc32("caf\u00e9".encode())))
+    assert saved == {"success": True, "content_crc": zlib.crc32("caf\u00e9s".encode())}
+    assert driver.request(client, "load_room(1)") == "caf\u00e9s"
+    assert driver.request(client, 'save_room(2, "x", 8)') == "Dungeon does not exist."
+    other = sign_up(backend, driver, "bob")
+    assert driver.request(other, 'save_room(1, "def", 7)') == "Not authorized"
+
+
+def test_like_unlike_and_tabs(backend, driver):
+    client = sign_up(backend, driver, "alice")
+    save_dungeon(backend, driver, client)
+    assert driver.request(client, "like_dungeon(7)") == "Success!"
+    assert driver.request(client, "like_dungeon(7)") == "Success!"
+    dungeons = backend.db_abstraction.database_abstraction.connection.dungeons
+    dungeon = dungeons.find_one({"dungeon_id": 7})
+    assert (dungeon["likers"], dungeon["like_count"]) == ([dungeon["owner"]], 1)
+    assert driver.request(client, "unlike_dungeon(7)") == "Success!"
+    assert dungeons.find_one({"dungeon_id": 7})["like_count"] == 0
+    assert isinstance(json.loads(driver.request(client, 'load_tab("new")')), list)
+    assert driver.request(client, 'load_tab_page("new", "nonsense")') == "Invalid page."
+
+
+def test_every_slot_is_set(backend):
+    for slot in dataclasses.fields(backend):
+        getattr(backend, slot.name)
+    assert backend.local_tier is None
+
+
+def test_tabs_are_served_from_the_feed(backend, driver):
+    backend.dm_session.tab_feeds.min_refresh_interval = 0
+    client = sign_up(backend, driver, "alice")
+    save_dungeon(backend, driver, client)
+    assert [dungeon["dungeon_id"] for dungeon in json.loads(driver.request(client, 'load_tab("new")'))] == [7]
+    assert backend.dm_session.tab_feeds._feeds["new"].dungeon_ids == [7]
+    save_dungeon(backend, driver, client, dungeon_id=8, start_room=2)
+    assert [dungeon["dungeon_id"] for dungeon in json.loads(driver.request(client, 'load_tab("new")'))] == [8, 7]
+    assert backend.dm_session.tab_feeds._feeds["new"].dungeon_ids == [8, 7]
@@ -0,0 +1,40 @@
+from dungeonmaker.dm_backend.modules.dm import cache
+from dungeonmaker.dm_backend.modules.dm.cache import IdentityMap
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entries_are_evicted():
+    evicted = []
+    identity_map = IdentityMap(capacity=2, on_evict=lambda key, value: evicted.append(key))
+    identity_map.put("a", 1)
+    identity_map.put("b", 2)
+    assert identity_map.get("a") == 1
+    identity_map.put("c", 3)
+    assert evicted == ["b"]
+    assert ("a" in identity_map, "b" in identity_map, "c" in identity_map) == (True, False, True)
+    assert identity_map.stats.evictions == 1
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    identity_map = IdentityMap(ttl=10)
+    identity_map.put("a", 1)
+    identity_map.put("b", 2)
+    clock.now += 5
+    identity_map.put("b", 3)
+    clock.now += 6
+    assert identity_map.peek("a") is None
+    assert identity_map.get("a") is None
+    assert identity_map.get("b") == 3
+    clock.now += 11
+    assert identity_map.prune() == 1
+    assert len(identity_map) == 0
+    assert (identity_map.stats.expirations, identity_map.stats.misses, identity_map.stats.hits) == (2, 1, 1)
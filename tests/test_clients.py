@@ -0,0 +1,65 @@
+import pytest
+from dungeonmaker.dm_backend import clients
+from dungeonmaker.dm_backend.clients import ClientRecord, MemoryClientStore, MongoDBClientStore
+from dungeonmaker.dm_backend.modules.dm import cache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    monkeypatch.setattr(clients.time, "monotonic", clock)
+    monkeypatch.setattr(clients.time, "time", clock)
+    return clock
+
+
+def test_least_recently_seen_clients_are_dropped(clock):
+    store = MemoryClientStore(capacity=2)
+    store.get("a").log_in(username="alice", user_id="u1")
+    store.get("b")
+    assert store.get("a").logged_in
+    store.get("c")
+    assert len(store) == 2
+    assert store.get("a").username == "alice"
+    assert not store.get("b").logged_in
+
+
+def test_idle_clients_are_pruned(clock):
+    store = MemoryClientStore(ttl=60, prune_interval=30)
+    store.get("a").log_in(username="alice", user_id="u1")
+    clock.now += 20
+    store.get("b")
+    clock.now += 50
+    assert store.get("b").client_id == "b"
+    assert len(store) == 1
+    assert not store.get("a").logged_in
+
+
+def test_password_reset_codes_expire(clock):
+    record = ClientRecord(client_id="a")
+    code = record.new_password_reset_code(ttl=900)
+    assert not record.check_password_reset_code(code + 1)
+    assert record.check_password_reset_code(code)
+    clock.now += 901
+    assert not record.check_password_reset_code(code)
+    assert record.password_reset_code is None
+
+
+def test_mongodb_client_store(mongo_session):
+    store = MongoDBClientStore(collection=mongo_session.db["clients"])
+    store.ensure_indexes()
+    assert store.get("a") == ClientRecord(client_id="a")
+    record = store.get("a")
+    record.log_in(username="alice", user_id="u1")
+    store.save(record)
+    assert store.get("a") == record
+    store.discard("a")
+    assert not store.get("a").logged_in
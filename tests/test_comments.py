@@ -0,0 +1,19 @@
+import queue
+from dungeonmaker.dm_backend.comments import CommentRelay, RelayedCommentIndex
+from dungeonmaker.dm_backend.simulation import SimulatedProject
+
+
+def test_workers_get_comments_from_the_relay():
+    project = SimulatedProject()
+    requests, relayed = queue.Queue(), [queue.Queue(), queue.Queue()]
+    relay = CommentRelay(project=project, queues=relayed, requests=requests, poll_interval=60, min_refresh_interval=0)
+    workers = [RelayedCommentIndex(requests=requests, relayed=inbox, worker=i, timeout=5) for i, inbox in enumerate(relayed)]
+    relay.start()
+    try:
+        project.post_comment(author="alice", content="My account: alice")
+        assert workers[0].find(user="alice", content="My account: alice")
+        assert workers[1].refresh() == 1
+        assert workers[1].lookup(user="alice")
+        assert not workers[1].find(user="bob")
+    finally:
+        relay.stop()
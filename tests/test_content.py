@@ -0,0 +1,43 @@
+import zlib
+import pytest
+from dungeonmaker.dm_backend.modules.database import InMemoryDatabaseAbstraction
+from dungeonmaker.dm_backend.modules.dm.content import CONTENT_HASH_FIELD, RoomContentStore, content_hash, pack_content, unpack_content
+from dungeonmaker.dm_backend.modules.dm.session import DMSession
+from dungeonmaker.dm_backend.modules.dm.selectors import ROOM
+
+
+@pytest.mark.parametrize(("content", "codec"), [("abc", "raw"), ("ab" * 300, "grid-zlib"), ("".join(chr(0x4e00 + i) for i in range(200)), "grid-zlib")])
+def test_codecs_round_trip(content, codec):
+    document = pack_content(content)
+    assert (document[CONTENT_HASH_FIELD], document["codec"], document["size"]) == (content_hash(content), codec, len(content.encode()))
+    assert unpack_content(document) == content
+
+
+def test_legacy_zlib_documents_are_read():
+    assert unpack_content({"codec": "zlib", "data": zlib.compress(b"abc")}) == "abc"
+    with pytest.raises(ValueError, match="Unknown content codec"):
+        unpack_content({"codec": "lz4", "data": b""})
+
+
+def test_stored_content_is_deduplicated():
+    store = RoomContentStore()
+    room, document = store.externalize({"room_id": 1, "content": "abc"})
+    assert room == {"room_id": 1, "content": None, CONTENT_HASH_FIELD: content_hash("abc")}
+    store.stored(document, "abc")
+    other, document = store.externalize({"room_id": 2, "content": "abc"})
+    assert (other[CONTENT_HASH_FIELD], document) == (room[CONTENT_HASH_FIELD], None)
+    assert store.stats.deduplicated == 1
+    assert store.externalize({"room_id": 3, "name": "Hall"}) == ({"room_id": 3, "name": "Hall"}, None)
+
+
+def test_write_behind_queues_room_content_until_the_rooms_are_flushed():
+    dba = InMemoryDatabaseAbstraction()
+    session = DMSession(database_abstractions=[dba], write_behind=True)
+    session.persist_insert(ROOM, {"room_id": 1, "dungeon_id": 7, "content": "abc"})
+    session.persist_insert(ROOM, {"room_id": 2, "dungeon_id": 7, "content": "abc"})
+    assert dba.collections["room_contents"] == {} and dba.collections["rooms"] == {}
+    assert session.load_room_content({"room_id": 1, CONTENT_HASH_FIELD: content_hash("abc")})["content"] == "abc"
+    session.flush()
+    assert list(dba.collections["room_contents"]) == [content_hash("abc")]
+    assert session.load_room_contents(dba.select_rooms(room_ids=[1, 2]))[1]["content"] == "abc"
+    assert session.room_contents.stats.to_object()["stored"] == 1
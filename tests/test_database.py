@@ -0,0 +1,79 @@
+import pytest
+from dungeonmaker.dm_backend.modules.database.dba import MongoDBDatabaseAbstraction, USERNAME_INDEX
+from dungeonmaker.dm_backend.modules.database.migrations import MigrationError, create_indexes
+from dungeonmaker.dm_backend.modules.dm.unit_of_work import WriteOperation
+from dungeonmaker.dm_backend.modules.dm.session import DMSession
+from dungeonmaker.dm_backend.modules.dm.selectors import DUNGEON
+from dungeonmaker.dm_backend.modules.dm.utils import LIKE_WEIGHT, TRANSITION_TARGETS
+
+
+def insert_dungeon(mongo_dba, dungeon_id=1):
+    mongo_dba.connection.dungeons.insert_one({"dungeon_id": dungeon_id, "likers": [], "like_count": 0, "views": 0, "score": 0})
+
+
+def test_like_unlike_and_view_update_counts(mongo_dba):
+    insert_dungeon(mongo_dba)
+    assert mongo_dba.add_liker(1, "a")["like_count"] == 1
+    assert mongo_dba.add_liker(1, "a") is None
+    counts = mongo_dba.add_view(1)
+    assert (counts["views"], counts["score"]) == (1, LIKE_WEIGHT + 1)
+    assert mongo_dba.remove_liker(1, "a")["score"] == 1
+    assert mongo_dba.remove_liker(1, "a") is None
+    assert mongo_dba.connection.dungeons.find_one({"dungeon_id": 1})["likers"] == []
+
+
+def test_add_view_of_missing_dungeon(mongo_dba):
+    assert mongo_dba.add_view(2) is None
+
+
+def test_transitions_keep_the_most_entered_rooms(mongo_dba):
+    insert_dungeon(mongo_dba)
+    mongo_dba.add_room_transitions(transitions={1: {5: {6: 3, 7: 2}}})
+    mongo_dba.add_room_transitions(transitions={1: {5: {room_id: 1 for room_id in range(100, 100 + TRANSITION_TARGETS)}}})
+    targets = mongo_dba.connection.dungeons.find_one({"dungeon_id": 1})["stats"]["transitions"]["5"]
+    assert len(targets) == TRANSITION_TARGETS
+    assert (targets["6"], targets["7"]) == (3, 2)
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_stale_workers_keep_each_others_rooms(mongo_dba, write_behind):
+    first, second = (DMSession(write_behind=write_behind) for _ in range(2))
+    for session in (first, second):
+        session.add_database_abstraction(mongo_dba)
+    dungeon = first.create(DUNGEON, kwargs={"dungeon_id": 1, "name": "Cave", "description": "", "owner": "u", "owner_name": "alice", "start": ()})
+    dungeon.write()
+    first.flush()
+    stale = second.find(DUNGEON, 1)
+    dungeon.new_room(room_id=10).write()
+    dungeon.write()
+    stale.new_room(room_id=20).write()
+    stale.write()
+    first.flush()
+    second.flush()
+    assert mongo_dba.connection.dungeons.find_one({"dungeon_id": 1})["rooms"] == [10, 20]
+
+
+def test_usernames_are_unique(mongo_session):
+    mongo_session.users.create_index([("username", 1)])
+    dba = MongoDBDatabaseAbstraction(connection=mongo_session)
+    dba.ensure_indexes()
+    assert mongo_session.users.index_information()[USERNAME_INDEX]["unique"]
+    dba.insert_user(data={"user_id": "a", "username": "alice"})
+    with pytest.warns(RuntimeWarning, match="unique index"):
+        dba.bulk_write(operations=[
+            WriteOperation(kind="insert", collection="users", key_field="user_id", key="b", data={"user_id": "b", "username": "alice"}),
+            WriteOperation(kind="insert", collection="users", key_field="user_id", key="c", data={"user_id": "c", "username": "carol"}),
+        ])
+    assert sorted(user["user_id"] for user in mongo_session.users.find()) == ["a", "c"]
+
+
+def test_create_indexes_reports_duplicate_usernames(mongo_session):
+    mongo_session.users.create_index([("username", 1)])
+    mongo_session.users.insert_many([{"user_id": "a", "username": "alice"}, {"user_id": "b", "username": "alice"}, {"user_id": "c", "username": "carol"}])
+    dba = MongoDBDatabaseAbstraction(connection=mongo_session)
+    with pytest.raises(MigrationError, match="'alice': users a, b"):
+        create_indexes(dba)
+    assert not mongo_session.users.index_information()[USERNAME_INDEX].get("unique")
+    mongo_session.users.update_one({"user_id": "b"}, {"$set": {"username": "bob"}})
+    create_indexes(dba)
+    assert mongo_session.users.index_information()[USERNAME_INDEX]["unique"]
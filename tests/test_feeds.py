@@ -0,0 +1,39 @@
+from dungeonmaker.dm_backend.modules.dm import feeds
+from dungeonmaker.dm_backend.modules.dm.feeds import TabFeedCache, NEWEST_TAB
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_feeds_refresh_when_invalidated_or_outdated(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(feeds.time, "monotonic", clock)
+    loads = []
+    def load(size):
+        loads.append(size)
+        return [len(loads) * 100 + position for position in range(size)]
+    tab_feeds = TabFeedCache(loaders={NEWEST_TAB: load}, size=5, refresh_interval=60, min_refresh_interval=5)
+    assert tab_feeds.page(NEWEST_TAB, amount=2) == [100, 101]
+    assert tab_feeds.page_after(NEWEST_TAB, 101, amount=2) == [102, 103]
+    assert tab_feeds.page(NEWEST_TAB, offset=4, amount=2) is None
+    tab_feeds.invalidate(NEWEST_TAB, "missing")
+    clock.now += 1
+    assert tab_feeds.page(NEWEST_TAB, amount=1) == [100]
+    clock.now += 5
+    assert tab_feeds.page(NEWEST_TAB, amount=1) == [200]
+    clock.now += 30
+    assert tab_feeds.page(NEWEST_TAB, amount=1) == [200]
+    clock.now += 30
+    assert tab_feeds.page(NEWEST_TAB, amount=1) == [300]
+    assert loads == [5, 5, 5]
+
+
+def test_short_feeds_are_complete():
+    tab_feeds = TabFeedCache(loaders={NEWEST_TAB: lambda size: [1, 2, 3]}, size=5)
+    assert tab_feeds.page(NEWEST_TAB, offset=2, amount=20) == [3]
+    assert tab_feeds.page_after(NEWEST_TAB, 4) is None
@@ -0,0 +1,47 @@
+import asyncio
+import pytest
+from scratchcommunication.cloudrequests import ErrorMessage
+from dungeonmaker.dm_backend.modules.database import InMemoryDatabaseAbstraction
+from dungeonmaker.dm_backend.modules.dm.metrics import MetricsRegistry, TimedDatabaseAbstraction
+from dungeonmaker.dm_backend.monitoring import instrument
+
+
+def test_histograms_count_into_buckets():
+    metrics = MetricsRegistry()
+    histogram = metrics.histogram("latency", buckets=(1, 2, 5))
+    for value in (0.5, 1.5, 1.5, 4, 10):
+        histogram.observe(value, handler="a")
+    series = histogram.snapshot()['{handler="a"}']
+    assert (series["count"], series["sum"], series["p50"], series["p99"]) == (5, 17.5, 2, float("inf"))
+    lines = metrics.to_prometheus().splitlines()
+    assert 'latency_bucket{handler="a",le="2"} 3' in lines
+    assert 'latency_bucket{handler="a",le="+Inf"} 5' in lines
+    assert metrics.histogram("latency") is histogram
+
+
+def test_counters_escape_label_values():
+    metrics = MetricsRegistry()
+    metrics.counter("requests").inc(handler='say "hi"\n')
+    metrics.counter("requests").inc(2, handler='say "hi"\n')
+    assert metrics.snapshot() == {"requests": {'{handler="say \\"hi\\"\\n"}': 3}}
+
+
+def test_requests_count_their_outcomes_and_database_calls():
+    metrics = MetricsRegistry()
+    dba = TimedDatabaseAbstraction(InMemoryDatabaseAbstraction(), metrics=metrics)
+
+    def load(user_id):
+        return dba.select_users(user_ids=[user_id])
+
+    async def reject():
+        raise ErrorMessage("No.")
+
+    assert instrument(load, name="load", metrics=metrics)("u1") == []
+    with pytest.raises(ErrorMessage):
+        asyncio.run(instrument(reject, name="reject", metrics=metrics)())
+    with pytest.raises(KeyError):
+        instrument(lambda: {}["x"], name="fail", metrics=metrics)()
+    snapshot = metrics.snapshot()
+    assert snapshot["dm_requests_total"] == {'{handler="load",outcome="ok"}': 1, '{handler="reject",outcome="rejected"}': 1, '{handler="fail",outcome="error"}': 1}
+    assert snapshot["dm_request_db_calls"]['{handler="load"}']["sum"] == 1
+    assert snapshot["dm_db_call_seconds"]['{method="select_users"}']["count"] == 1
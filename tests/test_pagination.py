@@ -0,0 +1,29 @@
+import pytest
+from dungeonmaker.dm_backend.modules.database import InMemoryDatabaseAbstraction
+from dungeonmaker.dm_backend.modules.dm.pagination import decode_cursor, encode_cursor
+
+
+@pytest.fixture(params=["mongo", "memory"])
+def dba(request):
+    if request.param == "memory":
+        return InMemoryDatabaseAbstraction()
+    return request.getfixturevalue("mongo_dba")
+
+
+def test_cursors_walk_tied_scores_without_gaps_or_repeats(dba):
+    scores = {1: 5, 2: 5, 3: 5, 4: 3, 5: 3, 6: 9}
+    for dungeon_id, score in scores.items():
+        dba.insert_dungeon(data={"dungeon_id": dungeon_id, "owner": "u", "owner_name": "alice", "name": "Cave", "description": "", "score": score})
+    seen, after = [], None
+    while True:
+        page = dba.sorted_dungeons(amount=2, field="score", aggregation=[], after=after)
+        seen.extend(data["dungeon_id"] for data in page)
+        if len(page) < 2:
+            break
+        after = decode_cursor(encode_cursor(page[-1]["score"], page[-1]["dungeon_id"]))
+    assert seen == [6, 3, 2, 1, 5, 4]
+
+
+def test_invalid_cursors_are_rejected():
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor("not a cursor")
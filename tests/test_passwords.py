@@ -0,0 +1,32 @@
+import asyncio
+from dungeonmaker.dm_backend.passwords import PasswordHasher, ScryptParameters, check_password, gen_passdata, hash_password, passdata_version
+
+PARAMS = ScryptParameters(n=2**4)
+
+
+def test_scrypt_passdata_round_trips():
+    passdata = hash_password("secret", params=PARAMS)
+    assert passdata_version(passdata) == 2
+    assert passdata != hash_password("secret", params=PARAMS)
+    assert check_password(username="alice", password="secret", passdata=passdata)
+    assert not check_password(username="alice", password="wrong", passdata=passdata)
+
+
+def test_legacy_passdata_is_checked_and_needs_rehash():
+    passdata = gen_passdata(username="alice", password="secret")
+    assert passdata_version(passdata) == 1
+    assert check_password(username="alice", password="secret", passdata=passdata)
+    assert not check_password(username="bob", password="secret", passdata=passdata)
+    hasher = PasswordHasher(params=PARAMS, processes=0)
+    assert hasher.needs_rehash(passdata)
+    assert not hasher.needs_rehash(hasher.hash("secret"))
+    assert PasswordHasher(params=ScryptParameters(n=2**5), processes=0).needs_rehash(hasher.hash("secret"))
+
+
+def test_successful_verifications_are_cached():
+    hasher = PasswordHasher(params=PARAMS, processes=0)
+    passdata = hasher.hash("secret")
+    assert not hasher.verify(user_id="u1", username="alice", password="wrong", passdata=passdata)
+    assert hasher.verify(user_id="u1", username="alice", password="secret", passdata=passdata)
+    assert asyncio.run(hasher.verify_async(user_id="u1", username="alice", password="secret", passdata=passdata))
+    assert (hasher.verified.stats.hits, len(hasher.verified)) == (1, 1)
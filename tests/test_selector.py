@@ -0,0 +1,37 @@
+import pytest
+from dungeonmaker.dm_backend.modules.database import InMemoryDatabaseAbstraction
+from dungeonmaker.dm_backend.modules.dm.dba import DATABASE_METHODS, DatabaseAbstractionSelector
+from dungeonmaker.dm_backend.modules.dm.dmtypes import BaseDatabaseAbstraction
+
+
+class UserOverride(BaseDatabaseAbstraction):
+    def select_user(self, user_id=None, *, fields=None):
+        return {"user_id": user_id, "source": "override"}
+
+    def ping(self):
+        return "pong"
+
+
+def test_methods_resolve_to_the_first_implementation():
+    override, memory = UserOverride(), InMemoryDatabaseAbstraction()
+    selector = DatabaseAbstractionSelector([override])
+    assert selector.select_user("u1")["source"] == "override"
+    assert "select_users" in selector.missing()
+    with pytest.raises(NotImplementedError, match="select_users"):
+        selector.validate()
+    selector.validate("select_user")
+    selector.add(memory)
+    assert selector.dispatch_table["select_user"] == override.select_user
+    assert selector.dispatch_table["select_users"] == memory.select_users
+    assert selector.missing() == [name for name in DATABASE_METHODS if name not in selector.dispatch_table] == []
+    assert selector.select_users(user_ids=["u1"]) == []
+
+
+def test_other_attributes_are_forwarded():
+    memory = InMemoryDatabaseAbstraction()
+    selector = DatabaseAbstractionSelector([UserOverride(), memory])
+    assert selector.ping() == "pong"
+    assert "ping" in selector.dispatch_table
+    assert selector.collections is memory.collections
+    with pytest.raises(AttributeError, match="nothing"):
+        selector.nothing
@@ -0,0 +1,29 @@
+from dungeonmaker.dm_backend.modules.database import InMemoryDatabaseAbstraction
+from dungeonmaker.dm_backend.modules.dm.session import DMSession
+from dungeonmaker.dm_backend.modules.dm.selectors import USER, USERNAME, LINKED_USER
+
+
+def seed_dungeons(dba, amount):
+    for index in range(amount):
+        dba.insert_user(data={"user_id": f"u{index}", "username": f"player{index}", "passdata": b""})
+        owner_name = "stored" if index == 0 else None
+        dba.insert_dungeon(data={"dungeon_id": index, "name": "Cave", "description": "", "owner": f"u{index}", "owner_name": owner_name, "start": (), "score": index})
+
+
+def test_tab_pages_resolve_missing_owner_names_with_one_query():
+    dba = InMemoryDatabaseAbstraction()
+    seed_dungeons(dba, 3)
+    session = DMSession(database_abstractions=[dba])
+    dba.calls = 0
+    dungeons = session.get_random_tab(amount=3)
+    assert sorted(dungeon.owner_name for dungeon in dungeons) == ["player1", "player2", "stored"]
+    assert dba.calls == 2
+    session.get_random_tab(amount=3)
+    assert dba.calls == 3
+
+
+def test_name_locks_dont_collide_with_user_locks():
+    session = DMSession()
+    with session.locked((USER, "alice"), (USERNAME, "alice"), (LINKED_USER, "alice")):
+        assert len(session.locks) == 3
+    assert len(session.locks) == 0
@@ -0,0 +1,47 @@
+import pytest
+from dungeonmaker.dm_backend.modules.database import InMemoryDatabaseAbstraction, SQLiteDocumentStore, TieredDatabaseAbstraction
+from dungeonmaker.dm_backend.modules.database.tiered import VERSION_FIELD
+from dungeonmaker.dm_backend.modules.dm.unit_of_work import WriteOperation
+
+
+class FailingDatabaseAbstraction(InMemoryDatabaseAbstraction):
+    def bulk_write(self, *, operations):
+        raise ConnectionError("remote is down")
+
+
+def test_write_back_keeps_writes_local_until_flushed():
+    remote = InMemoryDatabaseAbstraction()
+    tier = TieredDatabaseAbstraction(local=SQLiteDocumentStore(), remote=remote, write_back=True)
+    tier.insert_user(data={"user_id": "u1", "username": "alice"})
+    tier.update_user("u1", updator={"$set": {"username": "alicia"}})
+    assert remote.collections["users"] == {}
+    assert tier.select_user("u1") == {"user_id": "u1", "username": "alicia"}
+    assert tier.local.get("users", "u1").dirty
+    assert tier.flush() == 1
+    assert remote.select_user("u1") == {"user_id": "u1", "username": "alicia", VERSION_FIELD: 2}
+    entry = tier.local.get("users", "u1")
+    assert (entry.dirty, entry.version) == (False, 2)
+    assert tier.stats.writes == 2
+
+
+def test_failed_bulk_writes_roll_back_the_local_copies():
+    remote = FailingDatabaseAbstraction()
+    remote.insert_user(data={"user_id": "u1", "username": "alice", VERSION_FIELD: 1})
+    tier = TieredDatabaseAbstraction(local=SQLiteDocumentStore(), remote=remote)
+    assert tier.select_user("u1")["username"] == "alice"
+    with pytest.raises(ConnectionError):
+        tier.bulk_write(operations=[
+            WriteOperation(kind="update", collection="users", key_field="user_id", key="u1", data={"username": "alicia"}),
+            WriteOperation(kind="insert", collection="users", key_field="user_id", key="u2", data={"user_id": "u2", "username": "bob"}),
+        ])
+    assert tier.local.get("users", "u1") is None and tier.local.get("users", "u2") is None
+    assert tier.select_user("u1") == {"user_id": "u1", "username": "alice"}
+
+
+def test_newer_remote_documents_replace_expired_local_copies():
+    remote = InMemoryDatabaseAbstraction()
+    tier = TieredDatabaseAbstraction(local=SQLiteDocumentStore(), remote=remote, max_age=0)
+    tier.insert_user(data={"user_id": "u1", "username": "alice"})
+    remote.update_user("u1", updator={"$set": {"username": "alicia", VERSION_FIELD: 2}})
+    assert tier.select_user("u1")["username"] == "alicia"
+    assert (tier.stats.expirations, tier.stats.stale) == (1, 1)
@@ -0,0 +1,70 @@
+import base64
+import pytest
+from dungeonmaker.dm_backend.modules.dm import tiles
+from dungeonmaker.dm_backend.modules.dm.tiles import HEADER, MAGIC, FORMAT_VERSION, FLAG_RLE, MAX_TILES, RoomGrid, encode_room, decode_room, encode_varint
+from dungeonmaker.dm_backend.transfer import MAX_CONTENT_SIZE, decoded_content, encoded_content
+
+
+def grid_room(*, flags, tile_width, bits, palette, count):
+    out = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, flags, tile_width, bits))
+    for value in (count, 0, len(palette)):
+        encode_varint(value, out)
+    for tile in palette:
+        encode_varint(len(tile.encode()), out)
+        out += tile.encode()
+    return out
+
+
+def run_length_room(*, tile_width, palette, count, value=0):
+    out = grid_room(flags=FLAG_RLE, tile_width=tile_width, bits=1, palette=palette, count=count)
+    encode_varint(value, out)
+    encode_varint(count, out)
+    return bytes(out)
+
+
+@pytest.mark.parametrize("text", ["", "abc", "ab" * 300, "aabbcc" * 50 + "x"])
+def test_rooms_round_trip(text):
+    assert decode_room(encode_room(text)) == text
+    assert decoded_content(encoded_content(text)) == text
+
+
+def test_palette_entries_have_to_be_tile_width_long():
+    with pytest.raises(ValueError, match="corrupt"):
+        decode_room(run_length_room(tile_width=1, palette=["x" * 1000], count=MAX_TILES))
+
+
+def test_oversized_rooms_are_rejected_before_expanding():
+    payload = run_length_room(tile_width=255, palette=["x" * 255], count=MAX_TILES)
+    assert len(payload) < 300
+    with pytest.raises(ValueError, match=str(MAX_CONTENT_SIZE)):
+        decoded_content(base64.b64encode(payload).decode())
+
+
+@pytest.mark.parametrize("value", [1, 70000])
+def test_runs_outside_the_palette_are_rejected(value):
+    payload = run_length_room(tile_width=1, palette=["x"], count=3, value=value)
+    with pytest.raises(ValueError, match="corrupt"):
+        decode_room(payload)
+    with pytest.raises(ValueError, match="corrupt"):
+        decoded_content(base64.b64encode(payload).decode())
+
+
+@pytest.mark.parametrize(("bits", "body"), [(2, bytes([0b11100100])), (8, bytes([0, 1, 2, 1])), (16, bytes([0, 0, 1, 0, 0, 1, 0, 0]))])
+def test_packed_indices_outside_the_palette_are_rejected(bits, body):
+    payload = bytes(grid_room(flags=0, tile_width=1, bits=bits, palette=["a", "b"], count=4) + body)
+    with pytest.raises(ValueError, match="corrupt"):
+        decode_room(payload)
+
+
+@pytest.mark.parametrize("text", ["ab" * 300, "abcdefgh" * 40 + "ij", "".join(chr(0x4e00 + index % 300) for index in range(900))])
+def test_numpy_matches_the_pure_python_path(text, monkeypatch):
+    pytest.importorskip("numpy")
+    with_numpy = encode_room(text)
+    grid = RoomGrid.from_text(text)
+    runs = grid.runs()
+    assert decode_room(with_numpy) == text
+    monkeypatch.setattr(tiles, "numpy", None)
+    assert encode_room(text) == with_numpy
+    assert RoomGrid.from_text(text) == grid
+    assert grid.runs() == runs
+    assert decode_room(with_numpy) == text
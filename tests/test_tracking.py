@@ -0,0 +1,75 @@
+from dataclasses import dataclass, field
+from typing import Union
+from dungeonmaker.dm_backend.modules.dm import tracking
+from dungeonmaker.dm_backend.modules.dm.tracking import Tracked, WriteStats
+
+
+@dataclass(slots=True)
+class Thing(Tracked):
+    likers : list = field(kw_only=True, default_factory=list)
+    name : str = field(kw_only=True, default="")
+    new : bool = field(kw_only=True, default=True)
+    _snapshot : Union[dict, None] = field(kw_only=True, default=None)
+
+
+@dataclass(slots=True)
+class MergedThing(Tracked):
+    MERGED_FIELDS = ("likers",)
+    likers : list = field(kw_only=True, default_factory=list)
+    new : bool = field(kw_only=True, default=True)
+    _snapshot : Union[dict, None] = field(kw_only=True, default=None)
+
+
+def write(thing):
+    updates = []
+    thing.write_document(insert=updates.append, update=lambda changes, additions: updates.append({**changes, **{key: ("added", items) for key, items in additions.items()}}), stats=WriteStats())
+    return updates
+
+
+def count_fingerprints(monkeypatch):
+    calls = []
+    original = tracking.fingerprint
+    monkeypatch.setattr(tracking, "fingerprint", lambda value: calls.append(value) or original(value))
+    return calls
+
+
+def test_loading_does_not_fingerprint(monkeypatch):
+    calls = count_fingerprints(monkeypatch)
+    Thing(likers=["a"], new=False)
+    assert calls == []
+
+
+def test_changes_in_place_are_written(monkeypatch):
+    thing = Thing(likers=["a"], name="x", new=False)
+    assert write(thing) == []
+    thing.likers.append("b")
+    assert write(thing) == [{"likers": ["a", "b"]}]
+    thing.likers.append("c")
+    calls = count_fingerprints(monkeypatch)
+    assert write(thing) == [{"likers": ["a", "b", "c"]}]
+    assert len(calls) == 3
+    assert write(thing) == []
+
+
+def test_type_changes_are_written():
+    thing = Thing(name="", new=False)
+    thing.name = None
+    assert write(thing) == [{"name": None}]
+
+
+def test_appended_elements_of_merged_fields_are_added():
+    thing = MergedThing(likers=["a"], new=False)
+    thing.likers.append("b")
+    assert write(thing) == [{"likers": ("added", ["b"])}]
+    thing.likers.append("c")
+    assert write(thing) == [{"likers": ("added", ["c"])}]
+    assert write(thing) == []
+    thing.likers.remove("a")
+    assert write(thing) == [{"likers": ["b", "c"]}]
+
+
+def test_new_merged_fields_are_inserted():
+    thing = MergedThing(likers=["a"])
+    assert write(thing) == [{"likers": ["a"], "new": False}]
+    thing.likers.append("b")
+    assert write(thing) == [{"likers": ("added", ["b"])}]
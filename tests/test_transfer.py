@@ -0,0 +1,50 @@
+import pytest
+from scratchcommunication.cloudrequests import ErrorMessage
+from dungeonmaker.dm_backend.backend import edited_content
+from dungeonmaker.dm_backend.transfer import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, UploadStore, apply_delta, checksum, clamp_chunk_size, content_chunk
+
+
+def test_content_is_split_into_chunks():
+    content = "x" * 150 + "y" * 20
+    chunks = [content_chunk(content, index, chunk_size=64) for index in range(3)]
+    assert [chunk["data"] for chunk in chunks] == [content[:64], content[64:128], content[128:]]
+    assert {chunk["content_crc"] for chunk in chunks} == {checksum(content)}
+    assert all(chunk["crc"] == checksum(chunk["data"]) and chunk["chunks"] == 3 for chunk in chunks)
+    assert content_chunk("", 0)["data"] == ""
+    with pytest.raises(IndexError):
+        content_chunk(content, 3, chunk_size=64)
+    assert (clamp_chunk_size(None), clamp_chunk_size(1), clamp_chunk_size(10**6)) == (1024, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+
+
+def test_uploads_check_chunks_and_the_content():
+    content = "abc" * 30
+    upload = UploadStore().begin(user_id="u1", room_id=1, bound_dungeon=7, size=len(content), content_crc=checksum(content), chunk_size=64)
+    with pytest.raises(ValueError, match="Checksum of chunk 0"):
+        upload.add(0, content[:64], checksum(content[:64]) + 1)
+    with pytest.raises(ValueError, match="has to be 26 characters"):
+        upload.add(1, content[63:], checksum(content[63:]))
+    upload.add(1, content[64:], checksum(content[64:]))
+    assert upload.missing() == [0]
+    with pytest.raises(ValueError, match="missing"):
+        upload.assemble()
+    upload.add(0, content[:64], checksum(content[:64]))
+    assert upload.assemble() == content
+
+
+def test_deltas_apply_to_the_original_positions():
+    assert apply_delta("abcdef", [[4, 5, "E"], [0, 1, "AA"], [3, 3, "-"]]) == "AAbc-dEf"
+    for edits in ([[2, 1, ""]], [[0, 3, ""], [2, 4, ""]], [[0, 7, ""]], [["0", 1, ""]]):
+        with pytest.raises(ValueError):
+            apply_delta("abcdef", edits)
+
+
+def test_deltas_against_other_content_are_rejected():
+    assert edited_content("abcdef", checksum("abcdef"), [0, 1, "A", 5, 6, "F"]) == "AbcdeF"
+    with pytest.raises(ErrorMessage, match="changed"):
+        edited_content("abcdef", checksum("abcdeg"), [0, 1, "A"])
+    with pytest.raises(ErrorMessage, match="changed"):
+        edited_content(None, checksum(""), [])
+    with pytest.raises(ErrorMessage, match="start, end, replacement"):
+        edited_content("abcdef", checksum("abcdef"), [0, 1])
+    with pytest.raises(ErrorMessage, match="out of range"):
+        edited_content("abcdef", checksum("abcdef"), [0, 9, ""])
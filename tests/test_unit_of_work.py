@@ -0,0 +1,39 @@
+import pytest
+from dungeonmaker.dm_backend.modules.dm.unit_of_work import WriteBehindQueue, WriteOperation, PartialWriteError
+
+
+def insert(collection, key_field, key, **data):
+    return WriteOperation(kind="insert", collection=collection, key_field=key_field, key=key, data={key_field: key, **data})
+
+
+def update(collection, key_field, key, **data):
+    return WriteOperation(kind="update", collection=collection, key_field=key_field, key=key, data=data)
+
+
+def test_retried_inserts_are_upserts(mongo_dba):
+    mongo_dba.bulk_write(operations=[insert("users", "user_id", "1", username="a")])
+    mongo_dba.bulk_write(operations=[insert("users", "user_id", "1", username="b")])
+    assert [user["username"] for user in mongo_dba.connection.users.find()] == ["b"]
+
+
+def test_only_failed_operations_are_reported(mongo_dba):
+    mongo_dba.bulk_write(operations=[insert("users", "user_id", "1", username="a"), insert("users", "user_id", "2", username="b")])
+    failing = update("users", "user_id", "2", _id="changed")
+    with pytest.raises(PartialWriteError) as error:
+        mongo_dba.bulk_write(operations=[update("users", "user_id", "1", username="c"), failing, insert("dungeons", "dungeon_id", 5)])
+    assert error.value.failed == [failing]
+    assert mongo_dba.connection.users.find_one({"user_id": "1"})["username"] == "c"
+    assert mongo_dba.connection.dungeons.count_documents({}) == 1
+
+
+def test_flush_requeues_only_failed_operations():
+    def flush(operations):
+        raise PartialWriteError("1 of 2 writes failed.", failed=[operations[1]])
+    queue = WriteBehindQueue(flush_callback=flush)
+    queue.update("users", "user_id", "1", {"username": "a"})
+    queue.update("users", "user_id", "2", {"username": "b"})
+    with pytest.raises(PartialWriteError):
+        queue.flush()
+    assert not queue.is_pending("users", "1")
+    assert queue.is_pending("users", "2")
+    assert queue.flushed_operations == 1
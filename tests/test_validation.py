@@ -0,0 +1,37 @@
+import pytest
+from dungeonmaker.dm_backend.modules.dm.validation import RoomValidator, normalize_content
+from dungeonmaker.dm_backend.transfer import MAX_CONTENT_SIZE, UploadStore
+
+
+def test_content_is_normalized():
+    assert normalize_content("a\x00b\ud800café") == "abcafé"
+    validator = RoomValidator()
+    assert validator.sanitize("café") == "café"
+    assert validator.validate("café").normalized
+    assert validator.sanitize("plain") == "plain"
+
+
+@pytest.mark.parametrize(("content", "error"), [
+    (None, "has to be a string"),
+    ("x" * 11, "at most 10 characters"),
+    ("abcd", "at most 3 distinct characters"),
+])
+def test_invalid_content_is_rejected(content, error):
+    validator = RoomValidator(max_size=10, max_characters=3)
+    assert error in validator.validate(content).error
+    with pytest.raises(ValueError, match=error):
+        validator.sanitize(content)
+
+
+def test_verdicts_are_remembered():
+    validator = RoomValidator(max_characters=3)
+    for _ in range(3):
+        assert not validator.validate("abcd").valid
+        assert validator.validate("abc").valid
+    assert (validator.verdicts.stats.hits, validator.verdicts.stats.misses) == (4, 2)
+
+
+def test_uploads_share_the_size_limit():
+    assert RoomValidator().max_size == MAX_CONTENT_SIZE
+    with pytest.raises(ValueError, match=str(MAX_CONTENT_SIZE)):
+        UploadStore().begin(user_id="u", room_id=1, bound_dungeon=7, size=MAX_CONTENT_SIZE + 1, content_crc=0)